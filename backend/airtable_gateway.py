@@ -0,0 +1,229 @@
+"""
+Gateway compartido para todo el acceso a Airtable del backend.
+
+- Una única sesión HTTP con pool de conexiones por proceso.
+- Un token bucket compartido entre los workers de gunicorn (archivo local con
+  lock), para no superar el límite de Airtable de 5 req/s por base.
+- Reintentos con backoff exponencial cuando Airtable responde 429 (o 5xx en
+  lecturas). Un 429 pausa a todos los workers, no solo al que lo recibió.
+- Conteo de llamadas por tabla, visible en /api/admin/airtable_stats.
+
+Los handlers siguen usando `api.table(BASE_ID, ...)`: el `api` que expone el
+gateway es un `pyairtable.Api` normal cuya sesión pasa por el bucket.
+"""
+
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from pyairtable import Api
+
+try:
+    import fcntl
+except ImportError:  # Windows: el bucket queda limitado al proceso actual
+    fcntl = None
+
+AIRTABLE_RATE_LIMIT = float(os.getenv("AIRTABLE_RATE_LIMIT", "5"))  # requests por segundo por base
+AIRTABLE_BURST = float(os.getenv("AIRTABLE_BURST", "5"))
+AIRTABLE_MAX_RETRIES = int(os.getenv("AIRTABLE_MAX_RETRIES", "5"))
+AIRTABLE_POOL_SIZE = int(os.getenv("AIRTABLE_POOL_SIZE", "10"))
+AIRTABLE_TIMEOUT = (5, 30)  # (connect, read) en segundos
+AIRTABLE_API_URL = os.getenv("AIRTABLE_API_URL", "https://api.airtable.com")  # Para pruebas: servidor local
+AIRTABLE_GATEWAY_STATE = os.getenv(
+    "AIRTABLE_GATEWAY_STATE",
+    os.path.join(tempfile.gettempdir(), "traful_airtable_gateway.json")
+)
+
+# Airtable pide esperar 30 segundos después de un 429
+THROTTLE_PENALTY_SECONDS = 30
+RETRIABLE_READ_STATUS = (500, 502, 503, 504)
+
+_TABLE_FROM_URL = re.compile(r"/v0/(?:bases/)?app[^/]+/([^/?]+)")
+
+
+def _table_from_url(url):
+    """Extrae el ID/nombre de tabla de una URL de la API de Airtable."""
+    match = _TABLE_FROM_URL.search(url or "")
+    return match.group(1) if match else "meta"
+
+
+class SharedTokenBucket:
+    """
+    Token bucket cuyo estado vive en un archivo local compartido por todos los
+    procesos de la máquina. Cada toma de token también suma el contador de la
+    tabla, así las estadísticas cubren a todos los workers.
+    """
+
+    def __init__(self, path=AIRTABLE_GATEWAY_STATE, rate=AIRTABLE_RATE_LIMIT, burst=AIRTABLE_BURST):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._fd = None
+        self._fd_pid = None
+        self._local_state = None  # Solo se usa si no hay fcntl
+
+    def _open(self):
+        # Un fd heredado por fork comparte el lock con el padre: reabrir por proceso
+        if self._fd is None or self._fd_pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._fd_pid = os.getpid()
+        return self._fd
+
+    def _read(self, fd):
+        if fcntl is None:
+            return self._local_state
+        os.lseek(fd, 0, os.SEEK_SET)
+        raw = b""
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            raw += chunk
+        try:
+            return json.loads(raw.decode("utf-8")) if raw else None
+        except ValueError:
+            return None
+
+    def _write(self, fd, state):
+        if fcntl is None:
+            self._local_state = state
+            return
+        data = json.dumps(state).encode("utf-8")
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, data)
+
+    def _transaction(self, fn):
+        """Ejecuta fn(state) con el archivo bloqueado y persiste el estado resultante."""
+        with self._lock:
+            fd = self._open() if fcntl is not None else None
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                state = self._read(fd) or {"tokens": self.burst, "updated": time.time(), "paused_until": 0, "tables": {}}
+                result = fn(state)
+                self._write(fd, state)
+                return result
+            finally:
+                if fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def acquire(self, table):
+        """Bloquea hasta obtener un token. Devuelve los segundos esperados."""
+        waited = 0.0
+        while True:
+            def take(state):
+                now = time.time()
+                if state.get("paused_until", 0) > now:
+                    return state["paused_until"] - now
+                elapsed = max(0.0, now - state.get("updated", now))
+                state["tokens"] = min(self.burst, state.get("tokens", 0) + elapsed * self.rate)
+                state["updated"] = now
+                if state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    counters = state["tables"].setdefault(table, {"calls": 0, "throttled": 0, "retries": 0, "errors": 0})
+                    counters["calls"] += 1
+                    return 0
+                return (1 - state["tokens"]) / self.rate
+
+            wait = self._transaction(take)
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def record(self, table, counter, pause=None):
+        """Suma un contador de la tabla y, opcionalmente, pausa el bucket para todos."""
+        def update(state):
+            counters = state["tables"].setdefault(table, {"calls": 0, "throttled": 0, "retries": 0, "errors": 0})
+            counters[counter] = counters.get(counter, 0) + 1
+            if pause:
+                state["paused_until"] = max(state.get("paused_until", 0), time.time() + pause)
+        self._transaction(update)
+
+    def snapshot(self):
+        return self._transaction(lambda state: json.loads(json.dumps(state)))
+
+
+class ThrottledSession(requests.Session):
+    """Sesión de requests que pide un token antes de cada llamada y reintenta los 429."""
+
+    def __init__(self, bucket, max_retries=AIRTABLE_MAX_RETRIES, pool_size=AIRTABLE_POOL_SIZE):
+        super().__init__()
+        self.bucket = bucket
+        self.max_retries = max_retries
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        table = _table_from_url(url)
+        attempt = 0
+        while True:
+            self.bucket.acquire(table)
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.exceptions.ConnectionError:
+                if method.upper() != "GET" or attempt >= self.max_retries:
+                    self.bucket.record(table, "errors")
+                    raise
+                response = None
+
+            status = response.status_code if response is not None else None
+            throttled = status == 429
+            retriable = throttled or response is None or (method.upper() == "GET" and status in RETRIABLE_READ_STATUS)
+            if not retriable:
+                if status is not None and status >= 400:
+                    self.bucket.record(table, "errors")
+                return response
+
+            if attempt >= self.max_retries:
+                self.bucket.record(table, "errors")
+                return response
+
+            attempt += 1
+            if throttled:
+                retry_after = response.headers.get("Retry-After")
+                pause = float(retry_after) if retry_after and retry_after.isdigit() else THROTTLE_PENALTY_SECONDS
+                self.bucket.record(table, "throttled", pause=pause)
+                print(f"ADVERTENCIA: Airtable devolvió 429 en {table}. Pausando {pause}s (intento {attempt}/{self.max_retries}).")
+            else:
+                self.bucket.record(table, "retries")
+                # Backoff exponencial con jitter: 0.5, 1, 2, 4... segundos
+                time.sleep(0.5 * (2 ** (attempt - 1)) + random.uniform(0, 0.25))
+
+
+class AirtableGateway:
+    """Punto único de acceso a Airtable: una Api de pyairtable sobre la sesión compartida."""
+
+    def __init__(self, token, state_path=AIRTABLE_GATEWAY_STATE):
+        self.bucket = SharedTokenBucket(path=state_path)
+        # Los reintentos los maneja ThrottledSession, no urllib3
+        self.api = Api(token, timeout=AIRTABLE_TIMEOUT, retry_strategy=None, endpoint_url=AIRTABLE_API_URL)
+        self.api.session = ThrottledSession(self.bucket)
+        self.api.api_key = token  # Vuelve a poner el header Authorization en la nueva sesión
+
+    def table(self, base_id, table_id):
+        return self.api.table(base_id, table_id)
+
+    def reset_connections(self):
+        """Cierra las conexiones del pool (antes del fork: cada worker abre las suyas)."""
+        self.api.session.close()
+
+    def stats(self):
+        """Contadores por tabla acumulados entre todos los workers."""
+        state = self.bucket.snapshot()
+        return {
+            "rate_limit": self.bucket.rate,
+            "burst": self.bucket.burst,
+            "tokens_disponibles": round(state.get("tokens", 0), 2),
+            "pausado_hasta": state.get("paused_until", 0),
+            "tablas": state.get("tables", {}),
+        }
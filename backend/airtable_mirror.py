@@ -0,0 +1,302 @@
+"""
+Espejo local en SQLite de las tablas de Airtable (todas las de config.TABLE_IDS).
+
+- Sincronización incremental: solo se piden los registros modificados desde la
+  última sincronización, con un filtro LAST_MODIFIED_TIME().
+- El filtro no ve los registros borrados: cada AIRTABLE_MIRROR_FULL_INTERVAL
+  segundos la sincronización de cada tabla es completa (por defecto cada hora
+  sin webhook configurado, una vez por día con webhook, como red de seguridad).
+- Webhooks de Airtable: `apply_webhook_payload()` borra los registros
+  destruidos y vuelve a pedir los creados/modificados.
+- Las lecturas (listados de admin, estadísticas, buscadores) pueden consultar
+  el espejo en vez de paginar la API REST.
+
+Uso por línea de comandos:
+    python airtable_mirror.py              # sincronización incremental de todas las tablas
+    python airtable_mirror.py --full       # resincronización completa
+    python airtable_mirror.py --full --table HISTORIAL
+    python airtable_mirror.py --status
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from local_store import data_path, open_db, transaction
+
+AIRTABLE_MIRROR_PATH = os.getenv("AIRTABLE_MIRROR_PATH", data_path("airtable_mirror.sqlite3"))
+AIRTABLE_MIRROR_ENABLED = os.getenv("AIRTABLE_MIRROR", "0") == "1"
+AIRTABLE_MIRROR_INTERVAL = int(os.getenv("AIRTABLE_MIRROR_INTERVAL", "120"))  # segundos
+AIRTABLE_WEBHOOK_ID = os.getenv("AIRTABLE_WEBHOOK_ID")
+AIRTABLE_WEBHOOK_MAC_SECRET = os.getenv("AIRTABLE_WEBHOOK_MAC_SECRET")  # macSecretBase64 del webhook
+# Resincronización completa periódica: la incremental no se entera de los borrados
+AIRTABLE_MIRROR_FULL_INTERVAL = int(os.getenv(
+    "AIRTABLE_MIRROR_FULL_INTERVAL", "86400" if AIRTABLE_WEBHOOK_ID else "3600"
+))  # segundos
+
+# Solapamiento para no perder cambios por diferencias de reloj con Airtable
+SYNC_OVERLAP_SECONDS = 60
+# Registros por fórmula OR(RECORD_ID()=...) al refrescar cambios de un webhook
+FETCH_CHUNK = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    table_id TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    created_time TEXT,
+    fields_json TEXT NOT NULL,
+    synced_at TEXT NOT NULL,
+    PRIMARY KEY (table_id, record_id)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    table_id TEXT PRIMARY KEY,
+    last_sync TEXT,
+    last_full_sync TEXT
+);
+CREATE TABLE IF NOT EXISTS webhook_state (
+    webhook_id TEXT PRIMARY KEY,
+    cursor INTEGER NOT NULL
+);
+"""
+
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+
+def _full_sync_due(row):
+    last_full = datetime.strptime(row["last_full_sync"], "%Y-%m-%dT%H:%M:%S.000Z").replace(tzinfo=timezone.utc)
+    return (_utcnow() - last_full).total_seconds() > AIRTABLE_MIRROR_FULL_INTERVAL
+
+
+def _iso(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+class AirtableMirror:
+    def __init__(self, api, base_id, tables, path=AIRTABLE_MIRROR_PATH):
+        self.api = api
+        self.base_id = base_id
+        self.tables = dict(tables)  # {nombre: table_id}
+        self.path = path
+        self._sync_lock = threading.Lock()
+        self._thread_pid = None
+        with open_db(self.path) as conn:
+            conn.executescript(SCHEMA)
+
+    # --- Lectura ---
+
+    def is_ready(self, table_id):
+        """True si la tabla ya tuvo al menos una sincronización completa."""
+        with open_db(self.path) as conn:
+            row = conn.execute("SELECT last_full_sync FROM sync_state WHERE table_id = ?", (table_id,)).fetchone()
+        return bool(row and row["last_full_sync"])
+
+    def records(self, table_id, where=None, params=(), order_by=None, limit=None, offset=None):
+        """
+        Records con el mismo formato que devuelve pyairtable ({id, createdTime, fields}).
+        `where`/`order_by` son SQL sobre las columnas de `records`; para campos usar
+        json_extract(fields_json, '$."Nombre del campo"').
+        """
+        sql = "SELECT record_id, created_time, fields_json FROM records WHERE table_id = ?"
+        if where:
+            sql += f" AND ({where})"
+        if order_by:
+            sql += f" ORDER BY {order_by}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = tuple(params) + (limit,)
+            if offset:
+                sql += " OFFSET ?"
+                params = tuple(params) + (offset,)
+        with open_db(self.path) as conn:
+            rows = conn.execute(sql, (table_id,) + tuple(params)).fetchall()
+        return [
+            {"id": row["record_id"], "createdTime": row["created_time"], "fields": json.loads(row["fields_json"])}
+            for row in rows
+        ]
+
+    def count(self, table_id, where=None, params=()):
+        sql = "SELECT COUNT(*) FROM records WHERE table_id = ?"
+        if where:
+            sql += f" AND ({where})"
+        with open_db(self.path) as conn:
+            return conn.execute(sql, (table_id,) + tuple(params)).fetchone()[0]
+
+    # --- Escritura ---
+
+    def _upsert(self, conn, table_id, records):
+        now = _iso(_utcnow())
+        conn.executemany(
+            "INSERT OR REPLACE INTO records (table_id, record_id, created_time, fields_json, synced_at) VALUES (?, ?, ?, ?, ?)",
+            [(table_id, r["id"], r.get("createdTime"), json.dumps(r.get("fields", {})), now) for r in records]
+        )
+
+    def upsert_records(self, table_id, records):
+        """Aplica registros escritos por el propio backend sin esperar a la próxima sincronización."""
+        with open_db(self.path) as conn, transaction(conn):
+            self._upsert(conn, table_id, records)
+
+    def sync_table(self, table_id, full=False):
+        """Sincroniza una tabla. Devuelve la cantidad de registros recibidos."""
+        table = self.api.table(self.base_id, table_id)
+        started = _utcnow()
+        with open_db(self.path) as conn:
+            row = conn.execute("SELECT last_sync, last_full_sync FROM sync_state WHERE table_id = ?", (table_id,)).fetchone()
+        incremental = not full and row and row["last_full_sync"] and row["last_sync"] and not _full_sync_due(row)
+
+        if incremental:
+            since = datetime.strptime(row["last_sync"], "%Y-%m-%dT%H:%M:%S.000Z").replace(tzinfo=timezone.utc)
+            since -= timedelta(seconds=SYNC_OVERLAP_SECONDS)
+            formula = f"IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{_iso(since)}'))"
+            records = table.all(formula=formula)
+        else:
+            records = table.all()
+
+        with open_db(self.path) as conn, transaction(conn):
+            if not incremental:
+                # Resincronización completa: también elimina los registros borrados en Airtable
+                conn.execute("DELETE FROM records WHERE table_id = ?", (table_id,))
+            self._upsert(conn, table_id, records)
+            conn.execute(
+                """INSERT INTO sync_state (table_id, last_sync, last_full_sync) VALUES (?, ?, ?)
+                   ON CONFLICT(table_id) DO UPDATE SET
+                     last_sync = excluded.last_sync,
+                     last_full_sync = COALESCE(excluded.last_full_sync, sync_state.last_full_sync)""",
+                (table_id, _iso(started), None if incremental else _iso(started))
+            )
+        return len(records)
+
+    def sync_all(self, full=False, only=None):
+        """Sincroniza todas las tablas (o solo las indicadas por nombre). Devuelve {nombre: cantidad o error}."""
+        results = {}
+        with self._sync_lock:
+            for name, table_id in self.tables.items():
+                if only and name not in only:
+                    continue
+                try:
+                    results[name] = self.sync_table(table_id, full=full)
+                except Exception as e:
+                    print(f"ERROR sincronizando espejo de {name}: {e}")
+                    results[name] = f"error: {e}"
+        return results
+
+    def _fetch_by_ids(self, table_id, record_ids):
+        table = self.api.table(self.base_id, table_id)
+        records = []
+        ids = list(record_ids)
+        for i in range(0, len(ids), FETCH_CHUNK):
+            chunk = ids[i:i + FETCH_CHUNK]
+            formula = "OR(" + ",".join(f"RECORD_ID()='{rid}'" for rid in chunk) + ")"
+            records.extend(table.all(formula=formula))
+        return records
+
+    def apply_webhook_payload(self, payload):
+        """
+        Aplica un payload de webhook de Airtable (formato v0). Los valores vienen por
+        ID de campo, así que los registros creados/modificados se vuelven a pedir.
+        """
+        for table_id, changes in (payload.get("changedTablesById") or {}).items():
+            if table_id not in self.tables.values():
+                continue
+            destroyed = changes.get("destroyedRecordIds") or []
+            touched = set((changes.get("createdRecordsById") or {}).keys())
+            touched |= set((changes.get("changedRecordsById") or {}).keys())
+            touched -= set(destroyed)
+            fetched = self._fetch_by_ids(table_id, touched) if touched else []
+            with open_db(self.path) as conn, transaction(conn):
+                if destroyed:
+                    conn.executemany("DELETE FROM records WHERE table_id = ? AND record_id = ?",
+                                     [(table_id, rid) for rid in destroyed])
+                self._upsert(conn, table_id, fetched)
+
+    def consume_webhook(self, webhook_id):
+        """Lee y aplica los payloads pendientes del webhook desde el último cursor guardado."""
+        with open_db(self.path) as conn:
+            row = conn.execute("SELECT cursor FROM webhook_state WHERE webhook_id = ?", (webhook_id,)).fetchone()
+        cursor = row["cursor"] if row else 1
+        url = self.api.build_url("bases", self.base_id, "webhooks", webhook_id, "payloads")
+        applied = 0
+        while True:
+            response = self.api.request("GET", url, params={"cursor": cursor})
+            for payload in response.get("payloads", []):
+                self.apply_webhook_payload(payload)
+                applied += 1
+            cursor = response.get("cursor", cursor)
+            with open_db(self.path) as conn:
+                conn.execute(
+                    "INSERT INTO webhook_state (webhook_id, cursor) VALUES (?, ?) ON CONFLICT(webhook_id) DO UPDATE SET cursor = excluded.cursor",
+                    (webhook_id, cursor)
+                )
+            if not response.get("mightHaveMore"):
+                return applied
+
+    def start_periodic_sync(self, interval=AIRTABLE_MIRROR_INTERVAL):
+        """Thread de sincronización incremental. Se arranca una vez por proceso (después del fork)."""
+        if self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+
+        def run():
+            while True:
+                self.sync_all()
+                time.sleep(interval)
+
+        threading.Thread(target=run, name="airtable-mirror", daemon=True).start()
+
+    def status(self):
+        with open_db(self.path) as conn:
+            rows = conn.execute(
+                """SELECT s.table_id, s.last_sync, s.last_full_sync,
+                          (SELECT COUNT(*) FROM records r WHERE r.table_id = s.table_id) AS registros
+                   FROM sync_state s"""
+            ).fetchall()
+        by_id = {row["table_id"]: dict(row) for row in rows}
+        return {name: by_id.get(table_id, {"table_id": table_id, "last_sync": None}) for name, table_id in self.tables.items()}
+
+
+def verify_webhook_signature(body, header_value, secret_base64=AIRTABLE_WEBHOOK_MAC_SECRET):
+    """Valida el header X-Airtable-Content-MAC ("hmac-sha256=<hex>") de una notificación."""
+    if not secret_base64:
+        return True
+    if not header_value:
+        return False
+    expected = hmac.new(base64.b64decode(secret_base64), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(header_value, f"hmac-sha256={expected}")
+
+
+def main():
+    from airtable_gateway import AirtableGateway
+    from config import BASE_ID, TABLE_IDS
+
+    parser = argparse.ArgumentParser(description="Espejo local de la base de Airtable")
+    parser.add_argument("--full", action="store_true", help="Resincronización completa (descarta el espejo actual)")
+    parser.add_argument("--table", action="append", choices=sorted(TABLE_IDS), help="Limitar a una tabla (repetible)")
+    parser.add_argument("--status", action="store_true", help="Mostrar el estado de sincronización y salir")
+    args = parser.parse_args()
+
+    token = os.getenv("AIRTABLE_PAT")
+    if not token:
+        print("ERROR: AIRTABLE_PAT no configurado")
+        raise SystemExit(1)
+
+    mirror = AirtableMirror(AirtableGateway(token).api, BASE_ID, TABLE_IDS)
+    if args.status:
+        print(json.dumps(mirror.status(), indent=2))
+        return
+
+    started = time.time()
+    results = mirror.sync_all(full=args.full, only=args.table)
+    for name, result in results.items():
+        print(f"{name}: {result}")
+    print(f"Sincronización {'completa' if args.full else 'incremental'} terminada en {time.time() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
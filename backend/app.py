@@ -1,24 +1,46 @@
 import traceback
 import os
-from flask import Flask, request, jsonify, send_file, redirect
+from flask import Blueprint, Flask, request, jsonify, send_file, redirect, Response, stream_with_context
 from flask_cors import CORS, cross_origin
-from pyairtable import Api
 from pyairtable.formulas import match, AND, OR, SEARCH, LOWER, Field # Importar Field
 from dotenv import load_dotenv
-import mercadopago
 import json
-from weasyprint import HTML
 import io
 import resend
 from datetime import datetime
 import base64
 import hashlib
 import uuid
+import threading
+import time
+from urllib.parse import urlencode
 
 # Cargar variables de entorno desde el archivo .env
 load_dotenv()
 
-app = Flask(__name__)
+# Módulos propios: después de load_dotenv, porque leen su configuración del entorno
+from airtable_gateway import AirtableGateway
+from contactos import ContactStore
+from padron_cache import PadronCache, field_text
+from search_index import DniNameIndex, PrefixIndex
+from historial_journal import HistorialJournal
+from fanout import run_parallel
+from jobs import JobQueue, RetryJob
+from lazy_imports import lazy_object
+from log_shipper import LogShipper
+from mp_catchup import PaymentCatchUp, historial_formula, mp_sdk, search_approved
+from obligations import ObligationIndex
+from mail_queue import MailQueue
+from pagination import InvalidCursor, Paginator
+from pdf_pool import BACKENDS as PDF_BACKENDS, PDF_POOL_WORKERS, pool as pdf_pool
+from receipt_export import EXPORT_PAGE_SIZE, EXPORT_PDF_MAX_RECEIPTS, date_range_formula, parse_date, zip_stream
+from receipt_store import ReceiptStore
+from webhook_queue import WebhookQueue
+from stats_rollup import StatsRollup, efectivo_entry, historial_entry, manual_entry
+from airtable_mirror import AirtableMirror, AIRTABLE_MIRROR_ENABLED, AIRTABLE_WEBHOOK_ID, verify_webhook_signature
+
+# Las rutas se registran en el blueprint; la app la arma create_app() al final del módulo
+bp = Blueprint('backend', __name__)
 
 # Configuración CORS
 # Para producción, configurar CORS_ORIGINS en variables de entorno
@@ -27,8 +49,6 @@ if cors_origins != "*":
     # Si se especifican orígenes específicos, parsear la lista separada por comas
     cors_origins = [origin.strip() for origin in cors_origins.split(",")]
 
-CORS(app, resources={r"/*": {"origins": cors_origins}}, supports_credentials=True)
-
 # --- Verificación de Variables de Entorno ---
 print("--- Iniciando Verificación de Variables de Entorno ---")
 AIRTABLE_PAT_FROM_ENV = os.getenv("AIRTABLE_PAT")
@@ -71,26 +91,18 @@ print("--- Fin Verificación ---")
 # ---------------------------------------------
 
 # --- CONFIGURACION ---
-BASE_ID = "appoJs8XY2j2kwlYf"
-CONTRIBUTIVOS_TABLE_ID = "tblKbSq61LU1XXco0"
-DEUDAS_TABLE_ID = "tblHuS8CdqVqTsA3t"
-PATENTE_TABLE_ID = "tbl3CMMwccWeo8XSG"
-HISTORIAL_TABLE_ID = "tbl5p19Hv4cMk9NUS"
-LOGS_TABLE_ID = "tblLihQ9FmU6JD7NR"
-RECAUDACION_TABLE_ID = os.getenv("RECAUDACION_TABLE_ID", "tblzRhxpeqbuhrf78")
-PATENTE_MANUAL_TABLE_ID = os.getenv("PATENTE_MANUAL_TABLE_ID", "tblO0nlUQx3isKkXF")
-PLAN_PAGO_TABLE_ID = os.getenv("PLAN_PAGO_TABLE_ID", "tblMNNvOBuqQiCFqC")
-CONTACTOS_TABLE_ID = os.getenv("CONTACTOS_TABLE_ID", "tbl1ZcfxyaJtXPdPl")
-ACCESOS_PERSONAL_TABLE_ID = os.getenv("ACCESOS_PERSONAL_TABLE_ID", "tblAILbaYmnWkkPiV")
-WATER_TABLE_ID = "tblTgcF3XczjkpK3H" # ID de la tabla de Agua
-EFECTIVO_TABLE_ID = os.getenv("EFECTIVO_TABLE_ID", "tblXqPkaVnF9GHGdI") # ID de la tabla de Pagos Efectivo
+from config import (
+    BASE_ID, CONTRIBUTIVOS_TABLE_ID, DEUDAS_TABLE_ID, PATENTE_TABLE_ID, HISTORIAL_TABLE_ID,
+    LOGS_TABLE_ID, RECAUDACION_TABLE_ID, PATENTE_MANUAL_TABLE_ID, PLAN_PAGO_TABLE_ID,
+    CONTACTOS_TABLE_ID, ACCESOS_PERSONAL_TABLE_ID, WATER_TABLE_ID, EFECTIVO_TABLE_ID, TABLE_IDS
+)
 
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
 BACKEND_URL = os.getenv("RENDER_EXTERNAL_URL") or os.getenv("BACKEND_URL", "http://localhost:10000")
 
 # ... (código existente) ...
 
-@app.route('/api/send_payment_link', methods=['POST'])
+@bp.route('/api/send_payment_link', methods=['POST'])
 @cross_origin()
 def send_payment_link():
     data = request.json
@@ -122,616 +134,539 @@ def send_payment_link():
             </div>
             """
         }
-        # print(f"DEBUG: Intentando enviar email a {email} desde {from_email}...") # REMOVED DEBUG LOG
-        res_email = resend.Emails.send(params)
-        # print(f"DEBUG: Respuesta Resend: {res_email}") # REMOVED DEBUG LOG
-
-        # Verificar si Resend devolvió un ID (éxito) o si lanzó excepción
-        if not res_email.get('id'):
-             # print(f"ERROR: Resend no devolvió ID. Respuesta: {res_email}") # REMOVED DEBUG LOG
-             return jsonify({"error": "No se pudo enviar el email (Error proveedor)"}), 500
+        if not resend.api_key:
+            return jsonify({"error": "No se pudo enviar el email (Resend no configurado)"}), 500
+        # Se encola: el envío (con reintentos) lo hacen los threads de mail_queue
+        mail_id, _ = mail_queue.enqueue(params)
 
         # Guardar contacto en tabla Contactos
         save_contacto(email=email, origen='Link MP')
 
-        return jsonify({"success": True})
+        return jsonify({"success": True, "queued": True, "mail_id": mail_id})
     except Exception as e:
         print(f"ERROR CRÍTICO en send_payment_link: {str(e)}") # Esto saldrá en los logs de Render
         return jsonify({"error": f"Error interno: {str(e)}"}), 500
 
-@app.route('/api/patente_manual', methods=['POST'])
-@cross_origin()
-def registrar_patente_manual():
-    log_to_airtable('INFO', 'Patente Manual', 'Recibido nuevo pago de patente manual', details={'ip': request.remote_addr})
-    
-    if not api:
-        return jsonify({"error": "Error de configuración: Airtable no conectado"}), 500
-
-    try:
-        data = request.json
-        if not data:
-            return jsonify({"error": "Sin datos"}), 400
-
-        # 1. Generar PDF del recibo de Patente
-        items_pdf = [
-            {"description": f"Patente: {data.get('patente', '').upper()}", "amount": 0}, # Informativo
-            {"description": f"Vehículo: {data.get('marca')} {data.get('modelo')} ({data.get('anio')})", "amount": 0}, # Informativo
-            {"description": "Pago de Patente Automotor", "amount": float(data.get('monto') or 0)}
-        ]
-
-        if data.get('descuento') and float(data.get('descuento')) > 0:
-             items_pdf.append({"description": f"Descuento ({data.get('descuento')}%)", "amount": -1 * (float(data.get('monto')) - float(data.get('total_final')))})
-
-        if data.get('comentarios'):
-            items_pdf.append({"description": f"Comentarios: {data.get('comentarios')}", "amount": 0})
-
-        pdf_details = {
-            "FECHA_PAGO": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-            "ESTADO_PAGO": "Aprobado (Manual)",
-            "ID_PAGO_MP": f"PAT-{data.get('patente')}-{int(datetime.now().timestamp())}",
-            "NOMBRE_PAGADOR": data.get('nombre'),
-            "IDENTIFICADOR_PAGADOR": data.get('patente'),
-            "items": items_pdf,
-            "MONTO_TOTAL": data.get('total_final')
+# --- Cobros registrados por el personal (recaudación, patente, plan de pago, efectivo) ---
+# Cada endpoint arma un "plan" con los datos del formulario y lo ejecuta como job:
+# PDF, link de Mercado Pago y registro en Airtable corren en el request (el
+# frontend necesita el PDF y el link); email y contacto los hacen los workers.
+# Con "async": true en el body (o ?async=1) todo corre en segundo plano y se
+# responde enseguida con el job_id para consultar /api/jobs/<job_id>.
+
+COBRO_INLINE_STEPS = ('pdf', 'mp', 'airtable')
+COBRO_STEP_TIMEOUTS = {'pdf': 20, 'mp': 10, 'airtable': 15}  # segundos
+COBRO_ALL_STEPS = ('pdf', 'mp', 'airtable', 'email', 'contacto')
+
+def _mp_preference(title, amount, external_reference, data):
+    return {
+        "items": [{"title": title, "quantity": 1, "unit_price": float(amount)}],
+        "back_urls": {"success": f"{FRONTEND_URL}/exito", "failure": FRONTEND_URL, "pending": FRONTEND_URL},
+        "auto_return": "approved",
+        "notification_url": f"{BACKEND_URL}/api/payment_webhook",
+        "external_reference": json.dumps(external_reference),
+        "payer": {
+            "name": data.get('nombre'),
+            "email": data.get('email')
         }
+    }
 
-        # Intentar generar PDF - si falla, no bloquea el flujo
-        pdf_file = None
-        pdf_id = None
-        try:
-            pdf_file, pdf_id = create_receipt_pdf(pdf_details)
-        except Exception as pdf_error:
-            print(f"ERROR generando PDF en patente: {pdf_error}")
-            log_to_airtable('ERROR', 'Patente Manual', f'Error generando PDF: {pdf_error}')
-        
-        # 1.5 Generar Preferencia MP
-        mp_link = None
-        mp_id = None
-        if sdk and data.get('total_final') > 0:
-            try:
-                preference_data = {
-                    "items": [{"title": f"Patente {data.get('patente').upper()}", "quantity": 1, "unit_price": float(data.get('total_final'))}],
-                    "back_urls": {"success": f"{FRONTEND_URL}/exito", "failure": FRONTEND_URL, "pending": FRONTEND_URL},
-                    "auto_return": "approved",
-                    "notification_url": f"{BACKEND_URL}/api/payment_webhook",
-                    "external_reference": json.dumps({"type": "patente_manual", "email": data.get('email'), "dominio": data.get('patente').upper()}),
-                    "payer": {
-                        "name": data.get('nombre'),
-                        "email": data.get('email')
-                    }
-                }
-                preference_response = sdk.preference().create(preference_data)
-                mp_link = preference_response["response"]["init_point"]
-                mp_id = preference_response["response"]["id"]
-            except Exception as mp_err:
-                print(f"Error generando link MP Patente: {mp_err}")
-
-        # 2. Guardar en Airtable
-        try:
-            patente_table = api.table(BASE_ID, PATENTE_MANUAL_TABLE_ID)
-            record_data = {
-                "Fecha": data.get('fecha'),
-                "Contribuyente": data.get('nombre'),
-                "Dominio": data.get('patente', '').upper(),
-                "Vehículo": f"{data.get('marca')} {data.get('modelo')}",
-                "Año": int(data.get('anio')) if data.get('anio') else None,
-                "Email": data.get('email'),
-                "Total": float(data.get('total_final')),
-                "Operador": data.get('administrativo'),
-                "Estado Pago": "Pendiente",
-                "MP Preference ID": mp_id
-            }
-            if pdf_id:
-                record_data["PDF_ID"] = pdf_id
-            if data.get('comentarios'):
-                record_data["Comentarios"] = data.get('comentarios')
-            patente_table.create(record_data)
-        except Exception as airtable_err:
-            log_to_airtable('WARNING', 'Patente Manual', f'Fallo Airtable: {airtable_err}')
-
-        # 3. Enviar Email
-        email_sent = False
-        if data.get('email') and resend.api_key:
-            try:
-                from_email = os.getenv("RESEND_FROM_EMAIL", "trafulnet@geoarg.com")
-
-                html_content = f"<p>Estimado/a {data.get('nombre')},</p><p>Adjuntamos el comprobante de liquidación de patente para el dominio <strong>{data.get('patente', '').upper()}</strong>.</p>"
-
-                if mp_link:
-                    html_content += f"""
+def _pay_button(mp_link, total_label, total, button_label):
+    return f"""
                     <br>
-                    <p><strong>Total a Pagar: ${data.get('total_final')}</strong></p>
-                    <a href="{mp_link}" style="background-color: #009ee3; color: white; padding: 12px 24px; text-decoration: none; border-radius: 5px; font-weight: bold; display: inline-block;">Pagar Patente con Mercado Pago</a>
+                    <p><strong>{total_label}: ${total}</strong></p>
+                    <a href="{mp_link}" style="background-color: #009ee3; color: white; padding: 12px 24px; text-decoration: none; border-radius: 5px; font-weight: bold; display: inline-block;">{button_label}</a>
                     <br><br>
                     """
 
-                params = {
-                    "from": from_email,
-                    "to": data.get('email'),
-                    "subject": "Solicitud de Pago Patente - Comuna de Villa Traful",
-                    "html": html_content
-                }
-
-                # Solo agregar PDF si se generó exitosamente
-                if pdf_file:
-                    params["attachments"] = [{"filename": f"patente_{data.get('patente')}.pdf", "content": base64.b64encode(pdf_file.getvalue()).decode('utf-8')}]
-
-                resend.Emails.send(params)
-                email_sent = True
-                log_to_airtable('INFO', 'Patente Manual', f'Email enviado a {data.get("email")}')
+# Backend del PDF en los cobros en efectivo (mucho volumen en caja); por defecto RECEIPT_BACKEND
+EFECTIVO_RECEIPT_BACKEND = os.getenv("RECEIPT_BACKEND_EFECTIVO")
 
-                # Guardar contacto en tabla Contactos
-                save_contacto(email=data.get('email'), nombre=data.get('nombre'), origen='Patente')
-            except Exception as email_error:
-                print(f"ERROR enviando email patente: {email_error}")
-                log_to_airtable('ERROR', 'Patente Manual', f'Error enviando email a {data.get("email")}: {email_error}')
+EFECTIVO_FOOTER = """
+                <p style="color: #666; font-size: 12px; margin-top: 20px;">
+                    Comuna de Villa Traful - Provincia de Neuquén<br>
+                    CUIT: 30-67297005-5. Laffitte 0 . Villa Traful
+                </p>
+                """
 
-        # Mensaje de respuesta según lo que funcionó
-        message = "Pago de Patente registrado"
-        if email_sent:
-            message += " y email enviado exitosamente"
-        elif data.get('email'):
-            message += " pero hubo un error al enviar el email"
+def _importes_items(data):
+    items_pdf = []
+    notas = data.get('notas', {})
+    for key, val in data.get('importes', {}).items():
+        monto = float(val)
+        if monto > 0:
+            # Buscar label (esto es simplificado, idealmente vendría del front o map)
+            label = key.replace('_', ' ').capitalize()
+            # Agregar nota si existe
+            if notas.get(key):
+                label += f" ({notas.get(key)})"
+            items_pdf.append({"description": label, "amount": monto})
+
+    # Agregar descuento si existe
+    if data.get('descuento') and float(data.get('descuento')) > 0:
+         items_pdf.append({"description": f"Descuento ({data.get('descuento')}%)", "amount": -1 * (float(data.get('total')) - float(data.get('total_final')))})
+    return items_pdf
+
+def plan_recaudacion(data):
+    total_final = data.get('total_final')
+    notas = data.get('notas', {})
+
+    def record(pdf_id, mp_id):
+        detalle_completo = {
+            "importes": data.get('importes'),
+            "notas": notas
+        }
+        record_data = {
+            "Fecha": data.get('fecha'),
+            "Contribuyente": data.get('nombre'),
+            "Email": data.get('email'),
+            "Total": total_final,
+            "Detalle JSON": json.dumps(detalle_completo),
+            "Operador": data.get('administrativa'),
+            "Estado Pago": "Pendiente"
+        }
+        if pdf_id:
+            record_data["PDF_ID"] = pdf_id
+        # El webhook de MP cruza por email y monto con los registros "Pendiente"
+        return RECAUDACION_TABLE_ID, record_data
 
+    def email_html(mp_link):
+        html_content = f"<p>Estimado/a {data.get('nombre')},</p><p>Adjuntamos el detalle de tasas y derechos generados el {data.get('fecha')}.</p>"
         if mp_link:
-            message += " (link de pago generado)"
-
-        return jsonify({
-            "success": True,
-            "message": message,
-            "email_sent": email_sent,
-            "pdf_generated": pdf_file is not None,
-            "mp_link": mp_link,
-            "pdf_base64": base64.b64encode(pdf_file.getvalue()).decode('utf-8') if pdf_file else None
-        })
-
-    except Exception as e:
-        log_to_airtable('ERROR', 'Patente Manual', f'Error procesando patente: {e}')
-        return jsonify({"error": str(e)}), 500
+            html_content += _pay_button(mp_link, "Total a Pagar", total_final, "Pagar Ahora con Mercado Pago")
+        html_content += "<p>Gracias por su contribución.</p>"
+        return html_content
 
-@app.route('/api/plan_pago', methods=['POST'])
-@cross_origin()
-def registrar_plan_pago():
-    log_to_airtable('INFO', 'Plan de Pago', 'Recibido nuevo plan de pago', details={'ip': request.remote_addr})
-
-    if not api:
-        return jsonify({"error": "Error de configuración: Airtable no conectado"}), 500
-
-    try:
-        data = request.json
-        if not data:
-            return jsonify({"error": "Sin datos"}), 400
-
-        # 1. Generar PDF del recibo
-        items_pdf = [
-            {"description": f"Plan de Pago - Cuota #{data.get('cuota_plan')}", "amount": float(data.get('monto_total') or 0)}
-        ]
-
-        pdf_details = {
+    return {
+        "pdf_details": {
             "FECHA_PAGO": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-            "ESTADO_PAGO": "Pendiente",
-            "ID_PAGO_MP": f"PLAN-{int(datetime.now().timestamp())}",
+            "ESTADO_PAGO": "Aprobado (Manual)",
+            "ID_PAGO_MP": f"MAN-{int(datetime.now().timestamp())}",
             "NOMBRE_PAGADOR": data.get('nombre'),
             "IDENTIFICADOR_PAGADOR": data.get('email'),
-            "items": items_pdf,
-            "MONTO_TOTAL": data.get('monto_total')
-        }
-
-        # Intentar generar PDF - si falla, no bloquea el flujo
-        pdf_file = None
-        pdf_id = None
-        try:
-            pdf_file, pdf_id = create_receipt_pdf(pdf_details)
-        except Exception as pdf_error:
-            print(f"ERROR generando PDF en plan de pago: {pdf_error}")
-            log_to_airtable('ERROR', 'Plan de Pago', f'Error generando PDF: {pdf_error}')
-
-        # 2. Generar Preferencia MP
-        mp_link = None
-        mp_id = None
-        if sdk and float(data.get('monto_total', 0)) > 0:
-            try:
-                preference_data = {
-                    "items": [{"title": f"Plan de Pago - Cuota #{data.get('cuota_plan')}", "quantity": 1, "unit_price": float(data.get('monto_total'))}],
-                    "back_urls": {"success": f"{FRONTEND_URL}/exito", "failure": FRONTEND_URL, "pending": FRONTEND_URL},
-                    "auto_return": "approved",
-                    "notification_url": f"{BACKEND_URL}/api/payment_webhook",
-                    "external_reference": json.dumps({
-                        "type": "plan_pago",
-                        "email": data.get('email'),
-                        "nombre": data.get('nombre'),
-                        "cuota": data.get('cuota_plan')
-                    }),
-                    "payer": {
-                        "name": data.get('nombre'),
-                        "email": data.get('email')
-                    }
-                }
-                preference_response = sdk.preference().create(preference_data)
-                mp_link = preference_response["response"]["init_point"]
-                mp_id = preference_response["response"]["id"]
-            except Exception as mp_err:
-                print(f"Error generando link MP Plan de Pago: {mp_err}")
-                log_to_airtable('ERROR', 'Plan de Pago', f'Error generando link MP: {mp_err}')
-
-        # 3. Guardar en Airtable
-        try:
-            plan_pago_table = api.table(BASE_ID, PLAN_PAGO_TABLE_ID)
-            record_data = {
-                "Nombre Contribuyente": data.get('nombre'),
-                "Cuota del Plan": data.get('cuota_plan'),  # Guardar como texto (ej: "1/6")
-                "Email": data.get('email'),
-                "Monto Total": float(data.get('monto_total')),
-                "Estado": "No Pagado"
-            }
-            if pdf_id:
-                record_data["PDF_ID"] = pdf_id
-            plan_pago_table.create(record_data)
-            log_to_airtable('INFO', 'Plan de Pago', f'Guardado en Airtable para {data.get("nombre")}')
-        except Exception as airtable_err:
-            log_to_airtable('WARNING', 'Plan de Pago', f'Fallo Airtable: {airtable_err}')
-
-        # 4. Enviar Email
-        email_sent = False
-        if data.get('email') and resend.api_key:
-            try:
-                from_email = os.getenv("RESEND_FROM_EMAIL", "trafulnet@geoarg.com")
-
-                html_content = f"<p>Estimado/a {data.get('nombre')},</p>"
-                html_content += f"<p>Le enviamos el comprobante para el pago de la <strong>Cuota #{data.get('cuota_plan')}</strong> de su Plan de Pago.</p>"
-
-                if mp_link:
-                    html_content += f"""
-                    <br>
-                    <p><strong>Monto a Pagar: ${data.get('monto_total')}</strong></p>
-                    <a href="{mp_link}" style="background-color: #009ee3; color: white; padding: 12px 24px; text-decoration: none; border-radius: 5px; font-weight: bold; display: inline-block;">Pagar Cuota con Mercado Pago</a>
-                    <br><br>
-                    """
-
-                html_content += "<p>Gracias por su pago.</p>"
-
-                params = {
-                    "from": from_email,
-                    "to": data.get('email'),
-                    "subject": f"Plan de Pago - Cuota #{data.get('cuota_plan')} - Comuna de Villa Traful",
-                    "html": html_content
-                }
-
-                # Solo agregar PDF si se generó exitosamente
-                if pdf_file:
-                    params["attachments"] = [{"filename": f"plan_pago_cuota_{data.get('cuota_plan')}.pdf", "content": base64.b64encode(pdf_file.getvalue()).decode('utf-8')}]
-
-                resend.Emails.send(params)
-                email_sent = True
-                log_to_airtable('INFO', 'Plan de Pago', f'Email enviado a {data.get("email")}')
-
-                # Guardar contacto en tabla Contactos
-                save_contacto(email=data.get('email'), nombre=data.get('nombre'), origen='Plan de Pago')
-            except Exception as email_error:
-                print(f"ERROR enviando email plan de pago: {email_error}")
-                log_to_airtable('ERROR', 'Plan de Pago', f'Error enviando email a {data.get("email")}: {email_error}')
+            "items": _importes_items(data),
+            "MONTO_TOTAL": total_final
+        },
+        "preference": _mp_preference("Tasas y Derechos Municipales", total_final,
+                                     {"type": "recaudacion_manual", "email": data.get('email')}, data)
+                      if float(total_final or 0) > 0 else None,
+        "record": record,
+        # Queda pendiente hasta que el webhook de MP la cruce por email y monto
+        "obligation": ("recaudacion_manual", data.get('email'), "", total_final),
+        "email_subject": "Solicitud de Pago - Comuna de Villa Traful",
+        "email_html": email_html,
+        "attachment_name": "detalle_tasas.pdf",
+        "contacto_origen": "Recaudación",
+        "message": "Recaudación registrada",
+    }
 
-        # Mensaje de respuesta según lo que funcionó
-        message = "Plan de Pago registrado"
-        if email_sent:
-            message += " y email enviado exitosamente"
-        elif data.get('email'):
-            message += " pero hubo un error al enviar el email"
+def plan_patente_manual(data):
+    total_final = data.get('total_final')
+    dominio = data.get('patente', '').upper()
+
+    items_pdf = [
+        {"description": f"Patente: {dominio}", "amount": 0}, # Informativo
+        {"description": f"Vehículo: {data.get('marca')} {data.get('modelo')} ({data.get('anio')})", "amount": 0}, # Informativo
+        {"description": "Pago de Patente Automotor", "amount": float(data.get('monto') or 0)}
+    ]
+    if data.get('descuento') and float(data.get('descuento')) > 0:
+         items_pdf.append({"description": f"Descuento ({data.get('descuento')}%)", "amount": -1 * (float(data.get('monto')) - float(data.get('total_final')))})
+    if data.get('comentarios'):
+        items_pdf.append({"description": f"Comentarios: {data.get('comentarios')}", "amount": 0})
+
+    def record(pdf_id, mp_id):
+        record_data = {
+            "Fecha": data.get('fecha'),
+            "Contribuyente": data.get('nombre'),
+            "Dominio": dominio,
+            "Vehículo": f"{data.get('marca')} {data.get('modelo')}",
+            "Año": int(data.get('anio')) if data.get('anio') else None,
+            "Email": data.get('email'),
+            "Total": float(total_final),
+            "Operador": data.get('administrativo'),
+            "Estado Pago": "Pendiente",
+            "MP Preference ID": mp_id
+        }
+        if pdf_id:
+            record_data["PDF_ID"] = pdf_id
+        if data.get('comentarios'):
+            record_data["Comentarios"] = data.get('comentarios')
+        return PATENTE_MANUAL_TABLE_ID, record_data
 
+    def email_html(mp_link):
+        html_content = f"<p>Estimado/a {data.get('nombre')},</p><p>Adjuntamos el comprobante de liquidación de patente para el dominio <strong>{dominio}</strong>.</p>"
         if mp_link:
-            message += " (link de pago generado)"
-
-        return jsonify({
-            "success": True,
-            "message": message,
-            "email_sent": email_sent,
-            "pdf_generated": pdf_file is not None,
-            "mp_link": mp_link,
-            "pdf_base64": base64.b64encode(pdf_file.getvalue()).decode('utf-8') if pdf_file else None
-        })
+            html_content += _pay_button(mp_link, "Total a Pagar", total_final, "Pagar Patente con Mercado Pago")
+        return html_content
 
-    except Exception as e:
-        log_to_airtable('ERROR', 'Plan de Pago', f'Error procesando plan de pago: {e}')
-        return jsonify({"error": str(e)}), 500
-
-FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
-BACKEND_URL = os.getenv("RENDER_EXTERNAL_URL") or os.getenv("BACKEND_URL", "http://localhost:10000")
-
-@app.route('/healthz')
-def health_check():
-    return "OK", 200
-
-# ... (código existente) ...
-
-@app.route('/api/recaudacion', methods=['POST'])
-@cross_origin()
-def registrar_recaudacion():
-    log_to_airtable('INFO', 'Recaudacion', 'Recibida nueva recaudación manual', details={'ip': request.remote_addr})
-    
-    if not api:
-        return jsonify({"error": "Error de configuración: Airtable no conectado"}), 500
-
-    try:
-        data = request.json
-        if not data:
-            return jsonify({"error": "Sin datos"}), 400
-
-        # 1. Generar PDF del recibo
-        items_pdf = []
-        notas = data.get('notas', {})
-        for key, val in data.get('importes', {}).items():
-            monto = float(val)
-            if monto > 0:
-                # Buscar label (esto es simplificado, idealmente vendría del front o map)
-                label = key.replace('_', ' ').capitalize()
-                # Agregar nota si existe
-                if notas.get(key):
-                    label += f" ({notas.get(key)})"
-                items_pdf.append({"description": label, "amount": monto})
-        
-        # Agregar descuento si existe
-        if data.get('descuento') and float(data.get('descuento')) > 0:
-             items_pdf.append({"description": f"Descuento ({data.get('descuento')}%)", "amount": -1 * (float(data.get('total')) - float(data.get('total_final')))})
-
-        pdf_details = {
+    return {
+        "pdf_details": {
             "FECHA_PAGO": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
             "ESTADO_PAGO": "Aprobado (Manual)",
-            "ID_PAGO_MP": f"MAN-{int(datetime.now().timestamp())}",
+            "ID_PAGO_MP": f"PAT-{data.get('patente')}-{int(datetime.now().timestamp())}",
             "NOMBRE_PAGADOR": data.get('nombre'),
-            "IDENTIFICADOR_PAGADOR": data.get('email'),
+            "IDENTIFICADOR_PAGADOR": data.get('patente'),
             "items": items_pdf,
-            "MONTO_TOTAL": data.get('total_final')
-        }
-
-        # Intentar generar PDF - si falla, no bloquea el flujo
-        pdf_file = None
-        pdf_id = None
-        try:
-            pdf_file, pdf_id = create_receipt_pdf(pdf_details)
-        except Exception as pdf_error:
-            print(f"ERROR generando PDF en recaudación: {pdf_error}")
-            log_to_airtable('ERROR', 'Recaudacion', f'Error generando PDF: {pdf_error}')
-        
-        # 1.5 Generar Preferencia de Pago MP
-        mp_link = None
-        mp_id = None
-        if sdk and data.get('total_final') > 0:
-            try:
-                preference_data = {
-                    "items": [{"title": "Tasas y Derechos Municipales", "quantity": 1, "unit_price": float(data.get('total_final'))}],
-                    "back_urls": {"success": f"{FRONTEND_URL}/exito", "failure": FRONTEND_URL, "pending": FRONTEND_URL},
-                    "auto_return": "approved",
-                    "notification_url": f"{BACKEND_URL}/api/payment_webhook",
-                    "external_reference": json.dumps({"type": "recaudacion_manual", "email": data.get('email')}),
-                    "payer": {
-                        "name": data.get('nombre'),
-                        "email": data.get('email')
-                    }
-                }
-                preference_response = sdk.preference().create(preference_data)
-                mp_link = preference_response["response"]["init_point"]
-                mp_id = preference_response["response"]["id"]
-            except Exception as mp_err:
-                print(f"Error generando link MP: {mp_err}")
-
-        # 2. Guardar en Airtable
-        try:
-            detalle_completo = {
-                "importes": data.get('importes'),
-                "notas": notas
-            }
-            recaudacion_table = api.table(BASE_ID, RECAUDACION_TABLE_ID)
-
-            record_data = {
-                "Fecha": data.get('fecha'),
-                "Contribuyente": data.get('nombre'),
-                "Email": data.get('email'),
-                "Total": data.get('total_final'),
-                "Detalle JSON": json.dumps(detalle_completo),
-                "Operador": data.get('administrativa'),
-                "Estado Pago": "Pendiente"
-            }
-            if pdf_id:
-                record_data["PDF_ID"] = pdf_id
-            record = recaudacion_table.create(record_data)
-            
-            # Actualizar external_reference con el ID de airtable para el webhook
-            if mp_id:
-                 # Nota: No podemos editar la preferencia ya creada fácilmente sin crear otra, 
-                 # pero confiamos en el ID de preferencia guardado en Airtable para el cruce, 
-                 # o usamos el ID de airtable en el external_reference si lo creamos antes (huevo y gallina).
-                 # Estrategia simple: El webhook buscará por ID de preferencia si no halla external_ref exacto.
-                 pass
-
-        except Exception as airtable_err:
-            print(f"Advertencia: No se pudo guardar en tabla Recaudacion ({airtable_err}). Se ignora para no bloquear flujo.")
-            log_to_airtable('WARNING', 'Recaudacion', f'Fallo al guardar en tabla Recaudacion: {airtable_err}')
-
-        # 3. Enviar Email
-        email_sent = False
-        if data.get('email') and resend.api_key:
-            try:
-                from_email = os.getenv("RESEND_FROM_EMAIL", "trafulnet@geoarg.com")
-
-                html_content = f"<p>Estimado/a {data.get('nombre')},</p><p>Adjuntamos el detalle de tasas y derechos generados el {data.get('fecha')}.</p>"
-
-                if mp_link:
-                    html_content += f"""
-                    <br>
-                    <p><strong>Total a Pagar: ${data.get('total_final')}</strong></p>
-                    <a href="{mp_link}" style="background-color: #009ee3; color: white; padding: 12px 24px; text-decoration: none; border-radius: 5px; font-weight: bold; display: inline-block;">Pagar Ahora con Mercado Pago</a>
-                    <br><br>
-                    """
-
-                html_content += "<p>Gracias por su contribución.</p>"
-
-                params = {
-                    "from": from_email,
-                    "to": data.get('email'),
-                    "subject": "Solicitud de Pago - Comuna de Villa Traful",
-                    "html": html_content
-                }
-
-                # Solo agregar PDF si se generó exitosamente
-                if pdf_file:
-                    params["attachments"] = [{"filename": "detalle_tasas.pdf", "content": base64.b64encode(pdf_file.getvalue()).decode('utf-8')}]
-
-                resend.Emails.send(params)
-                email_sent = True
-                log_to_airtable('INFO', 'Recaudacion', f'Email enviado a {data.get("email")}')
-
-                # Guardar contacto en tabla Contactos
-                save_contacto(email=data.get('email'), nombre=data.get('nombre'), origen='Recaudación')
-            except Exception as email_error:
-                print(f"ERROR enviando email: {email_error}")
-                log_to_airtable('ERROR', 'Recaudacion', f'Error enviando email a {data.get("email")}: {email_error}')
+            "MONTO_TOTAL": total_final
+        },
+        "preference": _mp_preference(f"Patente {dominio}", total_final,
+                                     {"type": "patente_manual", "email": data.get('email'), "dominio": dominio}, data)
+                      if float(total_final or 0) > 0 else None,
+        "record": record,
+        "obligation": ("patente_manual", data.get('email'), dominio, total_final),
+        "email_subject": "Solicitud de Pago Patente - Comuna de Villa Traful",
+        "email_html": email_html,
+        "record_needs_mp": True,
+        "attachment_name": f"patente_{data.get('patente')}.pdf",
+        "contacto_origen": "Patente",
+        "message": "Pago de Patente registrado",
+    }
 
-        # Mensaje de respuesta según lo que funcionó
-        message = "Recaudación registrada"
-        if email_sent:
-            message += " y email enviado exitosamente"
-        elif data.get('email'):
-            message += " pero hubo un error al enviar el email"
+def plan_plan_pago(data):
+    monto_total = data.get('monto_total')
+    cuota = data.get('cuota_plan')
+
+    def record(pdf_id, mp_id):
+        record_data = {
+            "Nombre Contribuyente": data.get('nombre'),
+            "Cuota del Plan": cuota,  # Guardar como texto (ej: "1/6")
+            "Email": data.get('email'),
+            "Monto Total": float(monto_total),
+            "Estado": "No Pagado"
+        }
+        if pdf_id:
+            record_data["PDF_ID"] = pdf_id
+        return PLAN_PAGO_TABLE_ID, record_data
 
+    def email_html(mp_link):
+        html_content = f"<p>Estimado/a {data.get('nombre')},</p>"
+        html_content += f"<p>Le enviamos el comprobante para el pago de la <strong>Cuota #{cuota}</strong> de su Plan de Pago.</p>"
         if mp_link:
-            message += " (link de pago generado)"
-
-        return jsonify({
-            "success": True,
-            "message": message,
-            "email_sent": email_sent,
-            "pdf_generated": pdf_file is not None,
-            "mp_link": mp_link,
-            "pdf_base64": base64.b64encode(pdf_file.getvalue()).decode('utf-8') if pdf_file else None
-        })
+            html_content += _pay_button(mp_link, "Monto a Pagar", monto_total, "Pagar Cuota con Mercado Pago")
+        html_content += "<p>Gracias por su pago.</p>"
+        return html_content
 
-    except Exception as e:
-        log_to_airtable('ERROR', 'Recaudacion', f'Error procesando recaudación: {e}')
-        return jsonify({"error": str(e)}), 500
+    return {
+        "pdf_details": {
+            "FECHA_PAGO": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+            "ESTADO_PAGO": "Pendiente",
+            "ID_PAGO_MP": f"PLAN-{int(datetime.now().timestamp())}",
+            "NOMBRE_PAGADOR": data.get('nombre'),
+            "IDENTIFICADOR_PAGADOR": data.get('email'),
+            "items": [{"description": f"Plan de Pago - Cuota #{cuota}", "amount": float(monto_total or 0)}],
+            "MONTO_TOTAL": monto_total
+        },
+        "preference": _mp_preference(f"Plan de Pago - Cuota #{cuota}", monto_total, {
+                          "type": "plan_pago",
+                          "email": data.get('email'),
+                          "nombre": data.get('nombre'),
+                          "cuota": cuota
+                      }, data) if float(monto_total or 0) > 0 else None,
+        "record": record,
+        "obligation": ("plan_pago", data.get('email'), cuota, monto_total),
+        "record_log": f'Guardado en Airtable para {data.get("nombre")}',
+        "email_subject": f"Plan de Pago - Cuota #{cuota} - Comuna de Villa Traful",
+        "email_html": email_html,
+        "attachment_name": f"plan_pago_cuota_{cuota}.pdf",
+        "contacto_origen": "Plan de Pago",
+        "message": "Plan de Pago registrado",
+    }
 
-@app.route('/api/recaudacion_efectivo', methods=['POST'])
-@cross_origin()
-def registrar_recaudacion_efectivo():
-    log_to_airtable('INFO', 'Recaudacion Efectivo', 'Recibida nueva recaudación en efectivo', details={'ip': request.remote_addr})
+def plan_recaudacion_efectivo(data):
+    total_final = data.get('total_final')
+    pdf_id_fallback = f"EFEC-{int(datetime.now().timestamp())}"
+
+    def record(pdf_id, mp_id):
+        return EFECTIVO_TABLE_ID, {
+            "PDF_ID": pdf_id if pdf_id else pdf_id_fallback,
+            "Fecha y Hora": datetime.now().strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "Total": float(total_final),
+            "Tipo": "Recaudación",
+            "Contribuyente": data.get('nombre'),
+            "Email": data.get('email'),
+            "Operador": data.get('administrativa')
+        }
 
-    if not api:
-        return jsonify({"error": "Error de configuración: Airtable no conectado"}), 500
+    def email_html(mp_link):
+        return f"""
+                <p>Estimado/a {data.get('nombre')},</p>
+                <p>Adjuntamos el comprobante de pago en efectivo realizado el {data.get('fecha')}.</p>
+                <p><strong>Total Pagado: ${total_final}</strong></p>
+                <p>Gracias por su contribución.</p>{EFECTIVO_FOOTER}"""
 
-    try:
-        data = request.json
-        if not data:
-            return jsonify({"error": "Sin datos"}), 400
+    return {
+        "pdf_details": {
+            "FECHA_PAGO": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+            "ESTADO_PAGO": "Pagado en Efectivo",
+            "ID_PAGO_MP": pdf_id_fallback,
+            "NOMBRE_PAGADOR": data.get('nombre'),
+            "IDENTIFICADOR_PAGADOR": data.get('email'),
+            "items": _importes_items(data),
+            "MONTO_TOTAL": total_final
+        },
+        "pdf_backend": EFECTIVO_RECEIPT_BACKEND,
+        "preference": None,
+        "record": record,
+        "record_log": f'Guardado en tabla Efectivo para {data.get("nombre")}',
+        "after_record": lambda created: record_stats(efectivo_entry(created)),
+        "email_subject": "Comprobante de Pago en Efectivo - Comuna de Villa Traful",
+        "email_html": email_html,
+        "attachment_name": "comprobante_pago_efectivo.pdf",
+        "contacto_origen": "Pago Efectivo - Recaudación",
+        "message": "Pago en efectivo registrado",
+        "email_sent_message": " y comprobante enviado por email exitosamente",
+    }
 
-        # 1. Generar PDF del recibo
-        items_pdf = []
-        notas = data.get('notas', {})
-        for key, val in data.get('importes', {}).items():
-            monto = float(val)
-            if monto > 0:
-                label = key.replace('_', ' ').capitalize()
-                if notas.get(key):
-                    label += f" ({notas.get(key)})"
-                items_pdf.append({"description": label, "amount": monto})
+def plan_patente_efectivo(data):
+    total_final = data.get('total_final')
+    dominio = data.get('patente', '').upper()
+    pdf_id_fallback = f"EFEC-PAT-{int(datetime.now().timestamp())}"
+
+    items_pdf = [
+        {"description": f"Patente {dominio}", "amount": float(data.get('monto', 0))},
+        {"description": f"{data.get('marca')} {data.get('modelo')} ({data.get('anio')})", "amount": 0}
+    ]
+    if data.get('descuento') and float(data.get('descuento')) > 0:
+        descuento_monto = float(data.get('monto', 0)) * (float(data.get('descuento')) / 100)
+        items_pdf.append({"description": f"Descuento ({data.get('descuento')}%)", "amount": -1 * descuento_monto})
+    if data.get('comentarios'):
+        items_pdf.append({"description": f"Comentarios: {data.get('comentarios')}", "amount": 0})
+
+    def record(pdf_id, mp_id):
+        record_data = {
+            "PDF_ID": pdf_id if pdf_id else pdf_id_fallback,
+            "Fecha y Hora": datetime.now().strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "Total": float(total_final),
+            "Tipo": "Patente",
+            "Contribuyente": data.get('nombre'),
+            "Email": data.get('email'),
+            "Patente": dominio,
+            "Operador": data.get('administrativo')
+        }
+        if data.get('comentarios'):
+            record_data["Comentarios"] = data.get('comentarios')
+        return EFECTIVO_TABLE_ID, record_data
 
-        if data.get('descuento') and float(data.get('descuento')) > 0:
-             items_pdf.append({"description": f"Descuento ({data.get('descuento')}%)", "amount": -1 * (float(data.get('total')) - float(data.get('total_final')))})
+    def email_html(mp_link):
+        return f"""
+                <p>Estimado/a {data.get('nombre')},</p>
+                <p>Adjuntamos el comprobante de pago en efectivo de la patente <strong>{dominio}</strong> realizado el {data.get('fecha')}.</p>
+                <p><strong>Vehículo:</strong> {data.get('marca')} {data.get('modelo')} ({data.get('anio')})</p>
+                <p><strong>Total Pagado: ${total_final}</strong></p>
+                <p>Gracias por su contribución.</p>{EFECTIVO_FOOTER}"""
 
-        pdf_details = {
+    return {
+        "pdf_details": {
             "FECHA_PAGO": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
             "ESTADO_PAGO": "Pagado en Efectivo",
-            "ID_PAGO_MP": f"EFEC-{int(datetime.now().timestamp())}",
+            "ID_PAGO_MP": pdf_id_fallback,
             "NOMBRE_PAGADOR": data.get('nombre'),
             "IDENTIFICADOR_PAGADOR": data.get('email'),
             "items": items_pdf,
-            "MONTO_TOTAL": data.get('total_final')
-        }
-
-        # Generar PDF
-        pdf_file = None
-        pdf_id = None
-        try:
-            pdf_file, pdf_id = create_receipt_pdf(pdf_details)
-        except Exception as pdf_error:
-            print(f"ERROR generando PDF en recaudación efectivo: {pdf_error}")
-            log_to_airtable('ERROR', 'Recaudacion Efectivo', f'Error generando PDF: {pdf_error}')
+            "MONTO_TOTAL": total_final
+        },
+        "pdf_backend": EFECTIVO_RECEIPT_BACKEND,
+        "preference": None,
+        "record": record,
+        "record_log": f'Guardado en tabla Efectivo para patente {data.get("patente")}',
+        "after_record": lambda created: record_stats(efectivo_entry(created)),
+        "email_subject": f"Comprobante de Pago Patente {dominio} - Comuna de Villa Traful",
+        "email_html": email_html,
+        "attachment_name": f"comprobante_patente_{data.get('patente')}.pdf",
+        "contacto_origen": "Pago Efectivo - Patente",
+        "message": "Pago en efectivo de patente registrado",
+        "email_sent_message": " y comprobante enviado por email exitosamente",
+    }
 
-        # 2. Guardar en tabla Efectivo
+# tipo -> (source de los logs, descripción para errores, armado del plan)
+COBROS = {
+    'recaudacion': ('Recaudacion', 'recaudación', plan_recaudacion),
+    'patente_manual': ('Patente Manual', 'patente', plan_patente_manual),
+    'plan_pago': ('Plan de Pago', 'plan de pago', plan_plan_pago),
+    'recaudacion_efectivo': ('Recaudacion Efectivo', 'recaudación efectivo', plan_recaudacion_efectivo),
+    'patente_efectivo': ('Patente Efectivo', 'patente efectivo', plan_patente_efectivo),
+}
+
+def _logged_step(job, name, source, error_message, fn):
+    """job.step() que además deja el error en consola y en Logs."""
+    def run():
         try:
-            efectivo_table = api.table(BASE_ID, EFECTIVO_TABLE_ID)
-            record_data = {
-                "PDF_ID": pdf_id if pdf_id else f"EFEC-{int(datetime.now().timestamp())}",
-                "Fecha y Hora": datetime.now().strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-                "Total": float(data.get('total_final')),
-                "Tipo": "Recaudación",
-                "Contribuyente": data.get('nombre'),
-                "Email": data.get('email'),
-                "Operador": data.get('administrativa')
+            return fn()
+        except Exception as e:
+            print(f"ERROR {source} - {error_message}: {e}")
+            log_to_airtable('ERROR', source, f'{error_message}: {e}')
+            raise
+    return job.step(name, run)
+
+def run_cobro(job, steps, plan=None):
+    """Ejecuta los pasos indicados de un cobro; los que ya terminaron bien no se repiten."""
+    kind, data = job.payload['kind'], job.payload['data']
+    source, _, build_plan = COBROS[kind]
+    plan = plan or build_plan(data)
+
+    # El PDF_ID se genera antes: así el registro de Airtable no espera al PDF
+    if 'pdf_id' not in job.result:
+        job.set_result('pdf_id', str(uuid.uuid4()))
+    pdf_id = job.result['pdf_id']
+
+    # PDF, preferencia de MP y registro en Airtable son independientes: corren en paralelo
+    tasks = {}
+    if 'pdf' in steps:
+        def make_pdf():
+            pdf_file, _ = create_receipt_pdf(plan['pdf_details'], pdf_id=pdf_id, backend=plan.get('pdf_backend')) or (None, None)
+            if not pdf_file:
+                raise RuntimeError("No se pudo generar el PDF")
+            # El PDF queda en el almacén de comprobantes; en este request se reusa el buffer
+            job.pdf_file = pdf_file
+            sha256 = receipt_store.etag(pdf_id)
+            if not sha256:
+                # No se pudo guardar: el PDF viaja en el job, como antes
+                job.set_result('pdf_base64', base64.b64encode(pdf_file.getvalue()).decode('utf-8'))
+            return {"pdf_id": pdf_id, "sha256": sha256}
+        tasks['pdf'] = (lambda deps: _logged_step(job, 'pdf', source, 'Error generando PDF', make_pdf), ())
+
+    if 'mp' in steps and sdk and plan.get('preference'):
+        def make_preference():
+            preference_response = sdk.preference().create(plan['preference'])
+            return {"link": preference_response["response"]["init_point"], "id": preference_response["response"]["id"]}
+        tasks['mp'] = (lambda deps: _logged_step(job, 'mp', source, 'Error generando link MP', make_preference), ())
+
+    if 'airtable' in steps:
+        def save_record():
+            table_id, record_data = plan['record'](pdf_id, job.steps.get('mp', {}).get('id'))
+            created = api.table(BASE_ID, table_id).create(record_data)
+            if plan.get('obligation'):
+                add_obligation(created['id'], *plan['obligation'])
+            if plan.get('after_record'):
+                plan['after_record'](created)
+            if plan.get('record_log'):
+                log_to_airtable('INFO', source, plan['record_log'])
+            return {"record_id": created['id']}
+
+        def airtable_step(deps):
+            outcome = job.step('airtable', save_record)
+            if not outcome['ok'] and not job.step_running('airtable'):
+                # Como antes: el cobro sigue aunque falle Airtable
+                log_to_airtable('WARNING', source, f'Fallo Airtable: {outcome["error"]}')
+            return outcome
+        # Solo patente guarda el ID de la preferencia: ahí el registro espera a MP
+        tasks['airtable'] = (airtable_step, ('mp',) if plan.get('record_needs_mp') else ())
+
+    for name, outcome in run_parallel(tasks, timeouts=COBRO_STEP_TIMEOUTS).items():
+        if outcome.get('timeout'):
+            # El paso sigue en segundo plano y queda 'running' en el job hasta terminar
+            log_to_airtable('WARNING', source, f'Paso {name} sin respuesta a tiempo: {outcome["error"]}')
+
+    if 'email' in steps and data.get('email') and resend.api_key:
+        def send_email():
+            params = {
+                "from": os.getenv("RESEND_FROM_EMAIL", "trafulnet@geoarg.com"),
+                "to": data.get('email'),
+                "subject": plan['email_subject'],
+                "html": plan['email_html'](job.steps.get('mp', {}).get('link'))
             }
-            efectivo_table.create(record_data)
-            log_to_airtable('INFO', 'Recaudacion Efectivo', f'Guardado en tabla Efectivo para {data.get("nombre")}')
-        except Exception as airtable_err:
-            print(f"Advertencia: No se pudo guardar en tabla Efectivo ({airtable_err}).")
-            log_to_airtable('WARNING', 'Recaudacion Efectivo', f'Fallo al guardar en tabla Efectivo: {airtable_err}')
-
-        # 3. Enviar Email (solo PDF, sin link de pago)
-        email_sent = False
-        if data.get('email') and resend.api_key:
-            try:
-                from_email = os.getenv("RESEND_FROM_EMAIL", "trafulnet@geoarg.com")
-
-                html_content = f"""
-                <p>Estimado/a {data.get('nombre')},</p>
-                <p>Adjuntamos el comprobante de pago en efectivo realizado el {data.get('fecha')}.</p>
-                <p><strong>Total Pagado: ${data.get('total_final')}</strong></p>
-                <p>Gracias por su contribución.</p>
-                <p style="color: #666; font-size: 12px; margin-top: 20px;">
-                    Comuna de Villa Traful - Provincia de Neuquén<br>
-                    CUIT: 30-67297005-5. Laffitte 0 . Villa Traful
-                </p>
-                """
-
-                params = {
-                    "from": from_email,
-                    "to": data.get('email'),
-                    "subject": "Comprobante de Pago en Efectivo - Comuna de Villa Traful",
-                    "html": html_content
-                }
-
-                if pdf_file:
-                    params["attachments"] = [{"filename": "comprobante_pago_efectivo.pdf", "content": base64.b64encode(pdf_file.getvalue()).decode('utf-8')}]
-
-                resend.Emails.send(params)
-                email_sent = True
-                log_to_airtable('INFO', 'Recaudacion Efectivo', f'Email enviado a {data.get("email")}')
-
-                save_contacto(email=data.get('email'), nombre=data.get('nombre'), origen='Pago Efectivo - Recaudación')
-            except Exception as email_error:
-                print(f"ERROR enviando email: {email_error}")
-                log_to_airtable('ERROR', 'Recaudacion Efectivo', f'Error enviando email: {email_error}')
-
-        message = "Pago en efectivo registrado"
-        if email_sent:
-            message += " y comprobante enviado por email exitosamente"
-        elif data.get('email'):
-            message += " pero hubo un error al enviar el email"
-
-        return jsonify({
-            "success": True,
-            "message": message,
-            "email_sent": email_sent,
-            "pdf_generated": pdf_file is not None,
-            "pdf_base64": base64.b64encode(pdf_file.getvalue()).decode('utf-8') if pdf_file else None
-        })
+            # Solo agregar PDF si se generó exitosamente
+            pdf_bytes = cobro_pdf(job, plan)
+            if pdf_bytes:
+                params["attachments"] = [{"filename": plan['attachment_name'], "content": base64.b64encode(pdf_bytes).decode('utf-8')}]
+            # Se encola una sola vez por cobro aunque el job se reintente
+            mail_id, _ = mail_queue.enqueue(params, dedupe_key=f"cobro:{job.id}")
+            log_to_airtable('INFO', source, f'Email a {data.get("email")} en cola de envío')
+            return {"queued": True, "mail_id": mail_id}
+        email = _logged_step(job, 'email', source, f'Error enviando email a {data.get("email")}', send_email)
+
+        if email['ok'] and 'contacto' in steps:
+            # Guardar contacto en tabla Contactos
+            job.step('contacto', lambda: save_contacto(email=data.get('email'), nombre=data.get('nombre'), origen=plan['contacto_origen']))
+    return plan
+
+def run_cobro_job(job):
+    # Si un paso del request sigue en curso (venció su timeout), se espera: el email lleva el PDF
+    running = [name for name in job.steps if job.step_running(name)]
+    if running:
+        raise RetryJob(f"Pasos en curso: {', '.join(running)}")
+    run_cobro(job, COBRO_ALL_STEPS)
+    if job.steps.get('email', {}).get('ok') is False:
+        raise RetryJob(job.steps['email']['error'])
+
+def cobro_pdf(job, plan):
+    """Bytes del PDF del cobro: el buffer de este request, el almacén de comprobantes o, si no está, se regenera."""
+    if not job.steps.get('pdf', {}).get('ok'):
+        return None
+    if getattr(job, 'pdf_file', None):
+        return job.pdf_file.getvalue()
+    if job.result.get('pdf_base64'):
+        return base64.b64decode(job.result['pdf_base64'])
+    stored = receipt_store.open(job.result['pdf_id'])
+    if stored:
+        with stored[1] as f:
+            return f.read()
+    pdf_file, _ = create_receipt_pdf(plan['pdf_details'], pdf_id=job.result['pdf_id'], backend=plan.get('pdf_backend')) or (None, None)
+    return pdf_file.getvalue() if pdf_file else None
+
+def receipt_download_url(pdf_id):
+    """Link firmado y con vencimiento al PDF guardado, o None si no está en el almacén."""
+    if not receipt_store.etag(pdf_id):
+        return None
+    return f"{BACKEND_URL}/api/receipt_file/{pdf_id}?{urlencode(receipt_store.sign(pdf_id))}"
+
+def cobro_response(job, plan, pdf_mode='inline'):
+    """
+    Respuesta de los endpoints de cobro y de /api/jobs/<id> (mismas claves que antes).
+    pdf_mode='url' devuelve pdf_url (link firmado) en vez de pdf_base64.
+    """
+    data = job.payload['data']
+    email = job.steps.get('email') or {}
+    # El estado de entrega lo tiene la cola de emails
+    mail = mail_queue.get(email['mail_id']) if email.get('mail_id') else None
+    email_sent = bool(email.get('sent') or (mail and mail['status'] == 'sent'))
+    email_pending = bool(data.get('email') and resend.api_key) and not email_sent and (
+        job.status in ('pending', 'queued', 'running') or bool(mail and mail['status'] in ('queued', 'sending')))
+    mp_link = job.steps.get('mp', {}).get('link')
+
+    # Mensaje de respuesta según lo que funcionó
+    message = plan['message']
+    if email_sent:
+        message += plan.get('email_sent_message', " y email enviado exitosamente")
+    elif email_pending:
+        message += " y email en cola de envío"
+    elif data.get('email'):
+        message += " pero hubo un error al enviar el email"
+    if mp_link:
+        message += " (link de pago generado)"
+
+    pdf_generated = bool(job.steps.get('pdf', {}).get('ok'))
+    response = {
+        "success": True,
+        "job_id": job.id,
+        "job_status": job.status,
+        "message": message,
+        "email_sent": email_sent,
+        "email_pending": email_pending,
+        "pdf_generated": pdf_generated,
+        "pdf_id": job.result.get('pdf_id') if pdf_generated else None,
+        "mp_link": mp_link,
+        "steps": job.steps
+    }
+    pdf_url = receipt_download_url(job.result['pdf_id']) if pdf_generated and pdf_mode == 'url' else None
+    if pdf_url:
+        response["pdf_url"] = pdf_url
+    else:
+        pdf_bytes = cobro_pdf(job, plan)
+        response["pdf_base64"] = base64.b64encode(pdf_bytes).decode('utf-8') if pdf_bytes else None
+    return response
 
-    except Exception as e:
-        log_to_airtable('ERROR', 'Recaudacion Efectivo', f'Error procesando recaudación efectivo: {e}')
-        return jsonify({"error": str(e)}), 500
+LIMIT_ARG_ERROR = "El parámetro limit debe ser un número entero"
 
-@app.route('/api/patente_efectivo', methods=['POST'])
-@cross_origin()
-def registrar_patente_efectivo():
-    log_to_airtable('INFO', 'Patente Efectivo', 'Recibido nuevo pago de patente en efectivo', details={'ip': request.remote_addr})
+def limit_arg(default, maximum):
+    """?limit= acotado entre 1 y maximum; None si no es un número entero."""
+    try:
+        return max(1, min(int(request.args.get('limit', default)), maximum))
+    except (TypeError, ValueError):
+        return None
 
+def registrar_cobro(kind):
+    source, descripcion, build_plan = COBROS[kind]
     if not api:
         return jsonify({"error": "Error de configuración: Airtable no conectado"}), 500
 
@@ -740,130 +675,283 @@ def registrar_patente_efectivo():
         if not data:
             return jsonify({"error": "Sin datos"}), 400
 
-        # 1. Generar PDF del recibo
-        items_pdf = [
-            {"description": f"Patente {data.get('patente', '').upper()}", "amount": float(data.get('monto', 0))},
-            {"description": f"{data.get('marca')} {data.get('modelo')} ({data.get('anio')})", "amount": 0}
-        ]
-
-        if data.get('descuento') and float(data.get('descuento')) > 0:
-            descuento_monto = float(data.get('monto', 0)) * (float(data.get('descuento')) / 100)
-            items_pdf.append({"description": f"Descuento ({data.get('descuento')}%)", "amount": -1 * descuento_monto})
-
-        if data.get('comentarios'):
-            items_pdf.append({"description": f"Comentarios: {data.get('comentarios')}", "amount": 0})
-
-        pdf_details = {
-            "FECHA_PAGO": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-            "ESTADO_PAGO": "Pagado en Efectivo",
-            "ID_PAGO_MP": f"EFEC-PAT-{int(datetime.now().timestamp())}",
-            "NOMBRE_PAGADOR": data.get('nombre'),
-            "IDENTIFICADOR_PAGADOR": data.get('email'),
-            "items": items_pdf,
-            "MONTO_TOTAL": data.get('total_final')
-        }
+        # El plan se arma antes de guardar el pedido: datos inválidos cortan acá
+        plan = build_plan(data)
+        job = job_queue.create('cobro', {'kind': kind, 'data': data})
+
+        if data.get('async') or request.args.get('async') == '1':
+            job.enqueue()
+            return jsonify({
+                "success": True,
+                "job_id": job.id,
+                "status_url": f"{BACKEND_URL}/api/jobs/{job.id}",
+                "message": f"{plan['message']} (procesando en segundo plano)"
+            }), 202
+
+        run_cobro(job, COBRO_INLINE_STEPS, plan)
+        job.enqueue()  # Email y contacto quedan para los workers
+        # pdf_mode 'url': link firmado al PDF en vez del PDF en base64 dentro del JSON
+        pdf_mode = data.get('pdf_mode') or request.args.get('pdf_mode', 'inline')
+        return jsonify(cobro_response(job, plan, pdf_mode))
 
-        # Generar PDF
-        pdf_file = None
-        pdf_id = None
-        try:
-            pdf_file, pdf_id = create_receipt_pdf(pdf_details)
-        except Exception as pdf_error:
-            print(f"ERROR generando PDF en patente efectivo: {pdf_error}")
-            log_to_airtable('ERROR', 'Patente Efectivo', f'Error generando PDF: {pdf_error}')
+    except Exception as e:
+        log_to_airtable('ERROR', source, f'Error procesando {descripcion}: {e}')
+        return jsonify({"error": str(e)}), 500
 
-        # 2. Guardar en tabla Efectivo
-        try:
-            efectivo_table = api.table(BASE_ID, EFECTIVO_TABLE_ID)
-            record_data = {
-                "PDF_ID": pdf_id if pdf_id else f"EFEC-PAT-{int(datetime.now().timestamp())}",
-                "Fecha y Hora": datetime.now().strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-                "Total": float(data.get('total_final')),
-                "Tipo": "Patente",
-                "Contribuyente": data.get('nombre'),
-                "Email": data.get('email'),
-                "Patente": data.get('patente', '').upper(),
-                "Operador": data.get('administrativo')
-            }
-            if data.get('comentarios'):
-                record_data["Comentarios"] = data.get('comentarios')
-            efectivo_table.create(record_data)
-            log_to_airtable('INFO', 'Patente Efectivo', f'Guardado en tabla Efectivo para patente {data.get("patente")}')
-        except Exception as airtable_err:
-            print(f"Advertencia: No se pudo guardar en tabla Efectivo ({airtable_err}).")
-            log_to_airtable('WARNING', 'Patente Efectivo', f'Fallo al guardar en tabla Efectivo: {airtable_err}')
-
-        # 3. Enviar Email (solo PDF, sin link de pago)
-        email_sent = False
-        if data.get('email') and resend.api_key:
-            try:
-                from_email = os.getenv("RESEND_FROM_EMAIL", "trafulnet@geoarg.com")
-
-                html_content = f"""
-                <p>Estimado/a {data.get('nombre')},</p>
-                <p>Adjuntamos el comprobante de pago en efectivo de la patente <strong>{data.get('patente', '').upper()}</strong> realizado el {data.get('fecha')}.</p>
-                <p><strong>Vehículo:</strong> {data.get('marca')} {data.get('modelo')} ({data.get('anio')})</p>
-                <p><strong>Total Pagado: ${data.get('total_final')}</strong></p>
-                <p>Gracias por su contribución.</p>
-                <p style="color: #666; font-size: 12px; margin-top: 20px;">
-                    Comuna de Villa Traful - Provincia de Neuquén<br>
-                    CUIT: 30-67297005-5. Laffitte 0 . Villa Traful
-                </p>
-                """
+@bp.route('/api/patente_manual', methods=['POST'])
+@cross_origin()
+def registrar_patente_manual():
+    log_to_airtable('INFO', 'Patente Manual', 'Recibido nuevo pago de patente manual', details={'ip': request.remote_addr})
+    return registrar_cobro('patente_manual')
 
-                params = {
-                    "from": from_email,
-                    "to": data.get('email'),
-                    "subject": f"Comprobante de Pago Patente {data.get('patente', '').upper()} - Comuna de Villa Traful",
-                    "html": html_content
-                }
+@bp.route('/api/plan_pago', methods=['POST'])
+@cross_origin()
+def registrar_plan_pago():
+    log_to_airtable('INFO', 'Plan de Pago', 'Recibido nuevo plan de pago', details={'ip': request.remote_addr})
+    return registrar_cobro('plan_pago')
 
-                if pdf_file:
-                    params["attachments"] = [{"filename": f"comprobante_patente_{data.get('patente')}.pdf", "content": base64.b64encode(pdf_file.getvalue()).decode('utf-8')}]
+FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
+BACKEND_URL = os.getenv("RENDER_EXTERNAL_URL") or os.getenv("BACKEND_URL", "http://localhost:10000")
 
-                resend.Emails.send(params)
-                email_sent = True
-                log_to_airtable('INFO', 'Patente Efectivo', f'Email enviado a {data.get("email")}')
+@bp.route('/healthz')
+def health_check():
+    return "OK", 200
 
-                save_contacto(email=data.get('email'), nombre=data.get('nombre'), origen='Pago Efectivo - Patente')
-            except Exception as email_error:
-                print(f"ERROR enviando email: {email_error}")
-                log_to_airtable('ERROR', 'Patente Efectivo', f'Error enviando email: {email_error}')
+# ... (código existente) ...
 
-        message = "Pago en efectivo de patente registrado"
-        if email_sent:
-            message += " y comprobante enviado por email exitosamente"
-        elif data.get('email'):
-            message += " pero hubo un error al enviar el email"
+@bp.route('/api/recaudacion', methods=['POST'])
+@cross_origin()
+def registrar_recaudacion():
+    log_to_airtable('INFO', 'Recaudacion', 'Recibida nueva recaudación manual', details={'ip': request.remote_addr})
+    return registrar_cobro('recaudacion')
 
-        return jsonify({
-            "success": True,
-            "message": message,
-            "email_sent": email_sent,
-            "pdf_generated": pdf_file is not None,
-            "pdf_base64": base64.b64encode(pdf_file.getvalue()).decode('utf-8') if pdf_file else None
-        })
+@bp.route('/api/recaudacion_efectivo', methods=['POST'])
+@cross_origin()
+def registrar_recaudacion_efectivo():
+    log_to_airtable('INFO', 'Recaudacion Efectivo', 'Recibida nueva recaudación en efectivo', details={'ip': request.remote_addr})
+    return registrar_cobro('recaudacion_efectivo')
 
-    except Exception as e:
-        log_to_airtable('ERROR', 'Patente Efectivo', f'Error procesando patente efectivo: {e}')
-        return jsonify({"error": str(e)}), 500
+@bp.route('/api/patente_efectivo', methods=['POST'])
+@cross_origin()
+def registrar_patente_efectivo():
+    log_to_airtable('INFO', 'Patente Efectivo', 'Recibido nuevo pago de patente en efectivo', details={'ip': request.remote_addr})
+    return registrar_cobro('patente_efectivo')
 
 # Inicializar las SDKs de forma segura
+gateway = None
 api = None
 try:
     if AIRTABLE_PAT_FROM_ENV:
-        api = Api(AIRTABLE_PAT_FROM_ENV)
+        # Todo el acceso a Airtable pasa por el gateway (rate limit compartido entre workers)
+        gateway = AirtableGateway(AIRTABLE_PAT_FROM_ENV)
+        api = gateway.api
         print("SDK de Airtable inicializada con éxito.")
     else:
         print("ADVERTENCIA: AIRTABLE_PAT no disponible, SDK de Airtable NO inicializada.")
 except Exception as e:
     print(f"ERROR: Falló la inicialización de la SDK de Airtable: {e}")
+    gateway = None
     api = None
 
+# Espejo local en SQLite de la base (opcional, AIRTABLE_MIRROR=1)
+mirror = None
+if api and AIRTABLE_MIRROR_ENABLED:
+    try:
+        mirror = AirtableMirror(api, BASE_ID, TABLE_IDS)
+        print("Espejo local de Airtable habilitado.")
+    except Exception as e:
+        print(f"ERROR: No se pudo abrir el espejo local de Airtable: {e}")
+
+_background_workers_lock = threading.Lock()
+_background_workers_pid = None
+
+@bp.before_app_request
+def start_background_workers():
+    # Los threads se arrancan en cada worker ya forkeado, no en el master de gunicorn.
+    # Con workers gthread llegan varios requests a la vez: se arrancan una sola vez por proceso
+    global _background_workers_pid
+    if _background_workers_pid == os.getpid():
+        return
+    with _background_workers_lock:
+        if _background_workers_pid == os.getpid():
+            return
+        _start_background_workers()
+        _background_workers_pid = os.getpid()
+
+def _start_background_workers():
+    if mirror:
+        mirror.start_periodic_sync()
+    pdf_pool.start()
+    if api:
+        stats_rollup.start_periodic_rebuild(fetch_records)
+        job_queue.start_workers()
+    if api and sdk:
+        webhook_queue.start_workers()
+        mp_catchup.start_periodic()
+    if resend.api_key:
+        mail_queue.start_workers()
+    if api:
+        historial_journal.start_periodic_replay(create_historial, find_historial_by_pdf_id)
+
+def load_table_records(table_id):
+    """Todos los records de una tabla: del espejo local si está sincronizado, si no de Airtable."""
+    if mirror and mirror.is_ready(table_id):
+        # Lo mantienen al día el thread de sincronización y el webhook: la lectura no va a Airtable
+        return mirror.records(table_id)
+    return api.table(BASE_ID, table_id).all()
+
+def fetch_records(table_id, formula=None):
+    return api.table(BASE_ID, table_id).all(formula=formula)
+
+# Logs a Airtable en segundo plano, en lotes de 10
+log_shipper = LogShipper(lambda records: api.table(BASE_ID, LOGS_TABLE_ID).batch_create(records))
+
+# Pagos aprobados en MP sin webhook procesado: se cruzan con Historial y van a la cola de webhooks
+mp_catchup = PaymentCatchUp(
+    lambda begin, end: search_approved(sdk, begin, end),
+    lambda begin: [r['fields'].get('MP_Payment_ID') for r in
+                   api.table(BASE_ID, HISTORIAL_TABLE_ID).all(formula=historial_formula(begin), fields=['MP_Payment_ID'])],
+    lambda payment_id, source: webhook_queue.enqueue(payment_id, source=source),
+)
+
+# Contactos: upsert por Email en segundo plano, con índice local email -> record id
+contact_store = ContactStore(
+    lambda records: api.table(BASE_ID, CONTACTOS_TABLE_ID).batch_upsert(records, key_fields=['Email']),
+    lambda: load_table_records(CONTACTOS_TABLE_ID),
+    on_flush=lambda created, updated: log_to_airtable('INFO', 'Contactos', f'Contactos guardados: {created} nuevos, {updated} actualizados'),
+    on_reject=lambda email, error: log_to_airtable('ERROR', 'Contactos', f'Airtable rechazó el contacto {email}, queda apartado: {error}', related_id=email)
+)
+
+# Jobs en segundo plano (efectos secundarios de los cobros)
+job_queue = JobQueue()
+job_queue.register('cobro', run_cobro_job)
+
+# Obligaciones manuales pendientes, para cruzar los pagos de MP sin buscar en Airtable
+obligation_index = ObligationIndex()
+
+# Journal local de los registros de Historial que escribe process_payment
+historial_journal = HistorialJournal()
+
+# Comprobantes PDF ya generados (por contenido, clave PDF_ID)
+receipt_store = ReceiptStore()
+
+def store_receipt(pdf_id, pdf_file, aliases=()):
+    """Guarda el PDF generado; un error acá nunca debe frenar el comprobante."""
+    try:
+        return receipt_store.put(pdf_id, pdf_file.getvalue(), aliases=aliases)
+    except Exception as e:
+        print(f"ERROR guardando comprobante {pdf_id}: {e}")
+
+# Cola persistente de notificaciones de pago de Mercado Pago
+webhook_queue = WebhookQueue(
+    lambda payment_id, previous: handle_mp_payment(payment_id, previous),
+    on_dead=lambda payment_id, error: log_to_airtable(
+        'ERROR', 'Mercado Pago Webhook', f'Pago {payment_id} sin procesar tras agotar los reintentos: {error}',
+        related_id=payment_id, details={'error_message': str(error), 'payment_id': payment_id})
+)
+
+def sync_mail_status(mail):
+    """Lleva el estado de entrega de un email a su registro (ref 'historial:<PDF_ID>' -> Comprobante_Status)."""
+    kind, _, key = (mail['ref'] or '').partition(':')
+    if kind != 'historial' or not api:
+        return
+    record = find_historial_by_pdf_id(key)
+    if not record:
+        # process_payment todavía no escribió el registro: la cola reintenta más tarde
+        raise RuntimeError(f"Historial con PDF_ID {key} todavía no existe")
+    if mail['status'] == 'sent':
+        status = f"Enviado a {mail['to']}"
+    else:
+        status = f"Error email: {(mail['last_error'] or '')[:100]}"
+    api.table(BASE_ID, HISTORIAL_TABLE_ID).update(record['id'], {'Comprobante_Status': status})
+
+# Cola persistente de emails salientes (batch de Resend, reintentos, circuit breaker)
+mail_queue = MailQueue(
+    on_status=sync_mail_status,
+    on_dead=lambda mail, error: log_to_airtable(
+        'ERROR', 'Email Service', f'Email a {mail["to"]} sin enviar tras agotar los reintentos: {error}',
+        details={'mail_id': mail['id'], 'ref': mail['ref'], 'error_message': str(error)})
+)
+
+# Totales precalculados de /api/admin/stats
+stats_rollup = StatsRollup()
+
+def record_stats(entry):
+    """Suma un pago a las estadísticas; un error acá nunca debe frenar el pago."""
+    try:
+        stats_rollup.record(*entry)
+    except Exception as e:
+        print(f"ERROR actualizando estadísticas para {entry[0]}: {e}")
+
+# Paginación por cursor de los listados de administración
+paginator = Paginator(api, BASE_ID, mirror=mirror) if api else None
+
+# Cache en memoria de las tablas del padrón que consultan los buscadores
+padron_cache = PadronCache()
+
+def _register_padron_table(table_id, name):
+    padron_cache.register(
+        table_id, name,
+        loader=lambda: load_table_records(table_id),
+        record_loader=lambda record_id: api.table(BASE_ID, table_id).get(record_id)
+    )
+
+for _table_id, _name in [(CONTRIBUTIVOS_TABLE_ID, 'Contributivos'), (WATER_TABLE_ID, 'Agua'),
+                         (PATENTE_TABLE_ID, 'Patente'), (DEUDAS_TABLE_ID, 'Deudas')]:
+    _register_padron_table(_table_id, _name)
+
+def cached_records(table_id):
+    """Records de la cache del padrón, o None si todavía no cargó (usar Airtable directo)."""
+    if not api:
+        return None
+    return padron_cache.records(table_id)
+
+def dni_contribuyente_formula(query):
+    """Fórmula de Airtable para buscar por DNI o contribuyente (cuando la cache no está lista)."""
+    lower_query = query.lower()
+    search_terms = lower_query.split() # Dividir la consulta en palabras individuales
+
+    conditions_for_dni = []
+    conditions_for_contribuyente = []
+
+    for term in search_terms:
+        conditions_for_dni.append(SEARCH(term, LOWER(Field('dni'))))
+        conditions_for_contribuyente.append(SEARCH(term, LOWER(Field('contribuyente'))))
+
+    # Construir la fórmula combinando las condiciones
+    # Si hay múltiples términos, buscamos que todas las palabras estén en DNI O todas las palabras estén en Contribuyente
+    # Si hay un solo término, buscamos ese término en DNI O en Contribuyente
+    if len(search_terms) > 1:
+        formula_obj = OR(
+            AND(*conditions_for_dni),
+            AND(*conditions_for_contribuyente)
+        )
+    else: # Un solo término de búsqueda
+        formula_obj = OR(
+            SEARCH(lower_query, LOWER(Field('dni'))),
+            SEARCH(lower_query, LOWER(Field('contribuyente')))
+        )
+
+    return str(formula_obj) # Convertir el objeto Formula a string
+
+# Índices por DNI / contribuyente, reconstruidos cada vez que la cache recarga la tabla
+dni_name_indexes = {}
+for _table_id in (CONTRIBUTIVOS_TABLE_ID, WATER_TABLE_ID):
+    dni_name_indexes[_table_id] = DniNameIndex()
+    padron_cache.tables[_table_id].add_listener(dni_name_indexes[_table_id].listener)
+
+# Typeahead de deudas: prefijos rankeados sobre "nombre y apellido"
+SUGGESTIONS_DEFAULT_LIMIT = 10
+SUGGESTIONS_MAX_LIMIT = 50
+
+deudas_prefix_index = PrefixIndex('nombre y apellido')
+padron_cache.tables[DEUDAS_TABLE_ID].add_listener(deudas_prefix_index.listener)
+
 try:
     MERCADOPAGO_ACCESS_TOKEN = os.getenv("MERCADOPAGO_ACCESS_TOKEN", "APP_USR-4503490593720184-011614-66692f938236762e3d1709ccc0c94f66-2533057250")
     if MERCADOPAGO_ACCESS_TOKEN:
-        sdk = mercadopago.SDK(MERCADOPAGO_ACCESS_TOKEN)
+        # MP_API_URL: servidor local para pruebas. La SDK (y mercadopago) se carga en el primer uso
+        sdk = lazy_object(lambda: mp_sdk(MERCADOPAGO_ACCESS_TOKEN))
         print("SDK de Mercado Pago inicializada con éxito (Producción).")
     else:
         print("ADVERTENCIA: MERCADOPAGO_ACCESS_TOKEN no disponible.")
@@ -877,56 +965,19 @@ try:
         print("API Key de Resend configurada.")
     else:
         print("ADVERTENCIA: RESEND_API_KEY no disponible, Resend NO configurado.")
+    if os.getenv("RESEND_API_URL"):
+        # Para pruebas: un servidor HTTP local en lugar de la API de Resend
+        resend.api_url = os.getenv("RESEND_API_URL")
 except Exception as e:
     print(f"ERROR: Falló la configuración de Resend: {e}")
 
 
 # --- Funciones Auxiliares de PDF y Email ---
-def create_receipt_pdf(payment_details, pdf_id=None):
+def create_receipt_pdf(payment_details, pdf_id=None, backend=None):
     try:
-        # Generar ID único para este PDF si no se proporciona uno
-        if not pdf_id:
-            pdf_id = str(uuid.uuid4())
-        print(f"DEBUG PDF: Generado ID único para PDF: {pdf_id}")
-        print(f"DEBUG PDF: Iniciando generación de PDF con datos: {payment_details}")
-
-        # Usar ruta absoluta para encontrar el template
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        template_path = os.path.join(base_dir, 'comprobante_template.html')
-        print(f"DEBUG PDF: Buscando template en: {template_path}")
-
-        # Verificar si el archivo existe
-        if not os.path.exists(template_path):
-            print(f"ERROR PDF: El archivo template NO existe en {template_path}")
-            print(f"DEBUG PDF: Archivos en directorio: {os.listdir(base_dir)}")
-            return None
-
-        with open(template_path, 'r', encoding='utf-8') as f:
-            html_template = f.read()
-        print(f"DEBUG PDF: Template HTML leído correctamente, longitud: {len(html_template)}")
-
-        items_html = ""
-        for item in payment_details.get("items", []):
-            items_html += f"<tr><td>{item.get('description', '')}</td><td style='text-align: right;'>${item.get('amount', 0)}</td></tr>"
-        print(f"DEBUG PDF: Items HTML generados: {items_html}")
-
-        html_filled = html_template.replace("{{PDF_ID}}", pdf_id)
-        html_filled = html_filled.replace("{{FECHA_PAGO}}", payment_details.get("FECHA_PAGO", datetime.now().strftime("%d/%m/%Y %H:%M:%S")))
-        html_filled = html_filled.replace("{{ESTADO_PAGO}}", payment_details.get("ESTADO_PAGO", "N/A"))
-        html_filled = html_filled.replace("{{ID_PAGO_MP}}", str(payment_details.get("ID_PAGO_MP", "N/A")))
-        html_filled = html_filled.replace("{{NOMBRE_PAGADOR}}", str(payment_details.get("NOMBRE_PAGADOR", "N/A")))
-        html_filled = html_filled.replace("{{IDENTIFICADOR_PAGADOR}}", str(payment_details.get("IDENTIFICADOR_PAGADOR", "N/A")))
-        html_filled = html_filled.replace("{{ITEMS_PAGADOS}}", items_html)
-        html_filled = html_filled.replace("{{MONTO_TOTAL}}", str(payment_details.get("MONTO_TOTAL", 0)))
-        print(f"DEBUG PDF: HTML completado, longitud: {len(html_filled)}")
-
-        print(f"DEBUG PDF: Iniciando generación con WeasyPrint...")
-        pdf_file = io.BytesIO()
-        # Usar método write_pdf sin argumentos adicionales para evitar conflictos
-        html_doc = HTML(string=html_filled)
-        html_doc.write_pdf(target=pdf_file)
-        pdf_file.seek(0)
-        print(f"DEBUG PDF: PDF generado exitosamente, tamaño: {len(pdf_file.getvalue())} bytes")
+        # WeasyPrint corre en el pool de procesos; backend='native' lo escribe directo con pydyf
+        pdf_file, pdf_id = pdf_pool.render(payment_details, pdf_id=pdf_id, backend=backend)
+        store_receipt(pdf_id, pdf_file)
         return pdf_file, pdf_id
     except Exception as e:
         import traceback
@@ -941,7 +992,6 @@ def log_to_airtable(level, source, message, related_id=None, details=None):
         return
 
     try:
-        logs_table = api.table(BASE_ID, LOGS_TABLE_ID)
         log_entry = {
             'Level': level,
             'Source': source,
@@ -952,65 +1002,28 @@ def log_to_airtable(level, source, message, related_id=None, details=None):
         if details:
             log_entry['Details'] = json.dumps(details) # Store details as JSON string
 
-        logs_table.create(log_entry)
-        # print(f"Log exitoso en Airtable: [{level}] {source}: {message}")
+        # Solo se encola: el envío a Airtable lo hace el thread de log_shipper
+        log_shipper.enqueue(log_entry)
     except Exception as e:
         print(f"ERROR: Falló la escritura de log en Airtable: {e} - Mensaje original: {message}")
 
 def save_contacto(email, nombre=None, origen=None):
     """
-    Guarda o actualiza un contacto en la tabla Contactos de Airtable
-    - Si el email ya existe: actualiza Ultima Actividad y Origen
-    - Si no existe: crea un nuevo registro
+    Registra actividad de un contacto de la tabla Contactos de Airtable.
+    Solo se encola: el thread de contact_store lo envía con batch_upsert por Email
+    (nuevo contacto si no existe; si existe, Ultima Actividad, Origen y Nombre si estaba vacío).
     """
     if not api or not email:
         return
 
     try:
-        contactos_table = api.table(BASE_ID, CONTACTOS_TABLE_ID)
-        from pyairtable.formulas import match
-
-        # Buscar si el contacto ya existe
-        existing = contactos_table.all(formula=match({"Email": email}))
-
-        now = datetime.now().isoformat()
-
-        if existing:
-            # Actualizar contacto existente
-            record = existing[0]
-            update_fields = {"Ultima Actividad": now}
-
-            # Actualizar nombre si se proporciona y está vacío
-            if nombre and not record['fields'].get('Nombre'):
-                update_fields['Nombre'] = nombre
-
-            # Actualizar origen si se proporciona y es diferente
-            if origen and record['fields'].get('Origen') != origen:
-                update_fields['Origen'] = origen
-
-            contactos_table.update(record['id'], update_fields)
-            log_to_airtable('INFO', 'Contactos', f'Actualizado contacto: {email}')
-        else:
-            # Crear nuevo contacto
-            new_contact = {
-                "Email": email,
-                "Fecha Registro": now,
-                "Ultima Actividad": now
-            }
-            if nombre:
-                new_contact['Nombre'] = nombre
-            if origen:
-                new_contact['Origen'] = origen
-
-            contactos_table.create(new_contact)
-            log_to_airtable('INFO', 'Contactos', f'Nuevo contacto registrado: {email}')
-
+        contact_store.save(email, nombre=nombre, origen=origen)
     except Exception as e:
         print(f"ERROR guardando contacto {email}: {e}")
         log_to_airtable('ERROR', 'Contactos', f'Error guardando contacto {email}: {e}')
 
 # --- Endpoints ---
-@app.route('/api/search/patente', methods=['GET'])
+@bp.route('/api/search/patente', methods=['GET'])
 def search_patente():
     log_to_airtable('INFO', 'API Search', 'Recibida petición en /api/search/patente', details={'ip_address': request.remote_addr, 'dni_param': request.args.get('dni')})
     if not api:
@@ -1021,15 +1034,19 @@ def search_patente():
         log_to_airtable('WARNING', 'API Search', 'Parámetro DNI requerido para búsqueda de patente.', details={'ip_address': request.remote_addr})
         return jsonify({"error": "El parámetro DNI es requerido"}), 400
     try:
-        table = api.table(BASE_ID, PATENTE_TABLE_ID)
-        records = table.all(formula=match({"dni": dni}))
+        records = cached_records(PATENTE_TABLE_ID)
+        if records is not None:
+            records = [r for r in records if field_text(r['fields'].get('dni')) == dni.lower()]
+        else:
+            table = api.table(BASE_ID, PATENTE_TABLE_ID)
+            records = table.all(formula=match({"dni": dni}))
         log_to_airtable('INFO', 'API Search', f'Búsqueda de patente exitosa para DNI {dni}. Encontrados {len(records)} registros.', related_id=dni, details={'records_found': len(records)})
         return jsonify(records)
     except Exception as e:
         log_to_airtable('ERROR', 'API Search', f'ERROR en search_patente: {e}', related_id=dni, details={'error_message': str(e)})
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/search/contributivo', methods=['GET'])
+@bp.route('/api/search/contributivo', methods=['GET'])
 def search_contributivo():
     log_to_airtable('INFO', 'API Search', 'Recibida petición en /api/search/contributivo', details={'ip_address': request.remote_addr, 'query_param': request.args.get('query')})
     if not api: 
@@ -1042,34 +1059,12 @@ def search_contributivo():
         return jsonify({"error": "El parámetro 'query' es requerido para la búsqueda"}), 400
     
     try:
-        table = api.table(BASE_ID, CONTRIBUTIVOS_TABLE_ID)
-        
-        lower_query = query.lower()
-        search_terms = lower_query.split() # Dividir la consulta en palabras individuales
-
-        conditions_for_dni = []
-        conditions_for_contribuyente = []
-
-        for term in search_terms:
-            conditions_for_dni.append(SEARCH(term, LOWER(Field('dni'))))
-            conditions_for_contribuyente.append(SEARCH(term, LOWER(Field('contribuyente'))))
-        
-        # Construir la fórmula combinando las condiciones
-        # Si hay múltiples términos, buscamos que todas las palabras estén en DNI O todas las palabras estén en Contribuyente
-        # Si hay un solo término, buscamos ese término en DNI O en Contribuyente
-        if len(search_terms) > 1:
-            formula_obj = OR(
-                AND(*conditions_for_dni),
-                AND(*conditions_for_contribuyente)
-            )
-        else: # Un solo término de búsqueda
-            formula_obj = OR(
-                SEARCH(lower_query, LOWER(Field('dni'))),
-                SEARCH(lower_query, LOWER(Field('contribuyente')))
-            )
-        
-        formula_str = str(formula_obj) # Convertir el objeto Formula a string
-        records = table.all(formula=formula_str)
+        records = cached_records(CONTRIBUTIVOS_TABLE_ID)
+        if records is not None and dni_name_indexes[CONTRIBUTIVOS_TABLE_ID].ready:
+            records = dni_name_indexes[CONTRIBUTIVOS_TABLE_ID].search(query)
+        else:
+            table = api.table(BASE_ID, CONTRIBUTIVOS_TABLE_ID)
+            records = table.all(formula=dni_contribuyente_formula(query))
 
         log_to_airtable('INFO', 'API Search', f'Búsqueda de contributivo exitosa para "{query}". Encontrados {len(records)} registros.', related_id=query, details={'records_found': len(records)})
         return jsonify(records)
@@ -1078,7 +1073,7 @@ def search_contributivo():
         print(f"ERROR: Excepción en search_contributivo: {e}") # Debugging
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/search/agua', methods=['GET'])
+@bp.route('/api/search/agua', methods=['GET'])
 def search_agua():
     log_to_airtable('INFO', 'API Search', 'Recibida petición en /api/search/agua', details={'ip_address': request.remote_addr, 'query_param': request.args.get('query')})
     if not api: 
@@ -1091,31 +1086,12 @@ def search_agua():
         return jsonify({"error": "El parámetro 'query' es requerido para la búsqueda"}), 400
     
     try:
-        table = api.table(BASE_ID, WATER_TABLE_ID) # Usar la nueva tabla de Agua
-        
-        lower_query = query.lower()
-        search_terms = lower_query.split()
-
-        conditions_for_dni = []
-        conditions_for_contribuyente = []
-
-        for term in search_terms:
-            conditions_for_dni.append(SEARCH(term, LOWER(Field('dni'))))
-            conditions_for_contribuyente.append(SEARCH(term, LOWER(Field('contribuyente'))))
-        
-        if len(search_terms) > 1:
-            formula_obj = OR(
-                AND(*conditions_for_dni),
-                AND(*conditions_for_contribuyente)
-            )
-        else: # Un solo término de búsqueda
-            formula_obj = OR(
-                SEARCH(lower_query, LOWER(Field('dni'))),
-                SEARCH(lower_query, LOWER(Field('contribuyente')))
-            )
-        
-        formula_str = str(formula_obj) # Convertir el objeto Formula a string
-        records = table.all(formula=formula_str)
+        records = cached_records(WATER_TABLE_ID)
+        if records is not None and dni_name_indexes[WATER_TABLE_ID].ready:
+            records = dni_name_indexes[WATER_TABLE_ID].search(query)
+        else:
+            table = api.table(BASE_ID, WATER_TABLE_ID) # Usar la nueva tabla de Agua
+            records = table.all(formula=dni_contribuyente_formula(query))
 
         log_to_airtable('INFO', 'API Search', f'Búsqueda de agua exitosa para "{query}". Encontrados {len(records)} registros.', related_id=query, details={'records_found': len(records)})
         return jsonify(records)
@@ -1124,7 +1100,7 @@ def search_agua():
         print(f"ERROR: Excepción en search_agua: {e}") # Debugging
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/search/deuda', methods=['GET'])
+@bp.route('/api/search/deuda', methods=['GET'])
 def search_deuda():
     log_to_airtable('INFO', 'API Search', 'Recibida petición en /api/search/deuda', details={'ip_address': request.remote_addr, 'nombre_param': request.args.get('nombre')})
     if not api: return jsonify({"error": "La configuración del servidor para Airtable es incorrecta."}), 500
@@ -1133,15 +1109,19 @@ def search_deuda():
         log_to_airtable('WARNING', 'API Search', 'Parámetro nombre requerido para búsqueda de deuda.', details={'ip_address': request.remote_addr})
         return jsonify({"error": "El parámetro 'nombre' es requerido"}), 400
     try:
-        table = api.table(BASE_ID, DEUDAS_TABLE_ID)
-        records = table.all(formula=f"SEARCH('{nombre.lower()}', LOWER({{nombre y apellido}}))")
+        records = cached_records(DEUDAS_TABLE_ID)
+        if records is not None:
+            records = [r for r in records if nombre.lower() in field_text(r['fields'].get('nombre y apellido'))]
+        else:
+            table = api.table(BASE_ID, DEUDAS_TABLE_ID)
+            records = table.all(formula=f"SEARCH('{nombre.lower()}', LOWER({{nombre y apellido}}))")
         log_to_airtable('INFO', 'API Search', f'Búsqueda de deuda exitosa para {nombre}. Encontrados {len(records)} registros.', related_id=nombre, details={'records_found': len(records)})
         return jsonify(records)
     except Exception as e:
         log_to_airtable('ERROR', 'API Search', f'ERROR en search_deuda: {e}', related_id=nombre, details={'error_message': str(e)})
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/search/deuda_suggestions', methods=['GET'])
+@bp.route('/api/search/deuda_suggestions', methods=['GET'])
 def search_deuda_suggestions():
     log_to_airtable('INFO', 'API Search', 'Recibida petición en /api/search/deuda_suggestions', details={'ip_address': request.remote_addr, 'query_param': request.args.get('query')})
     if not api: return jsonify({"error": "La configuración del servidor para Airtable es incorrecta."}), 500
@@ -1149,9 +1129,16 @@ def search_deuda_suggestions():
     if not query: 
         log_to_airtable('INFO', 'API Search', 'Sin query para sugerencias de deuda.', details={'ip_address': request.remote_addr})
         return jsonify([]) # Return empty list if no query
+    limit = limit_arg(SUGGESTIONS_DEFAULT_LIMIT, SUGGESTIONS_MAX_LIMIT)
+    if limit is None:
+        return jsonify({"error": LIMIT_ARG_ERROR}), 400
     try:
-        table = api.table(BASE_ID, DEUDAS_TABLE_ID)
-        records = table.all(formula=f"SEARCH('{query.lower()}', LOWER({{nombre y apellido}}))")
+        records = cached_records(DEUDAS_TABLE_ID)
+        if records is not None and deudas_prefix_index.ready:
+            records = deudas_prefix_index.search(query, limit=limit)
+        else:
+            table = api.table(BASE_ID, DEUDAS_TABLE_ID)
+            records = table.all(formula=f"SEARCH('{query.lower()}', LOWER({{nombre y apellido}}))", max_records=limit)
         suggestions = []
         for record in records:
             suggestions.append({
@@ -1165,7 +1152,7 @@ def search_deuda_suggestions():
         log_to_airtable('ERROR', 'API Search', f'ERROR en search_deuda_suggestions: {e}', related_id=query, details={'error_message': str(e)})
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/create_preference', methods=['POST'])
+@bp.route('/api/create_preference', methods=['POST'])
 def create_preference():
     log_to_airtable('INFO', 'Mercado Pago', 'Recibida petición en /api/create_preference', details={'ip_address': request.remote_addr, 'payload': request.json})
     if not sdk:
@@ -1212,7 +1199,7 @@ def create_preference():
 
 
 
-@app.route('/api/create_payway_payment', methods=['POST', 'GET', 'OPTIONS'])
+@bp.route('/api/create_payway_payment', methods=['POST', 'GET', 'OPTIONS'])
 def create_payway_payment():
     if request.method == 'OPTIONS':
         response = jsonify({'status': 'ok'})
@@ -1332,7 +1319,7 @@ def create_payway_payment():
         log_to_airtable('ERROR', 'Payway', f'Excepción en create_payway_payment: {e}')
         return add_cors_headers(jsonify({"error": str(e)})), 500
 
-@app.route('/api/payway/redirect', methods=['GET'])
+@bp.route('/api/payway/redirect', methods=['GET'])
 def payway_redirect():
     # Endpoint auxiliar para generar el formulario POST hacia Payway
     try:
@@ -1397,7 +1384,7 @@ def payway_redirect():
     except Exception as e:
          return f"Error generando formulario de pago: {str(e)}", 500
 
-@app.route('/api/payway/callback', methods=['POST', 'GET'])
+@bp.route('/api/payway/callback', methods=['POST', 'GET'])
 def payway_callback():
     log_to_airtable('INFO', 'Payway Callback', 'Recibido callback de Payway', details={'method': request.method, 'args': request.args, 'form': request.form})
     
@@ -1435,205 +1422,278 @@ def payway_callback():
         log_to_airtable('ERROR', 'Payway Callback', f'Error procesando callback: {e}')
         return redirect(f"{FRONTEND_URL}/#/exito?error=procesamiento")
 
+# type del external_reference -> (tabla, campo del monto, filtros de la búsqueda en Airtable, campos al pagar)
+MANUAL_OBLIGATIONS = {
+    'recaudacion_manual': (RECAUDACION_TABLE_ID, 'Total', lambda ctx: {"Estado Pago": "Pendiente"}, {"Estado Pago": "Pagado"}),
+    'patente_manual': (PATENTE_MANUAL_TABLE_ID, 'Total', lambda ctx: {"Dominio": ctx.get('dominio'), "Estado Pago": "Pendiente"}, {"Estado Pago": "Pagado"}),
+    'plan_pago': (PLAN_PAGO_TABLE_ID, 'Monto Total', lambda ctx: {"Cuota del Plan": ctx.get('cuota'), "Estado": "No Pagado"}, {"Estado": "Pagado"}),
+}
+
+def obligation_ref(kind, items_context):
+    """Lo que distingue obligaciones del mismo email: dominio (patente) o cuota (plan de pago)."""
+    return {'patente_manual': items_context.get('dominio'), 'plan_pago': items_context.get('cuota')}.get(kind, "")
+
+def add_obligation(record_id, kind, email, ref, amount):
+    """Suma al índice la obligación recién registrada; si falla, el pago se cruza buscando en Airtable."""
+    try:
+        obligation_index.add(kind, email, ref, amount, record_id)
+    except Exception as e:
+        print(f"ERROR agregando obligación {record_id} al índice: {e}")
+
+def http_status(error):
+    """Código HTTP de un error de pyairtable/requests, o None si no hubo respuesta."""
+    return getattr(getattr(error, 'response', None), 'status_code', None)
+
+def settle_manual_obligation(payment_id, monto_pagado, items_context):
+    """
+    Marca como pagada la obligación manual que cubre el pago y devuelve el registro actualizado (o None).
+    Primero el índice local; si no la tiene, la búsqueda por fórmula en Airtable de antes.
+    """
+    kind = items_context.get('type')
+    table_id, amount_field, pending_filter, paid_fields = MANUAL_OBLIGATIONS[kind]
+    table = api.table(BASE_ID, table_id)
+    email = items_context.get('email')
+
+    while True:
+        claimed = obligation_index.claim(kind, email, obligation_ref(kind, items_context), monto_pagado, payment_id)
+        if claimed['status'] in ('ambiguous', 'duplicate'):
+            log_to_airtable('WARNING', 'Payment Process', f'Pago {payment_id}: coincidencia {claimed["status"]} con {kind} pendientes, revisar',
+                            related_id=payment_id, details=claimed)
+        if not claimed['record_id']:
+            break
+        try:
+            return table.update(claimed['record_id'], paid_fields)
+        except Exception as e:
+            if http_status(e) not in (404, 422):
+                # Que el reintento del webhook la vuelva a encontrar pendiente
+                obligation_index.release(claimed['record_id'], payment_id)
+                raise
+            # El registro se borró o cambió en Airtable: fuera del índice, y se sigue buscando
+            obligation_index.remove(claimed['record_id'])
+            log_to_airtable('WARNING', 'Payment Process', f'Pago {payment_id}: el {kind} {claimed["record_id"]} del índice ya no existe en Airtable ({e})',
+                            related_id=payment_id)
+    if claimed['status'] == 'duplicate':
+        return None
+
+    # No está en el índice (registrada antes de que existiera): búsqueda en Airtable
+    records = table.all(formula=match({"Email": email, **pending_filter(items_context)}))
+    candidates = [r for r in records if abs(float(r['fields'].get(amount_field, 0)) - float(monto_pagado)) < 1.0]
+    if not candidates:
+        return None
+    if len(candidates) > 1:
+        obligation_index.flag(payment_id, kind, 'ambiguous', float(monto_pagado), candidates[0]['id'], [r['id'] for r in candidates])
+        log_to_airtable('WARNING', 'Payment Process', f'Pago {payment_id}: {len(candidates)} {kind} pendientes coinciden, se toma el primero',
+                        related_id=payment_id, details={'candidates': [r['id'] for r in candidates]})
+    record = table.update(candidates[0]['id'], paid_fields)
+    obligation_index.mark_paid(record['id'], payment_id)
+    return record
+
+def apply_payment_to_origin(payment_id, monto_pagado, items_context):
+    """Marca como pagada la deuda/registro de origen. Devuelve los ítems para el comprobante."""
+    items_for_pdf = []
+
+    # Casos especiales: registros manuales pendientes (recaudación, patente, plan de pago)
+    if items_context.get('type') == 'recaudacion_manual':
+        record = settle_manual_obligation(payment_id, monto_pagado, items_context)
+        if record:
+            record_stats(manual_entry(record, "recaudacion"))
+            items_for_pdf.append({"description": "Pago Recaudación Manual", "amount": monto_pagado})
+            log_to_airtable('INFO', 'Payment Process', f'Actualizado registro recaudación {record["id"]} a Pagado (MP Payment ID: {payment_id})')
+
+    elif items_context.get('type') == 'patente_manual':
+        record = settle_manual_obligation(payment_id, monto_pagado, items_context)
+        if record:
+            record_stats(manual_entry(record, "patente"))
+            items_for_pdf.append({"description": f"Pago Patente {items_context.get('dominio')}", "amount": monto_pagado})
+            log_to_airtable('INFO', 'Payment Process', f'Actualizado registro patente {record["id"]} a Pagado (MP Payment ID: {payment_id})')
+
+    elif items_context.get('type') == 'plan_pago':
+        record = settle_manual_obligation(payment_id, monto_pagado, items_context)
+        if record:
+            items_for_pdf.append({"description": f"Plan de Pago - Cuota {items_context.get('cuota')}", "amount": monto_pagado})
+            log_to_airtable('INFO', 'Payment Process', f'Actualizado registro plan de pago {record["id"]} a Pagado (MP Payment ID: {payment_id})')
+
+    # Caso Estándar (Deudas previas)
+    elif "record_id" in items_context:
+        record_id_to_update = items_context["record_id"]
+        table_id_to_update = ""
+        fields_to_update_origin = {}
+        item_type = items_context.get("item_type")
+
+        if item_type == "deuda_general":
+            table_id_to_update = DEUDAS_TABLE_ID
+            fields_to_update_origin["monto total deuda"] = "0"
+            fields_to_update_origin["deuda en concepto de"] = "Pagado"
+            items_for_pdf.append({"description": "Deuda General", "amount": items_context.get('total_amount', 0)})
+        else:
+            if item_type == "lote":
+                table_id_to_update = CONTRIBUTIVOS_TABLE_ID
+            elif item_type == "vehiculo":
+                table_id_to_update = PATENTE_TABLE_ID
+            elif item_type == "agua": # NUEVO
+                table_id_to_update = WATER_TABLE_ID
+            if items_context.get("deuda"):
+                if item_type == "lote":
+                    fields_to_update_origin["deuda"] = "0"
+                elif item_type == "vehiculo":
+                    fields_to_update_origin["Deuda patente"] = "0"
+                elif item_type == "agua": # NUEVO - Added this line myself previously
+                    fields_to_update_origin["deuda"] = "0" # Asumiendo un campo 'deuda' para agua
+                
+                items_for_pdf.append({"description": f"Deuda {item_type.capitalize()}", "amount": items_context.get('deuda_monto', 0)})
+            
+            # Iterar por los meses para ponerlos a cero
+            # Asumo que `meses` en `items_context` son los meses seleccionados para pagar.
+            # Los nombres de los campos en Airtable deben coincidir con esta capitalización (ej. "Enero", "Enero agua")
+            meses_a_actualizar = items_context.get("meses", {})
+            for mes_key, sel in meses_a_actualizar.items():
+                if sel: # Si el mes fue seleccionado para pagar
+                    # Para el backend, los meses vienen en minúscula desde el frontend, capitalizamos aquí
+                    mesCapitalized = mes_key.capitalize() 
+                    if item_type == "agua":
+                        fields_to_update_origin[f"{mesCapitalized} agua"] = 0 # Valor numérico
+                        fields_to_update_origin[f"{mesCapitalized} Comercial"] = 0 # Valor numérico
+                    elif item_type == "lote":
+                        # Para TASAS, los campos son en minúscula
+                        fields_to_update_origin[mes_key] = 0 # Usar mes_key directamente (en minúscula)
+                    # Nota: para 'vehiculo' no se procesan meses individuales, solo 'Deuda patente'
+
+        if fields_to_update_origin:
+            api.table(BASE_ID, table_id_to_update).update(record_id_to_update, fields_to_update_origin)
+            # Los buscadores no deben seguir mostrando la deuda recién pagada
+            padron_cache.invalidate(table_id_to_update, record_id_to_update, fields_to_update_origin)
+            log_to_airtable('INFO', 'Payment Process', f'Airtable de deuda actualizado para ID: {record_id_to_update}', related_id=payment_id, details={'updates': fields_to_update_origin})
+
+    return items_for_pdf
+
+def send_payment_receipt(payment_id, pdf_id, pago_estado, monto_pagado, items_context, items_for_pdf):
+    """Genera el comprobante y encola el email. Devuelve el Comprobante_Status inicial (o None si no hubo email)."""
+    # Intentar generar y enviar PDF - si falla, no afecta el proceso de pago
+    try:
+        pdf_details = {
+            "FECHA_PAGO": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+            "ESTADO_PAGO": pago_estado,
+            "ID_PAGO_MP": payment_id,
+            "NOMBRE_PAGADOR": items_context.get('nombre_contribuyente') or items_context.get('email', 'Contribuyente'),
+            "IDENTIFICADOR_PAGADOR": items_context.get('dni') or items_context.get('email', 'N/A'),
+            "items": items_for_pdf,
+            "MONTO_TOTAL": monto_pagado
+        }
+        pdf_file, pdf_id = create_receipt_pdf(pdf_details, pdf_id=pdf_id)
+
+        if pdf_file and items_context.get("email"):
+            params = {
+                "from": os.getenv("RESEND_FROM_EMAIL", "onboarding@resend.dev"), "to": items_context.get("email"),
+                "subject": "Comprobante de Pago - Municipalidad de Villa Traful",
+                "html": f"<p>Hola, adjuntamos tu comprobante de pago con ID: {payment_id}.</p>",
+                "attachments": [{"filename": f"comprobante_{payment_id}.pdf", "content": base64.b64encode(pdf_file.getvalue()).decode('utf-8')}]
+            }
+            # Al enviarse (o agotar los reintentos) la cola actualiza Comprobante_Status del Historial
+            mail_queue.enqueue(params, dedupe_key=f"comprobante:{pdf_id}", ref=f"historial:{pdf_id}")
+            log_to_airtable('INFO', 'Email Service', f'Email de comprobante en cola para {items_context.get("email")}.', related_id=payment_id)
+
+            # Guardar contacto en tabla Contactos
+            save_contacto(
+                email=items_context.get('email'),
+                nombre=items_context.get('nombre_contribuyente') or items_context.get('nombre'),
+                origen='Pago Online'
+            )
+            return f"En cola para {items_context.get('email')}"
+        elif not items_context.get("email"):
+            log_to_airtable('WARNING', 'Email Service', f'No se envió email de comprobante porque no se proporcionó dirección de correo.', related_id=payment_id)
+        else: # pdf_file is None
+            log_to_airtable('ERROR', 'Email Service', f'No se pudo generar el PDF para el email del comprobante.', related_id=payment_id)
+        return None
+    except Exception as pdf_error:
+        # Si falla el PDF, logueamos pero NO fallamos el pago
+        print(f"ERROR generando/enviando PDF (no crítico): {pdf_error}")
+        log_to_airtable('ERROR', 'PDF Generation', f'Error generando/enviando PDF (pago procesado exitosamente): {pdf_error}', related_id=payment_id)
+        return f"Error PDF: {str(pdf_error)[:100]}"
+
+def find_historial_by_pdf_id(pdf_id):
+    return api.table(BASE_ID, HISTORIAL_TABLE_ID).first(formula=match({"PDF_ID": pdf_id}))
+
+def create_historial(fields):
+    return api.table(BASE_ID, HISTORIAL_TABLE_ID).create(fields)
+
 def process_payment(payment_id, payment_info, items_context, is_simulation=False):
     log_to_airtable('INFO', 'Payment Process', f'Inicio del procesamiento de pago. ID: {payment_id}', related_id=payment_id, details={'payment_info': payment_info, 'items_context': items_context})
     try:
         payment_status = payment_info["status"]
         monto_pagado = payment_info["transaction_amount"]
-        
-        pago_estado = "Fallido"
-        items_for_pdf = []
-
-        detalle_pago_historial = f"Pago para {items_context.get('item_type')}, DNI/Nombre: {items_context.get('dni') or items_context.get('nombre_contribuyente')}"
+        pago_estado = "Exitoso" if payment_status == "approved" else "Fallido"
 
-        historial_table = api.table(BASE_ID, HISTORIAL_TABLE_ID)
+        # El registro de Historial se arma completo y se escribe una sola vez al final.
+        # El journal local permite retomar este mismo registro si el proceso se corta.
+        # Solo se retoma una entrada del mismo estado de MP (la de 'pending' no sirve para 'approved')
+        builder = historial_journal.begin(payment_id, mp_status=payment_status)
+        if builder.resumed:
+            log_to_airtable('WARNING', 'Payment Process', f'Retomando registro de historial pendiente (PDF_ID {builder.pdf_id}).', related_id=payment_id)
 
-        # Preparar datos del historial
-        historial_data = {
+        detalle_pago_historial = f"Pago para {items_context.get('item_type')}, DNI/Nombre: {items_context.get('dni') or items_context.get('nombre_contribuyente')}"
+        builder.update({
             'Estado': pago_estado,
             'Monto': monto_pagado,
             'Detalle': detalle_pago_historial,
             'MP_Payment_ID': payment_id,
             'ItemsPagadosJSON': json.dumps([]),
-            'Contribuyente DNI': items_context.get('dni', 'N/A')
-        }
+            'Contribuyente DNI': items_context.get('dni', 'N/A'),
+            # PDF_ID y link se conocen antes de escribir: el comprobante se busca por PDF_ID
+            'PDF_ID': builder.pdf_id,
+            'Link Comprobante': f"{BACKEND_URL}/api/receipt/{builder.pdf_id}"
+        })
 
         # SOLO agregar link a Contribuyente si es un pago de retributivos (lote)
         # El campo "Contribuyente" está linkeado solo a la tabla de Retributivos
         if items_context.get('record_id') and items_context.get('item_type') == 'lote':
-            historial_data['Contribuyente'] = [items_context.get('record_id')]
-
-        historial_record = historial_table.create(historial_data)
-        log_to_airtable('INFO', 'Payment Process', f'Registro de historial creado con ID: {historial_record["id"]}', related_id=historial_record['id'], details={'mp_payment_id': payment_id})
+            builder.update({'Contribuyente': [items_context.get('record_id')]})
 
+        items_for_pdf = []
         if payment_status == "approved":
-            pago_estado = "Exitoso"
-            log_to_airtable('INFO', 'Payment Process', f'Pago APROBADO. Procesando actualizaciones de deuda. ID MP: {payment_id}', related_id=payment_id)
-            
-            # Caso Especial: Recaudación Manual
-            if items_context.get('type') == 'recaudacion_manual':
-                # Búsqueda en Airtable
-                recaudacion_table = api.table(BASE_ID, RECAUDACION_TABLE_ID)
-                records = recaudacion_table.all(formula=match({"Email": items_context.get('email'), "Estado Pago": "Pendiente"}))
-
-                for r in records:
-                    if abs(float(r['fields'].get('Total', 0)) - float(monto_pagado)) < 1.0:
-                        # Actualizar Estado Pago a Pagado
-                        recaudacion_table.update(r['id'], {"Estado Pago": "Pagado"})
-                        items_for_pdf.append({"description": "Pago Recaudación Manual", "amount": monto_pagado})
-                        log_to_airtable('INFO', 'Payment Process', f'Actualizado registro recaudación {r["id"]} a Pagado (MP Payment ID: {payment_id})')
-                        break
-
-            # Caso Especial: Patente Manual
-            elif items_context.get('type') == 'patente_manual':
-                patente_table = api.table(BASE_ID, PATENTE_MANUAL_TABLE_ID)
-                # Buscamos por email y dominio
-                records = patente_table.all(formula=match({"Email": items_context.get('email'), "Dominio": items_context.get('dominio'), "Estado Pago": "Pendiente"}))
-
-                for r in records:
-                    if abs(float(r['fields'].get('Total', 0)) - float(monto_pagado)) < 1.0:
-                        # Actualizar Estado Pago a Pagado
-                        patente_table.update(r['id'], {"Estado Pago": "Pagado"})
-                        items_for_pdf.append({"description": f"Pago Patente {items_context.get('dominio')}", "amount": monto_pagado})
-                        log_to_airtable('INFO', 'Payment Process', f'Actualizado registro patente {r["id"]} a Pagado (MP Payment ID: {payment_id})')
-                        break
-
-            # Caso Especial: Plan de Pago
-            elif items_context.get('type') == 'plan_pago':
-                plan_pago_table = api.table(BASE_ID, PLAN_PAGO_TABLE_ID)
-                # Buscamos por email y cuota del plan
-                records = plan_pago_table.all(formula=match({
-                    "Email": items_context.get('email'),
-                    "Cuota del Plan": items_context.get('cuota'),  # Corregido: usar 'cuota' en vez de 'cuota_plan'
-                    "Estado": "No Pagado"
-                }))
-
-                for r in records:
-                    if abs(float(r['fields'].get('Monto Total', 0)) - float(monto_pagado)) < 1.0:
-                        # Actualizar Estado a Pagado
-                        plan_pago_table.update(r['id'], {"Estado": "Pagado"})
-                        items_for_pdf.append({"description": f"Plan de Pago - Cuota {items_context.get('cuota')}", "amount": monto_pagado})
-                        log_to_airtable('INFO', 'Payment Process', f'Actualizado registro plan de pago {r["id"]} a Pagado (MP Payment ID: {payment_id})')
-                        break
-
-            # Caso Estándar (Deudas previas)
-            elif "record_id" in items_context:
-                record_id_to_update = items_context["record_id"]
-                table_id_to_update = ""
-                fields_to_update_origin = {}
-                item_type = items_context.get("item_type")
-
-                if item_type == "deuda_general":
-                    table_id_to_update = DEUDAS_TABLE_ID
-                    fields_to_update_origin["monto total deuda"] = "0"
-                    fields_to_update_origin["deuda en concepto de"] = "Pagado"
-                    items_for_pdf.append({"description": "Deuda General", "amount": items_context.get('total_amount', 0)})
-                else:
-                    if item_type == "lote":
-                        table_id_to_update = CONTRIBUTIVOS_TABLE_ID
-                    elif item_type == "vehiculo":
-                        table_id_to_update = PATENTE_TABLE_ID
-                    elif item_type == "agua": # NUEVO
-                        table_id_to_update = WATER_TABLE_ID
-                    if items_context.get("deuda"):
-                        if item_type == "lote":
-                            fields_to_update_origin["deuda"] = "0"
-                        elif item_type == "vehiculo":
-                            fields_to_update_origin["Deuda patente"] = "0"
-                        elif item_type == "agua": # NUEVO - Added this line myself previously
-                            fields_to_update_origin["deuda"] = "0" # Asumiendo un campo 'deuda' para agua
-                        
-                        items_for_pdf.append({"description": f"Deuda {item_type.capitalize()}", "amount": items_context.get('deuda_monto', 0)})
-                    
-                    # Iterar por los meses para ponerlos a cero
-                    # Asumo que `meses` en `items_context` son los meses seleccionados para pagar.
-                    # Los nombres de los campos en Airtable deben coincidir con esta capitalización (ej. "Enero", "Enero agua")
-                    meses_a_actualizar = items_context.get("meses", {})
-                    for mes_key, sel in meses_a_actualizar.items():
-                        if sel: # Si el mes fue seleccionado para pagar
-                            # Para el backend, los meses vienen en minúscula desde el frontend, capitalizamos aquí
-                            mesCapitalized = mes_key.capitalize() 
-                            if item_type == "agua":
-                                fields_to_update_origin[f"{mesCapitalized} agua"] = 0 # Valor numérico
-                                fields_to_update_origin[f"{mesCapitalized} Comercial"] = 0 # Valor numérico
-                            elif item_type == "lote":
-                                # Para TASAS, los campos son en minúscula
-                                fields_to_update_origin[mes_key] = 0 # Usar mes_key directamente (en minúscula)
-                            # Nota: para 'vehiculo' no se procesan meses individuales, solo 'Deuda patente'
-
-                if fields_to_update_origin:
-                    api.table(BASE_ID, table_id_to_update).update(record_id_to_update, fields_to_update_origin)
-                    log_to_airtable('INFO', 'Payment Process', f'Airtable de deuda actualizado para ID: {record_id_to_update}', related_id=payment_id, details={'updates': fields_to_update_origin})
-            
-            historial_table.update(historial_record['id'], {
-                'Estado': pago_estado,
-                'ItemsPagadosJSON': json.dumps(items_for_pdf)
-            })
-            log_to_airtable('INFO', 'Payment Process', f'Historial de pago actualizado a "Exitoso" y con ítems. ID: {historial_record["id"]}', related_id=payment_id)
-
+            if not builder.done('deuda'):
+                log_to_airtable('INFO', 'Payment Process', f'Pago APROBADO. Procesando actualizaciones de deuda. ID MP: {payment_id}', related_id=payment_id)
+                builder.step('deuda', items=apply_payment_to_origin(payment_id, monto_pagado, items_context))
+            items_for_pdf = builder.steps['deuda']['items']
+            builder.update({'ItemsPagadosJSON': json.dumps(items_for_pdf)})
         else: # Si el pago no fue aprobado
-            historial_table.update(historial_record['id'], {'Estado': pago_estado})
             log_to_airtable('WARNING', 'Payment Process', f'Pago NO APROBADO. Estado final: {payment_status}.', related_id=payment_id, details={'payment_info': payment_info})
-        
-        receipt_url = f"{BACKEND_URL}/api/receipt/{historial_record['id']}"
-        historial_table.update(historial_record['id'], {"Link Comprobante": receipt_url})
-        log_to_airtable('INFO', 'Payment Process', f'Link de comprobante guardado para historial ID: {historial_record["id"]}', related_id=payment_id)
 
-        # Intentar generar y enviar PDF - si falla, no afecta el proceso de pago
-        try:
-            pdf_details = {
-                "FECHA_PAGO": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-                "ESTADO_PAGO": pago_estado,
-                "ID_PAGO_MP": payment_id,
-                "NOMBRE_PAGADOR": items_context.get('nombre_contribuyente') or items_context.get('email', 'Contribuyente'),
-                "IDENTIFICADOR_PAGADOR": items_context.get('dni') or items_context.get('email', 'N/A'),
-                "items": items_for_pdf,
-                "MONTO_TOTAL": monto_pagado
-            }
-            pdf_file, pdf_id = create_receipt_pdf(pdf_details)
-
-            # Guardar PDF_ID en historial si se generó exitosamente
-            if pdf_id:
-                historial_table.update(historial_record['id'], {"PDF_ID": pdf_id})
-
-            if pdf_file and items_context.get("email"):
-                params = {
-                    "from": os.getenv("RESEND_FROM_EMAIL", "onboarding@resend.dev"), "to": items_context.get("email"),
-                    "subject": "Comprobante de Pago - Municipalidad de Villa Traful",
-                    "html": f"<p>Hola, adjuntamos tu comprobante de pago con ID: {payment_id}.</p>",
-                    "attachments": [{"filename": f"comprobante_{payment_id}.pdf", "content": base64.b64encode(pdf_file.getvalue()).decode('utf-8')}]
-                }
-                resend.Emails.send(params)
-                log_to_airtable('INFO', 'Email Service', f'Email de comprobante enviado a {items_context.get("email")}.', related_id=payment_id)
-
-                # Guardar contacto en tabla Contactos
-                save_contacto(
-                    email=items_context.get('email'),
-                    nombre=items_context.get('nombre_contribuyente') or items_context.get('nombre'),
-                    origen='Pago Online'
-                )
-
-                historial_table.update(historial_record['id'], {"Comprobante_Status": f"Enviado a {items_context.get('email')}"})
-            elif not items_context.get("email"):
-                log_to_airtable('WARNING', 'Email Service', f'No se envió email de comprobante porque no se proporcionó dirección de correo.', related_id=payment_id)
-            else: # pdf_file is None
-                log_to_airtable('ERROR', 'Email Service', f'No se pudo generar el PDF para el email del comprobante.', related_id=payment_id)
-        except Exception as pdf_error:
-            # Si falla el PDF, logueamos pero NO fallamos el pago
-            print(f"ERROR generando/enviando PDF (no crítico): {pdf_error}")
-            log_to_airtable('ERROR', 'PDF Generation', f'Error generando/enviando PDF (pago procesado exitosamente): {pdf_error}', related_id=payment_id)
-            historial_table.update(historial_record['id'], {"Comprobante_Status": f"Error PDF: {str(pdf_error)[:100]}"})
+        if not builder.done('comprobante'):
+            builder.step('comprobante', status=send_payment_receipt(payment_id, builder.pdf_id, pago_estado, monto_pagado, items_context, items_for_pdf))
+        if builder.steps['comprobante']['status']:
+            builder.update({'Comprobante_Status': builder.steps['comprobante']['status']})
+
+        historial_record = builder.commit(create_historial, find_existing=find_historial_by_pdf_id)
+        if payment_status == "approved":
+            record_stats(historial_entry(historial_record))
+        log_to_airtable('INFO', 'Payment Process', f'Registro de historial creado con ID: {historial_record["id"]} (Estado: {pago_estado})', related_id=historial_record['id'], details={'mp_payment_id': payment_id})
 
         return {"status": "ok", "historialRecordId": historial_record['id']}
     except Exception as e:
         log_to_airtable('ERROR', 'Payment Process', f'Error procesando pago {payment_id}: {e}', related_id=payment_id, details={'error_message': str(e)})
         raise
 
-@app.route('/api/payment_webhook', methods=['POST'])
+def handle_mp_payment(payment_id, previous_mp_status=None):
+    """Procesa un pago de la cola de webhooks. Cualquier excepción hace que se reintente."""
+    payment_response = sdk.payment().get(payment_id)
+    payment_info = payment_response.get("response") or {}
+    if not payment_info.get("status"):
+        raise RuntimeError(f"Mercado Pago no devolvió el pago (HTTP {payment_response.get('status')}): {payment_info}")
+    print(f"DEBUG WEBHOOK: Info del pago {payment_id} obtenida: Status={payment_info.get('status')}")
+
+    # Una notificación repetida sin cambio de estado no vuelve a generar historial ni email
+    if payment_info["status"] == previous_mp_status:
+        return {"mp_status": payment_info["status"], "skipped": "sin cambios de estado"}
+
+    items_context = json.loads(payment_info.get("external_reference") or "{}")
+    print(f"DEBUG WEBHOOK: Items context: {items_context}")
+    result = process_payment(payment_id, payment_info, items_context)
+    return {"mp_status": payment_info["status"], **result}
+
+@bp.route('/api/payment_webhook', methods=['POST'])
 def payment_webhook():
     print("--- Webhook Recibido ---")
     data = request.json
-    print(f"DEBUG WEBHOOK: Data recibida: {json.dumps(data, indent=2)}")
     print(f"DEBUG WEBHOOK: Type: {data.get('type') if data else 'NO DATA'}")
 
     if data and data.get("type") == "payment":
@@ -1645,31 +1705,19 @@ def payment_webhook():
             return jsonify({"error": "No payment ID"}), 400
 
         try:
-            print(f"DEBUG WEBHOOK: Consultando pago a Mercado Pago con ID: {payment_id}")
-            payment_info = sdk.payment().get(payment_id)["response"]
-            print(f"DEBUG WEBHOOK: Info del pago obtenida: Status={payment_info.get('status')}")
-
-            items_context = json.loads(payment_info.get("external_reference", "{}"))
-            print(f"DEBUG WEBHOOK: Items context: {items_context}")
-
-            # process_payment hará un raise si hay error, que será capturado aquí
-            print(f"DEBUG WEBHOOK: Iniciando process_payment...")
-            result = process_payment(payment_id, payment_info, items_context)
-            print(f"DEBUG WEBHOOK: process_payment completado exitosamente")
-
-            return jsonify({"status": "success", "message": "Webhook processed successfully"}), 200
+            # Solo se guarda en la cola; lo procesan los workers con reintentos
+            outcome = webhook_queue.enqueue(payment_id)
         except Exception as e:
-            error_traceback = traceback.format_exc()
-            print(f"ERROR WEBHOOK: Exception procesando webhook: {e}")
-            print(f"ERROR WEBHOOK: Traceback: {error_traceback}")
-            log_to_airtable('ERROR', 'Mercado Pago Webhook', f'ERROR procesando webhook para payment_id {payment_id}: {e}\nTraceback: {error_traceback}', details={'error_message': str(e), 'payment_id': payment_id, 'traceback': error_traceback})
-            # Importante: devolver 200 a MP para evitar reintentos, aunque internamente haya fallado.
-            return jsonify({"status": "error", "message": "Error processing payment internally"}), 200
+            # Sin la cola no hay garantía: que MP reintente la notificación
+            print(f"ERROR WEBHOOK: No se pudo encolar el pago {payment_id}: {e}")
+            return jsonify({"status": "error", "message": "No se pudo encolar el pago"}), 500
+        print(f"DEBUG WEBHOOK: Pago {payment_id} -> {outcome}")
+        return jsonify({"status": outcome}), 200
 
     print(f"DEBUG WEBHOOK: No es un webhook de payment. Ignorando.")
     return jsonify({"status": "not a payment"}), 200
 
-@app.route('/api/debug/simulate_payment', methods=['POST'])
+@bp.route('/api/debug/simulate_payment', methods=['POST'])
 def simulate_payment():
     print("--- Simulación de Pago Recibida ---")
     data = request.json
@@ -1687,7 +1735,7 @@ def simulate_payment():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/get_history_by_payment_id/<mp_payment_id>', methods=['GET'])
+@bp.route('/api/get_history_by_payment_id/<mp_payment_id>', methods=['GET'])
 def get_history_by_payment_id(mp_payment_id):
     if not api: return jsonify({"error": "Airtable no configurado"}), 500
     try:
@@ -1697,41 +1745,197 @@ def get_history_by_payment_id(mp_payment_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/receipt/<historial_record_id>', methods=['GET'])
-def get_receipt(historial_record_id):
+def historial_receipt_details(record, fecha_pago=None):
+    """Datos del comprobante a partir de un registro de Historial."""
+    return {
+        "FECHA_PAGO": record['fields'].get('Timestamp') or fecha_pago or datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+        "ESTADO_PAGO": record['fields'].get('Estado', 'Desconocido'),
+        "ID_PAGO_MP": record['fields'].get('MP_Payment_ID', 'N/A'),
+        "items": json.loads(record['fields'].get('ItemsPagadosJSON', '[]')),
+        "MONTO_TOTAL": record['fields'].get('Monto', 0)
+    }
+
+def efectivo_receipt_details(record):
+    """Datos del comprobante a partir de un registro de Efectivo (la tabla solo guarda el total)."""
+    f = record['fields']
+    fecha = f.get('Fecha y Hora') or record.get('createdTime')
+    try:
+        fecha = datetime.strptime(fecha[:19], "%Y-%m-%dT%H:%M:%S").strftime("%d/%m/%Y %H:%M:%S")
+    except (TypeError, ValueError):
+        pass
+    return {
+        "FECHA_PAGO": fecha or "N/A",
+        "ESTADO_PAGO": "Pagado en Efectivo",
+        "ID_PAGO_MP": "N/A",
+        "items": [{"description": f"{f.get('Tipo', 'Cobro')} - {f.get('Contribuyente', '')}".strip(' -'), "amount": f.get('Total', 0)}],
+        "MONTO_TOTAL": f.get('Total', 0)
+    }
+
+def send_receipt_pdf(receipt_id, etag, pdf_file):
+    # conditional=True responde 304 si el If-None-Match coincide con el ETag
+    return send_file(pdf_file, mimetype='application/pdf', as_attachment=True,
+                     download_name=f"comprobante_{receipt_id}.pdf", etag=etag, conditional=True)
+
+@bp.route('/api/receipt_file/<pdf_id>', methods=['GET'])
+def get_receipt_file(pdf_id):
+    # Link firmado que devuelven los endpoints de cobro (pdf_mode=url)
+    expires = request.args.get('expires')
+    if not receipt_store.verify(pdf_id, expires, request.args.get('sig')):
+        return jsonify({"error": "Link de comprobante vencido o inválido"}), 403
+    stored = receipt_store.open(pdf_id)
+    if not stored:
+        return jsonify({"error": "Comprobante no disponible"}), 404
+    response = send_receipt_pdf(pdf_id, *stored)
+    # El navegador puede guardarlo mientras el link sea válido
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.max_age = max(0, int(expires) - int(time.time()))
+    return response
+
+@bp.route('/api/receipt/<receipt_id>', methods=['GET'])
+def get_receipt(receipt_id):
+    # Acepta el ID del registro de Historial (links viejos, "rec...") o el PDF_ID (links nuevos)
+    # Si ya se generó, se sirve el PDF guardado sin consultar Airtable
+    stored = receipt_store.open(receipt_id)
+    if stored:
+        return send_receipt_pdf(receipt_id, *stored)
+
     if not api: return "Error: Airtable no inicializado.", 500
     try:
         historial_table = api.table(BASE_ID, HISTORIAL_TABLE_ID)
-        record = historial_table.get(historial_record_id)
-        items_for_pdf = json.loads(record['fields'].get('ItemsPagadosJSON', '[]'))
+        fecha_pago = None
+        if receipt_id.startswith('rec'):
+            record = historial_table.get(receipt_id)
+        else:
+            # Primero el journal local (no consulta Airtable), después la tabla por PDF_ID
+            entry = historial_journal.find(receipt_id)
+            if entry:
+                record = {"id": entry.historial_id, "fields": entry.fields}
+                fecha_pago = datetime.fromtimestamp(entry.created_at).strftime("%d/%m/%Y %H:%M:%S")
+            else:
+                record = find_historial_by_pdf_id(receipt_id)
+            if not record:
+                return jsonify({"error": "No se pudo encontrar o generar el comprobante."}), 404
 
         # Obtener PDF_ID existente si hay uno guardado
         existing_pdf_id = record['fields'].get('PDF_ID')
 
-        payment_details = {
-            "FECHA_PAGO": record['fields'].get('Timestamp', datetime.now().strftime("%d/%m/%Y %H:%M:%S")),
-            "ESTADO_PAGO": record['fields'].get('Estado', 'Desconocido'),
-            "ID_PAGO_MP": record['fields'].get('MP_Payment_ID', 'N/A'),
-            "items": items_for_pdf,
-            "MONTO_TOTAL": record['fields'].get('Monto', 0)
-        }
+        # El link viejo (rec...) de un comprobante ya guardado por PDF_ID
+        if existing_pdf_id and existing_pdf_id != receipt_id:
+            stored = receipt_store.open(existing_pdf_id)
+            if stored:
+                receipt_store.alias(receipt_id, existing_pdf_id)
+                return send_receipt_pdf(receipt_id, *stored)
 
-        # Reutilizar PDF_ID existente o generar uno nuevo
+        payment_details = historial_receipt_details(record, fecha_pago)
+
+        # Reutilizar PDF_ID existente o generar uno nuevo (create_receipt_pdf lo guarda)
         pdf_file, pdf_id = create_receipt_pdf(payment_details, pdf_id=existing_pdf_id)
 
-        # Si se generó un nuevo PDF_ID, guardarlo en Airtable
-        if pdf_file and pdf_id and not existing_pdf_id:
-            historial_table.update(historial_record_id, {"PDF_ID": pdf_id})
+        # Registros viejos sin PDF_ID: guardarlo en Airtable
+        if pdf_file and pdf_id and not existing_pdf_id and record.get('id'):
+            historial_table.update(record['id'], {"PDF_ID": pdf_id})
 
         if pdf_file:
-            return send_file(pdf_file, mimetype='application/pdf', as_attachment=True, download_name=f"comprobante_{historial_record_id}.pdf")
+            if record.get('id'):
+                receipt_store.alias(record['id'], pdf_id)
+            return send_receipt_pdf(receipt_id, receipt_store.etag(pdf_id), pdf_file)
         return "Error al generar el PDF.", 500
     except Exception as e:
         return jsonify({"error": "No se pudo encontrar o generar el comprobante."}), 404
 
+# Exportación masiva: tabla, expresión de fecha para filtrar, campo del operador y armado del comprobante
+RECEIPT_EXPORT_SOURCES = {
+    'historial': (HISTORIAL_TABLE_ID, "IF({Fecha de Transacción}, {Fecha de Transacción}, CREATED_TIME())", None, historial_receipt_details),
+    'efectivo': (EFECTIVO_TABLE_ID, "IF({Fecha y Hora}, {Fecha y Hora}, CREATED_TIME())", 'Operador', efectivo_receipt_details),
+}
+
+def export_receipt_pdf(record, build_details, backend):
+    """
+    Bytes del comprobante: el guardado si existe, si no se genera solo para la
+    exportación. El regenerado no se guarda: desde el registro no siempre se
+    reconstruye completo (Efectivo solo tiene el total) y pasaría a ser el que
+    sirve /api/receipt/<PDF_ID> en lugar del original.
+    """
+    pdf_id = record['fields'].get('PDF_ID')
+    stored = receipt_store.open(pdf_id) if pdf_id else None
+    stored = stored or receipt_store.open(record['id'])
+    if stored:
+        with stored[1] as f:
+            return f.read()
+    pdf_file, _ = pdf_pool.render(build_details(record), pdf_id=pdf_id or record['id'], backend=backend)
+    return pdf_file.getvalue()
+
+@bp.route('/api/admin/receipts/export', methods=['GET'])
+def admin_export_receipts():
+    """
+    Comprobantes de un rango de fechas (y operador, en Efectivo).
+    ?source=historial|efectivo&desde=YYYY-MM-DD&hasta=YYYY-MM-DD&operador=...&format=zip|pdf
+    """
+    if not api: return jsonify({"error": "Airtable no inicializada"}), 500
+    source = request.args.get('source', 'historial')
+    export_format = request.args.get('format', 'zip')
+    operador = request.args.get('operador')
+    backend = request.args.get('backend')
+    try:
+        if source not in RECEIPT_EXPORT_SOURCES:
+            raise ValueError("'source' debe ser historial o efectivo")
+        if export_format not in ('zip', 'pdf'):
+            raise ValueError("'format' debe ser zip o pdf")
+        if backend and backend not in PDF_BACKENDS:
+            raise ValueError(f"'backend' debe ser {' o '.join(PDF_BACKENDS)}")
+        table_id, date_expr, operador_field, build_details = RECEIPT_EXPORT_SOURCES[source]
+        if operador and not operador_field:
+            raise ValueError(f"La tabla {source} no tiene operador")
+        desde = parse_date(request.args['desde'], 'desde') if request.args.get('desde') else None
+        hasta = parse_date(request.args['hasta'], 'hasta') if request.args.get('hasta') else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conditions = date_range_formula(date_expr, desde, hasta)
+    if operador:
+        conditions.append(str(match({operador_field: operador})))
+    if source == 'historial':
+        conditions.append("{Estado}='Exitoso'")
+    formula = f"AND({', '.join(conditions)})" if conditions else None
+    table = api.table(BASE_ID, table_id)
+    log_to_airtable('INFO', 'Admin API', f'Exportación de comprobantes ({source}, {export_format})',
+                    details={'desde': desde, 'hasta': hasta, 'operador': operador})
+
+    def records():
+        # De a una página de Airtable: nunca se tienen todos los registros en memoria
+        for page in table.iterate(formula=formula, page_size=EXPORT_PAGE_SIZE):
+            yield from page
+
+    filename = f"comprobantes_{source}_{desde or 'inicio'}_{hasta or 'hoy'}"
+
+    if export_format == 'pdf':
+        try:
+            receipts = []
+            for record in records():
+                if len(receipts) == EXPORT_PDF_MAX_RECEIPTS:
+                    return jsonify({"error": f"Más de {EXPORT_PDF_MAX_RECEIPTS} comprobantes: usar format=zip o acotar las fechas"}), 400
+                receipts.append((build_details(record), record['fields'].get('PDF_ID') or record['id']))
+            if not receipts:
+                return jsonify({"error": "No hay comprobantes para ese filtro"}), 404
+            pdf_file = pdf_pool.render_many(receipts, backend=backend)
+            return send_file(pdf_file, mimetype='application/pdf', as_attachment=True, download_name=f"{filename}.pdf")
+        except Exception as e:
+            log_to_airtable('ERROR', 'Admin API', f'ERROR exportando comprobantes: {e}')
+            return jsonify({"error": str(e)}), 500
+
+    def entries():
+        for record in records():
+            fecha = (record['fields'].get('Fecha de Transacción') or record['fields'].get('Fecha y Hora') or record.get('createdTime', ''))[:10]
+            name = f"{fecha}_{record['fields'].get('PDF_ID') or record['id']}.pdf"
+            yield name, lambda record=record: export_receipt_pdf(record, build_details, backend)
+
+    return Response(stream_with_context(zip_stream(entries())), mimetype='application/zip',
+                    headers={"Content-Disposition": f'attachment; filename="{filename}.zip"'})
+
 # --- NUEVOS ENDPOINTS ADMINISTRATIVOS ---
 
-@app.route('/api/staff/register_access', methods=['POST'])
+@bp.route('/api/staff/register_access', methods=['POST'])
 def register_staff_access():
     data = request.json
     username = data.get('username')
@@ -1751,18 +1955,15 @@ def register_staff_access():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/admin/recaudacion', methods=['GET'])
+@bp.route('/api/admin/recaudacion', methods=['GET'])
 def admin_get_recaudacion():
     if not api: return jsonify({"error": "Airtable no inicializada"}), 500
     try:
         page = int(request.args.get('page', 1))
         per_page = 10
-        table = api.table(BASE_ID, RECAUDACION_TABLE_ID)
-        all_records = table.all(sort=['-Fecha'])
-        
-        start = (page - 1) * per_page
-        end = start + per_page
-        paginated = all_records[start:end]
+        # Solo se pide la página actual (cursor de Airtable o espejo local)
+        result = paginator.page(RECAUDACION_TABLE_ID, ['-Fecha'], per_page, page=page, cursor=request.args.get('cursor'))
+        paginated = result['records']
         
         records = []
         for r in paginated:
@@ -1781,22 +1982,22 @@ def admin_get_recaudacion():
                 "detalle": f.get('Detalle JSON')
             })
             
-        return jsonify({"records": records, "total_records": len(all_records), "per_page": per_page})
+        return jsonify({"records": records, "total_records": result['total_records'], "per_page": per_page,
+                        "next_cursor": result['next_cursor'], "total_records_approx": result['total_records_approx']})
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/admin/patentes_manuales', methods=['GET'])
+@bp.route('/api/admin/patentes_manuales', methods=['GET'])
 def admin_get_patentes():
     if not api: return jsonify({"error": "Airtable no inicializada"}), 500
     try:
         page = int(request.args.get('page', 1))
         per_page = 10
-        table = api.table(BASE_ID, PATENTE_MANUAL_TABLE_ID)
-        all_records = table.all(sort=['-Fecha'])
-        
-        start = (page - 1) * per_page
-        end = start + per_page
-        paginated = all_records[start:end]
+        # Solo se pide la página actual (cursor de Airtable o espejo local)
+        result = paginator.page(PATENTE_MANUAL_TABLE_ID, ['-Fecha'], per_page, page=page, cursor=request.args.get('cursor'))
+        paginated = result['records']
         
         records = []
         for r in paginated:
@@ -1814,11 +2015,14 @@ def admin_get_patentes():
                 "transferencia": f.get('Transferencia')
             })
             
-        return jsonify({"records": records, "total_records": len(all_records), "per_page": per_page})
+        return jsonify({"records": records, "total_records": result['total_records'], "per_page": per_page,
+                        "next_cursor": result['next_cursor'], "total_records_approx": result['total_records_approx']})
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/admin/payments_history', methods=['GET'])
+@bp.route('/api/admin/payments_history', methods=['GET'])
 def admin_get_payments_history():
     log_to_airtable('INFO', 'Admin API', 'Recuperando historial de pagos para administrador.')
     if not api: return jsonify({"error": "Airtable no inicializada"}), 500
@@ -1826,15 +2030,10 @@ def admin_get_payments_history():
         page = int(request.args.get('page', 1))
         per_page = int(request.args.get('per_page', 20))  # Cambiado a 20 registros por página
 
-        historial_table = api.table(BASE_ID, HISTORIAL_TABLE_ID)
         # Ordenar por Fecha de Transacción descendente (más reciente primero), fallback a Timestamp
-        all_records = historial_table.all(sort=['-Fecha de Transacción', '-Timestamp'])
-        total_records = len(all_records)
-
-        # Implementar paginación manual
-        start_index = (page - 1) * per_page
-        end_index = start_index + per_page
-        paginated = all_records[start_index:end_index]
+        result = paginator.page(HISTORIAL_TABLE_ID, ['-Fecha de Transacción', '-Timestamp'], per_page, page=page, cursor=request.args.get('cursor'))
+        total_records = result['total_records']
+        paginated = result['records']
 
         payments = []
         for record in paginated:
@@ -1861,26 +2060,25 @@ def admin_get_payments_history():
             })
 
         log_to_airtable('INFO', 'Admin API', f'Recuperados {len(payments)} registros de pago (pág {page}) para administrador.', details={'total_records': total_records, 'current_page': page, 'per_page': per_page})
-        return jsonify({"payments": payments, "total_records": total_records})
+        return jsonify({"payments": payments, "total_records": total_records,
+                        "next_cursor": result['next_cursor'], "total_records_approx": result['total_records_approx']})
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         log_to_airtable('ERROR', 'Admin API', f'ERROR en admin_get_payments_history: {e}', details={'error_message': str(e), 'query_params': request.args})
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/admin/access_logs', methods=['GET'])
+@bp.route('/api/admin/access_logs', methods=['GET'])
 def admin_get_access_logs():
     if not api: return jsonify({"error": "Airtable no inicializada"}), 500
     try:
         page = int(request.args.get('page', 1))
         per_page = int(request.args.get('per_page', 20))  # Cambiado a 20
 
-        logs_table = api.table(BASE_ID, LOGS_TABLE_ID)
-        all_records = logs_table.all(sort=['-Timestamp']) # Obtener todos los registros, ordenados por Timestamp descendente
-        total_records = len(all_records)
-
-        # Implementar paginación manual
-        start_index = (page - 1) * per_page
-        end_index = start_index + per_page
-        paginated = all_records[start_index:end_index]
+        # Solo la página pedida, ordenada por Timestamp descendente (la tabla de logs crece todo el tiempo)
+        result = paginator.page(LOGS_TABLE_ID, ['-Timestamp'], per_page, page=page, cursor=request.args.get('cursor'))
+        total_records = result['total_records']
+        paginated = result['records']
         
         logs = []
         for record in paginated:
@@ -1895,12 +2093,15 @@ def admin_get_access_logs():
                 'details': fields.get('Details', None)
             })
         log_to_airtable('INFO', 'Admin API', f'Recuperados {len(logs)} registros de logs (pág {page}/{per_page}) para administrador.', details={'total_records': total_records, 'current_page': page, 'per_page': per_page})
-        return jsonify({"logs": logs, "total_records": total_records, "per_page": per_page}) # CORRECTED: "per_page"
+        return jsonify({"logs": logs, "total_records": total_records, "per_page": per_page, # CORRECTED: "per_page"
+                        "next_cursor": result['next_cursor'], "total_records_approx": result['total_records_approx']})
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         log_to_airtable('ERROR', 'Admin API', f'ERROR en admin_get_logs: {e}', details={'error_message': str(e), 'query_params': request.args})
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/admin/staff_access_logs', methods=['GET'])
+@bp.route('/api/admin/staff_access_logs', methods=['GET'])
 def admin_get_staff_access_logs():
     log_to_airtable('INFO', 'Admin API', 'Recuperando logs de acceso de personal para administrador.')
     if not api: return jsonify({"error": "Airtable no inicializada"}), 500
@@ -1908,14 +2109,9 @@ def admin_get_staff_access_logs():
         page = int(request.args.get('page', 1))
         per_page = int(request.args.get('per_page', 10)) # Asumo 10 registros por página
 
-        access_table = api.table(BASE_ID, ACCESOS_PERSONAL_TABLE_ID)
-        all_records = access_table.all(sort=['-Fecha', '-Hora']) # Ordenar por fecha y hora descendente
-        total_records = len(all_records)
-
-        # Implementar paginación manual
-        start_index = (page - 1) * per_page
-        end_index = start_index + per_page
-        paginated = all_records[start_index:end_index]
+        result = paginator.page(ACCESOS_PERSONAL_TABLE_ID, ['-Fecha', '-Hora'], per_page, page=page, cursor=request.args.get('cursor')) # Ordenar por fecha y hora descendente
+        total_records = result['total_records']
+        paginated = result['records']
         
         staff_access_logs = []
         for record in paginated:
@@ -1929,12 +2125,15 @@ def admin_get_staff_access_logs():
             })
         
         log_to_airtable('INFO', 'Admin API', f'Recuperados {len(staff_access_logs)} logs de acceso de personal (pág {page}/{per_page}) para administrador.', details={'total_records': total_records, 'current_page': page, 'per_page': per_page})
-        return jsonify({"logs": staff_access_logs, "total_records": total_records, "per_page": per_page})
+        return jsonify({"logs": staff_access_logs, "total_records": total_records, "per_page": per_page,
+                        "next_cursor": result['next_cursor'], "total_records_approx": result['total_records_approx']})
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         log_to_airtable('ERROR', 'Admin API', f'ERROR en admin_get_staff_access_logs: {e}', details={'error_message': str(e), 'query_params': request.args})
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/admin/stats-login', methods=['POST'])
+@bp.route('/api/admin/stats-login', methods=['POST'])
 def stats_login():
     data = request.json
     password = data.get('password')
@@ -1948,97 +2147,182 @@ def stats_login():
         return jsonify({"success": True}), 200
     return jsonify({"success": False, "message": "Clave incorrecta"}), 401
 
-@app.route('/api/admin/stats', methods=['GET'])
+@bp.route('/api/admin/stats', methods=['GET'])
 def get_stats():
     if not api: return jsonify({"error": "Airtable no conectado"}), 500
     
     try:
-        # 1. Obtener datos de las 3 tablas principales
-        historial_table = api.table(BASE_ID, HISTORIAL_TABLE_ID)
-        recaudacion_table = api.table(BASE_ID, RECAUDACION_TABLE_ID)
-        patente_table = api.table(BASE_ID, PATENTE_MANUAL_TABLE_ID)
-
-        # Filtros: Solo pagos exitosos/aprobados
-        pagos_web = historial_table.all(formula="Estado='Exitoso'")
-        pagos_recaudacion = recaudacion_table.all(formula="OR({Estado Pago}='Pagado', {Estado Pago}='Exitoso')")
-        pagos_patente = patente_table.all(formula="OR({Estado Pago}='Pagado', {Estado Pago}='Exitoso')")
-
-        # Estructura de agregación
-        stats = {
-            "total_2026": 0,
-            "counts": {"total": 0, "deudas": 0, "contributivos": 0, "recaudacion": 0, "patente": 0},
-            "totals_by_cat": {"deudas": 0, "contributivos": 0, "recaudacion": 0, "patente": 0},
-            "by_day": {}, # { "2026-01-14": { "total": 100, "count": 2 } }
-            "by_month": {}, # { "2026-01": 5000 }
-        }
+        # Los totales se mantienen al registrar cada pago; la primera vez se calculan desde Airtable
+        if not stats_rollup.is_built():
+            stats_rollup.rebuild(fetch_records)
+        return jsonify(stats_rollup.snapshot())
 
-        def process_record(amount, date_str, category):
-            try:
-                # Normalizar fecha (Airtable puede devolver '2026-01-14' o ISO)
-                date_obj = datetime.strptime(date_str[:10], '%Y-%m-%d')
-                day_key = date_obj.strftime('%Y-%m-%d')
-                month_key = date_obj.strftime('%Y-%m')
-                
-                amount = float(amount or 0)
-                
-                stats["total_2026"] += amount
-                stats["counts"]["total"] += 1
-                stats["counts"][category] += 1
-                stats["totals_by_cat"][category] += amount
-                
-                # Agrupar por día
-                if day_key not in stats["by_day"]: stats["by_day"][day_key] = {"total": 0, "count": 0}
-                stats["by_day"][day_key]["total"] += amount
-                stats["by_day"][day_key]["count"] += 1
-                
-                # Agrupar por mes
-                if month_key not in stats["by_month"]: stats["by_month"][month_key] = 0
-                stats["by_month"][month_key] += amount
-            except: pass
-
-        # Procesar Pagos Web (Determinar si es deuda o contributivo por el detalle)
-        for r in pagos_web:
-            f = r['fields']
-            cat = "deudas"
-            if "lote" in f.get('Detalle', '').lower() or "Contributivo" in f.get('Detalle', ''): cat = "contributivos"
-            # Usar Timestamp de creación si no hay fecha de transacción
-            date = f.get('Fecha de Transacción') or r.get('createdTime')
-            process_record(f.get('Monto'), date, cat)
-
-        # Procesar Recaudación Manual
-        for r in pagos_recaudacion:
-            f = r['fields']
-            process_record(f.get('Total'), f.get('Fecha'), "recaudacion")
-
-        # Procesar Patente Manual
-        for r in pagos_patente:
-            f = r['fields']
-            process_record(f.get('Total'), f.get('Fecha'), "patente")
-
-        # Formatear para Recharts (de Diccionario a Lista ordenada)
-        sorted_days = sorted(stats["by_day"].items())
-        recharts_day = [{"date": k, "total": v["total"], "cantidad": v["count"]} for k, v in sorted_days]
-        
-        sorted_months = sorted(stats["by_month"].items())
-        recharts_month = [{"month": k, "total": v} for k, v in sorted_months]
-
-        return jsonify({
-            "summary": {
-                "total_anual": stats["total_2026"],
-                "cantidad_operaciones": stats["counts"],
-                "totales_categoria": stats["totals_by_cat"]
-            },
-            "daily_chart": recharts_day,
-            "monthly_chart": recharts_month
-        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
+@bp.route('/api/admin/airtable_stats', methods=['GET'])
+def get_airtable_stats():
+    # Llamadas a Airtable por tabla (todas las instancias del gateway en esta máquina)
+    if not gateway: return jsonify({"error": "Airtable no conectado"}), 500
+    return jsonify({**gateway.stats(), "cache_padron": padron_cache.stats(), "log_shipper": log_shipper.stats(),
+                    "jobs": job_queue.stats(), "receipts": pdf_pool.stats(), "receipt_store": receipt_store.stats(),
+                    "contactos": contact_store.stats()})
+
+@bp.route('/api/airtable_webhook', methods=['POST'])
+def airtable_webhook():
+    # Airtable solo notifica; los cambios se leen de la lista de payloads del webhook
+    if not verify_webhook_signature(request.get_data(), request.headers.get('X-Airtable-Content-MAC')):
+        return jsonify({"error": "Firma inválida"}), 401
+    if not mirror:
+        return jsonify({"status": "mirror deshabilitado"}), 200
+    webhook_id = (request.json or {}).get('webhook', {}).get('id') or AIRTABLE_WEBHOOK_ID
+    if not webhook_id:
+        return jsonify({"error": "Sin ID de webhook"}), 400
+
+    def consume():
+        try:
+            applied = mirror.consume_webhook(webhook_id)
+            print(f"Webhook Airtable {webhook_id}: {applied} payloads aplicados al espejo.")
+        except Exception as e:
+            print(f"ERROR aplicando webhook de Airtable {webhook_id}: {e}")
+
+    threading.Thread(target=consume, name="airtable-webhook", daemon=True).start()
+    return jsonify({"status": "ok"}), 200
+
+@bp.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    # Estado de un cobro procesado en segundo plano: PDF, link de pago y email
+    job = job_queue.load(job_id)
+    if not job:
+        return jsonify({"error": "Job no encontrado"}), 404
+    response = {"status": job.status, "attempts": job.attempts, "kind": job.kind}
+    if job.kind == 'cobro':
+        # El PDF en base64 solo si se pide; si no, el link firmado para descargarlo
+        pdf_mode = 'inline' if request.args.get('include_pdf') == '1' else 'url'
+        response.update(cobro_response(job, COBROS[job.payload['kind']][2](job.payload['data']), pdf_mode))
+        if pdf_mode == 'url':
+            response.pop('pdf_base64', None)
+    return jsonify(response)
+
+@bp.route('/api/admin/webhooks', methods=['GET'])
+def admin_list_webhooks():
+    # ?status=dead para la lista de pagos que agotaron los reintentos
+    status = request.args.get('status')
+    limit = limit_arg(100, 500)
+    if limit is None:
+        return jsonify({"error": LIMIT_ARG_ERROR}), 400
+    return jsonify({"summary": webhook_queue.stats(), "payments": webhook_queue.payments(status, limit)})
+
+@bp.route('/api/admin/webhooks/<payment_id>/retry', methods=['POST'])
+def admin_retry_webhook(payment_id):
+    if not webhook_queue.retry(payment_id):
+        return jsonify({"error": "Pago no encontrado o en proceso"}), 404
+    return jsonify({"success": True})
+
+@bp.route('/api/admin/obligations', methods=['GET'])
+def admin_obligations():
+    # Pagos con coincidencias ambiguas o duplicadas para revisar a mano
+    limit = limit_arg(100, 500)
+    if limit is None:
+        return jsonify({"error": LIMIT_ARG_ERROR}), 400
+    return jsonify({"summary": obligation_index.stats(), "flags": obligation_index.flags(limit)})
+
+@bp.route('/api/admin/contactos/parked', methods=['GET'])
+def admin_parked_contacts():
+    # Contactos que Airtable rechazó (email inválido, Email repetido en la tabla)
+    limit = limit_arg(100, 500)
+    if limit is None:
+        return jsonify({"error": LIMIT_ARG_ERROR}), 400
+    return jsonify({"summary": contact_store.stats(), "contacts": contact_store.parked(limit)})
+
+@bp.route('/api/admin/mails', methods=['GET'])
+def admin_list_mails():
+    # ?status=dead para la lista de emails que agotaron los reintentos
+    status = request.args.get('status')
+    limit = limit_arg(100, 500)
+    if limit is None:
+        return jsonify({"error": LIMIT_ARG_ERROR}), 400
+    return jsonify({"summary": mail_queue.stats(), "mails": mail_queue.mails(status, limit)})
+
+@bp.route('/api/admin/mails/<int:mail_id>/retry', methods=['POST'])
+def admin_retry_mail(mail_id):
+    if not mail_queue.retry(mail_id):
+        return jsonify({"error": "Email no encontrado o no está en la lista de no enviados"}), 404
+    return jsonify({"success": True})
+
+@bp.route('/api/admin/mp_catchup', methods=['GET'])
+def admin_mp_catchup_runs():
+    limit = limit_arg(20, 100)
+    if limit is None:
+        return jsonify({"error": LIMIT_ARG_ERROR}), 400
+    return jsonify({"runs": mp_catchup.runs(limit)})
+
+@bp.route('/api/admin/mp_catchup/run', methods=['POST'])
+def admin_mp_catchup_run():
+    # ?dry_run=1 para solo listar los faltantes; ?hours= para otra ventana
+    if not api or not sdk:
+        return jsonify({"error": "Airtable o Mercado Pago no configurados"}), 500
+    hours = None
+    if request.args.get('hours'):
+        try:
+            hours = float(request.args['hours'])
+        except ValueError:
+            hours = 0
+        if not hours > 0:
+            return jsonify({"error": "El parámetro hours debe ser un número positivo"}), 400
+    try:
+        return jsonify(mp_catchup.run(hours=hours, dry_run=request.args.get('dry_run') == '1', source="admin"))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/test_cors', methods=['GET', 'POST', 'OPTIONS'])
+@bp.route('/api/admin/mirror/status', methods=['GET'])
+def admin_mirror_status():
+    if not mirror: return jsonify({"error": "Espejo local deshabilitado"}), 404
+    return jsonify(mirror.status())
+
+@bp.route('/api/admin/cache/invalidate', methods=['POST'])
+def admin_invalidate_cache():
+    # Invalidación explícita: un registro (record_id) o la tabla completa del padrón
+    data = request.json or {}
+    table_id = data.get('table_id')
+    if table_id not in padron_cache.tables:
+        return jsonify({"error": "Tabla no cacheada", "tablas": list(padron_cache.tables.keys())}), 400
+    padron_cache.invalidate(table_id, data.get('record_id'))
+    return jsonify({"success": True})
+
+@bp.route('/api/test_cors', methods=['GET', 'POST', 'OPTIONS'])
 def test_cors():
     return jsonify({"message": "CORS OK", "method": request.method}), 200
 
+PRELOAD_PADRON = os.getenv("PRELOAD_PADRON", "1") == "1"
+
+def warm_up():
+    """
+    Estado compartido que conviene cargar una sola vez en el master de gunicorn
+    (preload_app), antes del fork: los workers lo heredan por copy-on-write.
+    """
+    started = time.time()
+    if api and PRELOAD_PADRON:
+        # Padrón e índices de búsqueda: la primera búsqueda de cada worker ya no espera a Airtable
+        for cache in padron_cache.tables.values():
+            cache.refresh()
+    if PDF_POOL_WORKERS <= 0:
+        # Render en el mismo proceso: template, CSS y fuentes ya cargados en el master
+        from receipt_renderer import renderer
+        renderer.warm_up()
+    if gateway:
+        # Las conexiones abiertas en el master no se comparten con los workers
+        gateway.reset_connections()
+    print(f"Precarga del master completa en {time.time() - started:.2f}s.")
+
+def create_app():
+    app = Flask(__name__)
+    CORS(app, resources={r"/*": {"origins": cors_origins}}, supports_credentials=True)
+    app.register_blueprint(bp)
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 10000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""
+Comparación de los backends de comprobantes PDF (WeasyPrint y pydyf).
+
+Cada backend corre en un proceso aparte para medir su memoria por separado:
+tiempo de arranque (imports, template, fuentes), comprobantes por segundo,
+tamaño promedio del PDF y memoria máxima del proceso.
+
+    python bench_receipts.py            # ambos, 50 comprobantes
+    python bench_receipts.py -n 200 --items 15
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+BACKENDS = ("weasyprint", "native")
+
+
+def sample_details(items):
+    return {
+        "FECHA_PAGO": "01/01/2026 12:00:00",
+        "ESTADO_PAGO": "Pagado en Efectivo",
+        "ID_PAGO_MP": "EFEC-1767268800",
+        "items": [{"description": f"Tasa Municipal - Concepto {i + 1}", "amount": 1000 + i} for i in range(items)],
+        "MONTO_TOTAL": sum(1000 + i for i in range(items)),
+    }
+
+
+def max_rss_mb():
+    # ru_maxrss está en KB en Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_one(backend, n, items):
+    """Mide un backend en este proceso y devuelve el resultado."""
+    base_rss = max_rss_mb()
+    started = time.perf_counter()
+    if backend == "native":
+        from receipt_pdf_native import renderer
+    else:
+        from receipt_renderer import renderer
+    details = sample_details(items)
+    renderer.render(details, pdf_id="warm-up")
+    startup = time.perf_counter() - started
+
+    sizes = []
+    started = time.perf_counter()
+    for i in range(n):
+        pdf_file, _ = renderer.render(details, pdf_id=f"bench-{i}")
+        sizes.append(len(pdf_file.getvalue()))
+    elapsed = time.perf_counter() - started
+    return {
+        "backend": backend,
+        "receipts": n,
+        "startup_s": round(startup, 3),
+        "avg_ms": round(elapsed / n * 1000, 2),
+        "receipts_per_second": round(n / elapsed, 1),
+        "avg_bytes": sum(sizes) // n,
+        "max_rss_mb": max_rss_mb(),
+        "rss_growth_mb": round(max_rss_mb() - base_rss, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de backends de comprobantes PDF")
+    parser.add_argument("-n", type=int, default=50, help="Comprobantes por backend")
+    parser.add_argument("--items", type=int, default=5, help="Ítems por comprobante")
+    parser.add_argument("--backend", choices=BACKENDS, help="Medir solo este backend (en este proceso)")
+    args = parser.parse_args()
+
+    if args.backend:
+        print(json.dumps(run_one(args.backend, args.n, args.items)))
+        return
+
+    results = []
+    for backend in BACKENDS:
+        proc = subprocess.run(
+            [sys.executable, __file__, "--backend", backend, "-n", str(args.n), "--items", str(args.items)],
+            capture_output=True, text=True
+        )
+        lines = proc.stdout.strip().splitlines()
+        if proc.returncode != 0 or not lines:
+            print(f"ERROR midiendo {backend}: {proc.stderr.strip().splitlines()[-1:] or proc.returncode}")
+            continue
+        results.append(json.loads(lines[-1]))
+
+    columns = ("backend", "startup_s", "avg_ms", "receipts_per_second", "avg_bytes", "max_rss_mb")
+    print(" | ".join(f"{c:>19}" for c in columns))
+    for result in results:
+        print(" | ".join(f"{result[c]:>19}" for c in columns))
+    if len(results) == 2:
+        weasy, native = results
+        print(f"\npydyf vs WeasyPrint: {weasy['avg_ms'] / native['avg_ms']:.1f}x más rápido, "
+              f"{weasy['max_rss_mb'] / native['max_rss_mb']:.1f}x menos memoria")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Tiempo de arranque del backend con y sin imports diferidos (LAZY_IMPORTS).
+
+Cada variante corre en un proceso aparte: mide `import app` (lo que paga cada
+worker sin preload_app, o el master con preload), la memoria máxima del
+proceso, qué dependencias pesadas quedaron cargadas y los módulos más lentos
+según `python -X importtime`.
+
+    python bench_startup.py             # comparación eager vs lazy
+    python bench_startup.py --top 15    # más módulos en el detalle
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+MODES = {"eager": "0", "lazy": "1"}
+HEAVY_MODULES = ("weasyprint", "mercadopago", "pydyf", "pyairtable", "resend", "flask")
+
+
+def max_rss_mb():
+    # ru_maxrss está en KB en Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_one(mode):
+    """Importa la app en este proceso (LAZY_IMPORTS ya viene en el entorno) y devuelve el resultado."""
+    started = time.perf_counter()
+    import app  # noqa: F401
+    elapsed = time.perf_counter() - started
+
+    from lazy_imports import is_loaded
+    return {
+        "mode": mode,
+        "import_s": round(elapsed, 3),
+        "max_rss_mb": max_rss_mb(),
+        "modules": len(sys.modules),
+        "loaded": [name for name in HEAVY_MODULES if is_loaded(name)],
+    }
+
+
+def slowest_imports(env, top):
+    """Los `top` módulos con mayor tiempo acumulado según -X importtime."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                          capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    rows = []
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split(":", 1)[1].split("|")
+        # Solo lo que importa app directamente (cada uno ya incluye sus dependencias)
+        if len(name) - len(name.lstrip()) != 3:
+            continue
+        rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de arranque del backend")
+    parser.add_argument("--mode", choices=MODES, help="Medir solo esta variante (en este proceso)")
+    parser.add_argument("--top", type=int, default=10, help="Módulos a mostrar de -X importtime")
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_one(args.mode)))
+        return
+
+    results = []
+    for mode, flag in MODES.items():
+        env = {**os.environ, "LAZY_IMPORTS": flag}
+        proc = subprocess.run([sys.executable, __file__, "--mode", mode], capture_output=True, text=True, env=env)
+        lines = proc.stdout.strip().splitlines()
+        if proc.returncode != 0 or not lines:
+            print(f"ERROR midiendo {mode}: {proc.stderr.strip().splitlines()[-1:] or proc.returncode}")
+            continue
+        result = json.loads(lines[-1])
+        result["slowest"] = slowest_imports(env, args.top)
+        results.append(result)
+
+    columns = ("mode", "import_s", "max_rss_mb", "modules")
+    print(" | ".join(f"{c:>12}" for c in columns) + " | cargados")
+    for result in results:
+        print(" | ".join(f"{result[c]:>12}" for c in columns) + f" | {', '.join(result['loaded'])}")
+    for result in results:
+        print(f"\n{result['mode']}: imports más lentos (acumulado)")
+        for cumulative, name in result["slowest"]:
+            print(f"  {cumulative / 1000:>9.1f} ms  {name}")
+    if len(results) == 2:
+        eager, lazy = results
+        print(f"\nlazy vs eager: {eager['import_s'] - lazy['import_s']:.2f}s menos de arranque, "
+              f"{eager['max_rss_mb'] - lazy['max_rss_mb']:.1f} MB menos de memoria")
+
+
+if __name__ == "__main__":
+    main()
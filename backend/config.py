@@ -0,0 +1,30 @@
+"""
+IDs de la base y las tablas de Airtable, compartidos por app.py y las
+herramientas de línea de comandos (espejo local, scripts de mantenimiento).
+"""
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BASE_ID = "appoJs8XY2j2kwlYf"
+CONTRIBUTIVOS_TABLE_ID = "tblKbSq61LU1XXco0"
+DEUDAS_TABLE_ID = "tblHuS8CdqVqTsA3t"
+PATENTE_TABLE_ID = "tbl3CMMwccWeo8XSG"
+HISTORIAL_TABLE_ID = "tbl5p19Hv4cMk9NUS"
+LOGS_TABLE_ID = "tblLihQ9FmU6JD7NR"
+RECAUDACION_TABLE_ID = os.getenv("RECAUDACION_TABLE_ID", "tblzRhxpeqbuhrf78")
+PATENTE_MANUAL_TABLE_ID = os.getenv("PATENTE_MANUAL_TABLE_ID", "tblO0nlUQx3isKkXF")
+PLAN_PAGO_TABLE_ID = os.getenv("PLAN_PAGO_TABLE_ID", "tblMNNvOBuqQiCFqC")
+CONTACTOS_TABLE_ID = os.getenv("CONTACTOS_TABLE_ID", "tbl1ZcfxyaJtXPdPl")
+ACCESOS_PERSONAL_TABLE_ID = os.getenv("ACCESOS_PERSONAL_TABLE_ID", "tblAILbaYmnWkkPiV")
+WATER_TABLE_ID = "tblTgcF3XczjkpK3H" # ID de la tabla de Agua
+EFECTIVO_TABLE_ID = os.getenv("EFECTIVO_TABLE_ID", "tblXqPkaVnF9GHGdI") # ID de la tabla de Pagos Efectivo
+
+# Todas las tablas anteriores por nombre corto, ej. {"HISTORIAL": "tbl5p19Hv4cMk9NUS", ...}
+TABLE_IDS = {
+    name[:-len("_TABLE_ID")]: value
+    for name, value in list(globals().items())
+    if name.endswith("_TABLE_ID")
+}
@@ -0,0 +1,285 @@
+"""
+Alta y actualización de contactos (tabla Contactos) en segundo plano.
+
+`save_contacto` ya no busca el email en Airtable en cada pago: deja la
+actividad en una cola SQLite y un thread por worker la envía cada
+CONTACTOS_FLUSH_INTERVAL segundos con `batch_upsert` (clave Email).
+
+- Coalescencia: varias actividades del mismo email antes del envío quedan en
+  una sola fila (último origen, última actividad, el primer nombre conocido),
+  compartida por todos los workers: una ráfaga es una sola actualización.
+- Índice local email -> record id (y si el contacto ya tiene Nombre), cargado
+  una vez de la tabla y mantenido con las respuestas del upsert. Con él se
+  respeta lo que hacía la versión anterior: Fecha Registro solo al crear y
+  Nombre solo si estaba vacío.
+- Si Airtable falla, las filas vuelven a la cola y se reintenta con espera
+  exponencial.
+- Si Airtable rechaza el lote (422: un email inválido, un Email repetido en la
+  tabla), se parte en mitades hasta aislar las filas rechazadas: esas quedan
+  apartadas en `parked` (y se avisan con on_reject) y el resto se envía.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+
+from local_store import data_path, open_db, transaction
+
+CONTACTOS_STORE_PATH = os.getenv("CONTACTOS_STORE_PATH", data_path("contactos.sqlite3"))
+CONTACTOS_FLUSH_INTERVAL = float(os.getenv("CONTACTOS_FLUSH_INTERVAL", "5"))  # segundos
+CONTACTOS_INDEX_TTL = float(os.getenv("CONTACTOS_INDEX_TTL", "86400"))  # recarga completa del índice
+FLUSH_LIMIT = 100  # Filas por envío (batch_upsert las parte de a 10)
+MAX_BACKOFF_SECONDS = 300
+REJECTED_STATUS = (400, 422)  # Airtable rechaza el contenido: reintentar no cambia nada
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contacts (
+    email TEXT PRIMARY KEY,
+    record_id TEXT NOT NULL,
+    has_nombre INTEGER NOT NULL DEFAULT 0,
+    origen TEXT
+);
+CREATE TABLE IF NOT EXISTS pending (
+    email TEXT PRIMARY KEY,
+    nombre TEXT,
+    origen TEXT,
+    activity_at TEXT NOT NULL,
+    events INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS parked (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL,
+    nombre TEXT,
+    origen TEXT,
+    activity_at TEXT NOT NULL,
+    error TEXT,
+    parked_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Misma fila pendiente por email: se combinan las actividades que llegan antes del envío
+MERGE_PENDING = """
+INSERT INTO pending (email, nombre, origen, activity_at, events) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(email) DO UPDATE SET
+    nombre = COALESCE(pending.nombre, excluded.nombre),
+    origen = COALESCE(excluded.origen, pending.origen),
+    activity_at = MAX(pending.activity_at, excluded.activity_at),
+    events = pending.events + excluded.events
+"""
+
+
+class ContactStore:
+    def __init__(self, upsert, loader, path=CONTACTOS_STORE_PATH, interval=CONTACTOS_FLUSH_INTERVAL,
+                 on_flush=None, on_reject=None):
+        self.upsert = upsert  # upsert(records) -> respuesta de batch_upsert
+        self.loader = loader  # () -> todos los records de Contactos
+        self.on_flush = on_flush  # on_flush(created, updated)
+        self.on_reject = on_reject  # on_reject(email, error)
+        self.path = path
+        self.interval = interval
+        self.counters = {"saved": 0, "created": 0, "updated": 0, "coalesced": 0, "errors": 0, "parked": 0}
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread_pid = None
+        self._thread_lock = threading.Lock()
+        self._failures = 0
+        self._retry_at = 0
+        with open_db(self.path) as conn:
+            conn.executescript(SCHEMA)
+
+    # --- Lado del request: solo SQLite local ---
+
+    def save(self, email, nombre=None, origen=None):
+        email = (email or "").strip()
+        if not email:
+            return
+        self._ensure_thread()
+        with open_db(self.path) as conn:
+            conn.execute(MERGE_PENDING, (email, nombre or None, origen or None, _now(), 1))
+        self.counters["saved"] += 1
+
+    def _ensure_thread(self):
+        # Un thread por proceso, arrancado después del fork de gunicorn
+        if self._thread_pid == os.getpid():
+            return
+        with self._thread_lock:  # Varios requests a la vez con workers gthread
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, name="contactos", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if time.time() < self._retry_at:
+                continue
+            try:
+                self.flush()
+            except Exception as e:
+                self.counters["errors"] += 1
+                self._failures += 1
+                delay = min(MAX_BACKOFF_SECONDS, self.interval * 2 ** self._failures)
+                self._retry_at = time.time() + delay
+                print(f"ERROR guardando contactos en Airtable ({e}). Reintento en {delay:.0f}s.")
+
+    # --- Índice ---
+
+    def load_index(self, force=False):
+        """Carga email -> record id de toda la tabla (una vez, o si pasó CONTACTOS_INDEX_TTL)."""
+        with open_db(self.path) as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'loaded_at'").fetchone()
+        if row and not force and time.time() - float(row["value"]) < CONTACTOS_INDEX_TTL:
+            return False
+        records = self.loader()
+        rows = [
+            (fields["Email"].strip(), record["id"], 1 if fields.get("Nombre") else 0, fields.get("Origen"))
+            for record in records
+            for fields in [record.get("fields", {})]
+            if (fields.get("Email") or "").strip()
+        ]
+        with open_db(self.path) as conn, transaction(conn):
+            conn.execute("DELETE FROM contacts")
+            conn.executemany("INSERT OR REPLACE INTO contacts (email, record_id, has_nombre, origen) VALUES (?, ?, ?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('loaded_at', ?)", (str(time.time()),))
+        print(f"Contactos: índice local cargado con {len(rows)} emails.")
+        return True
+
+    def record_id(self, email):
+        with open_db(self.path) as conn:
+            row = conn.execute("SELECT record_id FROM contacts WHERE email = ?", ((email or "").strip(),)).fetchone()
+        return row["record_id"] if row else None
+
+    # --- Envío ---
+
+    def _claim(self):
+        # Las filas se sacan de la cola al tomarlas: otro worker no las envía de nuevo
+        with open_db(self.path) as conn, transaction(conn):
+            rows = conn.execute(
+                """SELECT p.*, c.record_id, c.has_nombre, c.origen AS known_origen
+                   FROM pending p LEFT JOIN contacts c ON c.email = p.email
+                   ORDER BY p.activity_at LIMIT ?""",
+                (FLUSH_LIMIT,)
+            ).fetchall()
+            conn.executemany("DELETE FROM pending WHERE email = ?", [(row["email"],) for row in rows])
+        return rows
+
+    def _requeue(self, rows):
+        with open_db(self.path) as conn, transaction(conn):
+            conn.executemany(MERGE_PENDING, [
+                (row["email"], row["nombre"], row["origen"], row["activity_at"], row["events"]) for row in rows
+            ])
+
+    def flush(self):
+        """Envía la actividad pendiente. Devuelve (creados, actualizados)."""
+        with self._flush_lock:
+            self.load_index()
+            created = updated = 0
+            while True:
+                rows = self._claim()
+                if not rows:
+                    break
+                try:
+                    results = self._upsert(rows)
+                except Exception:
+                    self._requeue(rows)
+                    raise
+                for sent, result in results:
+                    self._index(sent, result)
+                    created += len(result.get("createdRecords", []))
+                    updated += len(result.get("updatedRecords", []))
+                self.counters["coalesced"] += sum(row["events"] - 1 for row in rows)
+                if len(rows) < FLUSH_LIMIT:
+                    break
+            self._failures = 0
+        self.counters["created"] += created
+        self.counters["updated"] += updated
+        if (created or updated) and self.on_flush:
+            self.on_flush(created, updated)
+        return created, updated
+
+    def _upsert(self, rows):
+        """
+        Upsert de las filas. Devuelve [(filas, respuesta)]; si Airtable rechaza el
+        lote, lo parte hasta aislar las filas rechazadas y las aparta. Los errores
+        transitorios (red, 429, 5xx) se propagan: todo el lote vuelve a la cola.
+        """
+        try:
+            return [(rows, self.upsert([{"fields": _fields(row)} for row in rows]))]
+        except Exception as e:
+            if _status(e) not in REJECTED_STATUS:
+                raise
+            if len(rows) == 1:
+                self._park(rows[0], e)
+                return []
+            half = len(rows) // 2
+            # Lo ya enviado de una mitad no se repite si falla la otra: upsert por Email es idempotente
+            return self._upsert(rows[:half]) + self._upsert(rows[half:])
+
+    def _park(self, row, error):
+        with open_db(self.path) as conn:
+            conn.execute(
+                "INSERT INTO parked (email, nombre, origen, activity_at, error, parked_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (row["email"], row["nombre"], row["origen"], row["activity_at"], str(error)[:1000], time.time())
+            )
+        self.counters["parked"] += 1
+        print(f"ERROR: Airtable rechazó el contacto {row['email']}, queda apartado: {error}")
+        if self.on_reject:
+            try:
+                self.on_reject(row["email"], error)
+            except Exception as e:
+                print(f"ERROR avisando el contacto rechazado {row['email']}: {e}")
+
+    def parked(self, limit=100):
+        with open_db(self.path) as conn:
+            rows = conn.execute("SELECT * FROM parked ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def _index(self, rows, result):
+        by_email = {row["email"]: row for row in rows}
+        entries = []
+        for record in result.get("records", []):
+            fields = record.get("fields", {})
+            email = (fields.get("Email") or "").strip()
+            row = by_email.get(email)
+            if row is None:
+                continue
+            has_nombre = bool(fields.get("Nombre") or row["nombre"] or row["has_nombre"])
+            entries.append((email, record["id"], 1 if has_nombre else 0, fields.get("Origen", row["origen"])))
+        with open_db(self.path) as conn:
+            conn.executemany("INSERT OR REPLACE INTO contacts (email, record_id, has_nombre, origen) VALUES (?, ?, ?, ?)", entries)
+
+    def stats(self):
+        with open_db(self.path) as conn:
+            pending = conn.execute("SELECT COUNT(*) AS n FROM pending").fetchone()["n"]
+            indexed = conn.execute("SELECT COUNT(*) AS n FROM contacts").fetchone()["n"]
+            parked = conn.execute("SELECT COUNT(*) AS n FROM parked").fetchone()["n"]
+        return {**self.counters, "pending": pending, "indexed": indexed, "parked_total": parked,
+                "retry_in": max(0, round(self._retry_at - time.time()))}
+
+
+def _fields(row):
+    """Campos del upsert, con las mismas reglas que el alta/actualización de antes."""
+    fields = {"Email": row["email"], "Ultima Actividad": row["activity_at"]}
+    if row["record_id"] is None:
+        fields["Fecha Registro"] = row["activity_at"]
+    if row["nombre"] and not row["has_nombre"]:
+        fields["Nombre"] = row["nombre"]
+    if row["origen"] and row["origen"] != row["known_origen"]:
+        fields["Origen"] = row["origen"]
+    return fields
+
+
+def _status(error):
+    """Código HTTP de un error de pyairtable/requests, o None si no hubo respuesta."""
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def _now():
+    return datetime.now().isoformat()
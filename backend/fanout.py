@@ -0,0 +1,79 @@
+"""
+Ejecución concurrente de pasos independientes (I/O) en un pool acotado.
+
+    results = run_parallel({
+        'pdf': (lambda deps: generar_pdf(), ()),
+        'mp': (lambda deps: crear_preferencia(), ()),
+        'airtable': (lambda deps: guardar(deps['mp']), ('mp',)),  # espera a 'mp'
+    }, timeouts={'pdf': 20})
+
+Cada paso arranca apenas terminan sus dependencias (bien o mal) y tiene su
+propio timeout, contado desde que arranca. La latencia total es la de la
+cadena más lenta, no la suma de los pasos. Un paso que vence su timeout se
+informa como fallido; su thread no se puede cortar y termina en segundo plano.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "8"))
+DEFAULT_STEP_TIMEOUT = 30  # segundos
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Pool compartido del proceso (se recrea después del fork de gunicorn)."""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def run_parallel(tasks, timeouts=None, default_timeout=DEFAULT_STEP_TIMEOUT):
+    """
+    tasks: {nombre: (fn, dependencias)}; fn recibe {dependencia: resultado}.
+    Devuelve {nombre: {"ok", "result" | "error", "elapsed_ms"[, "timeout"]}}.
+    """
+    timeouts = timeouts or {}
+    executor = get_executor()
+    results = {}
+    pending = dict(tasks)
+    running = {}  # future -> (nombre, inicio)
+
+    def limit(name):
+        return timeouts.get(name, default_timeout)
+
+    def elapsed_ms(started):
+        return int((time.monotonic() - started) * 1000)
+
+    def submit_ready():
+        for name, (fn, deps) in list(pending.items()):
+            if all(dep in results or dep not in tasks for dep in deps):
+                del pending[name]
+                deps_results = {dep: results.get(dep) for dep in deps}
+                running[executor.submit(fn, deps_results)] = (name, time.monotonic())
+
+    submit_ready()
+    while running:
+        deadline = min(started + limit(name) for name, started in running.values())
+        done, _ = wait(list(running), timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        for future in done:
+            name, started = running.pop(future)
+            try:
+                results[name] = {"ok": True, "result": future.result(), "elapsed_ms": elapsed_ms(started)}
+            except Exception as e:
+                results[name] = {"ok": False, "error": str(e), "elapsed_ms": elapsed_ms(started)}
+        for future, (name, started) in list(running.items()):
+            if time.monotonic() - started >= limit(name):
+                running.pop(future)
+                results[name] = {"ok": False, "timeout": True, "error": f"Sin respuesta después de {limit(name)}s",
+                                 "elapsed_ms": elapsed_ms(started)}
+        submit_ready()
+    return results
@@ -0,0 +1,43 @@
+# Configuración de gunicorn (se carga automáticamente desde backend/)
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+
+# Los endpoints pasan casi todo el tiempo esperando a Airtable, Mercado Pago,
+# Payway o Resend: workers con threads (gthread) atienden varios requests a la vez
+# por proceso mientras los otros esperan la red. Capacidad = workers x threads.
+# Los clientes compartidos son seguros entre threads (sesión de Airtable con
+# pool y token bucket con lock, la SDK de MP y Resend abren una sesión por
+# llamada, el render con WeasyPrint va serializado o en el pool de procesos).
+# GUNICORN_WORKER_CLASS=sync vuelve al modelo anterior (un request por proceso).
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Con threads > 1 gunicorn pasa a gthread aunque se pida sync
+threads = int(os.getenv("GUNICORN_THREADS", "8")) if worker_class == "gthread" else 1
+# Con gthread el timeout vigila al worker, no a cada request: un Airtable lento no reinicia el proceso
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
+
+# La app se importa en el master y los workers la heredan con el fork: padrón,
+# índices de búsqueda y (con PDF_POOL_WORKERS=0) el template de comprobantes con
+# sus fuentes se cargan una sola vez (app.warm_up).
+# Los threads de fondo arrancan recién en cada worker (start_background_workers).
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    import gc
+    import app
+    app.warm_up()
+    # Lo cargado hasta acá queda fuera del GC: recorrerlo en los workers tocaría
+    # las páginas compartidas y las copiaría
+    gc.freeze()
+
+
+def worker_exit(server, worker):
+    # Enviar los logs que quedaron en cola antes de que termine el worker
+    import log_shipper
+    log_shipper.flush_all()
@@ -0,0 +1,214 @@
+"""
+Registro de Historial armado en memoria y escrito en Airtable una sola vez.
+
+`process_payment` acumula los campos del registro en un `HistorialBuilder`
+(estado, ítems, PDF_ID, link del comprobante, estado del email) y al final
+hace un único `create`. Cada paso se guarda también en un journal SQLite local:
+
+- Si el proceso muere a mitad de camino, el reintento del mismo pago retoma la
+  entrada pendiente con el mismo PDF_ID y no repite los pasos ya hechos
+  (actualización de la deuda, envío del comprobante). Solo si es el mismo
+  estado de MP: una entrada de otro estado (p. ej. 'pending' cuando llega
+  'approved') queda reemplazada ('superseded') y se arma una nueva.
+- Las entradas que quedaron listas pero sin escribir en Airtable se escriben
+  con `replay()` (thread periódico, o `python historial_journal.py --replay`).
+- El comprobante se puede regenerar desde el journal por PDF_ID sin consultar
+  Airtable.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+
+from local_store import data_path, open_db, transaction
+
+HISTORIAL_JOURNAL_PATH = os.getenv("HISTORIAL_JOURNAL_PATH", data_path("historial_journal.sqlite3"))
+# Una entrada 'ready' sin escribir después de esto se considera abandonada
+REPLAY_AFTER_SECONDS = 300
+REPLAY_INTERVAL_SECONDS = 300
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    pdf_id TEXT PRIMARY KEY,
+    payment_id TEXT NOT NULL,
+    mp_status TEXT,
+    status TEXT NOT NULL,
+    fields_json TEXT NOT NULL DEFAULT '{}',
+    steps_json TEXT NOT NULL DEFAULT '{}',
+    historial_id TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_payment ON entries (payment_id, status);
+CREATE INDEX IF NOT EXISTS entries_status ON entries (status, updated_at);
+"""
+
+
+class HistorialBuilder:
+    """Campos de un registro de Historial, persistidos en el journal a cada paso."""
+
+    def __init__(self, journal, row):
+        self.journal = journal
+        self.pdf_id = row["pdf_id"]
+        self.payment_id = row["payment_id"]
+        self.status = row["status"]
+        self.fields = json.loads(row["fields_json"])
+        self.steps = json.loads(row["steps_json"])
+        self.historial_id = row["historial_id"]
+        self.created_at = row["created_at"]
+        self.resumed = bool(self.steps) or self.status != "building"
+
+    def update(self, fields):
+        self.fields.update(fields)
+
+    def done(self, step):
+        return step in self.steps
+
+    def step(self, name, **data):
+        """Marca un paso como hecho (con sus datos) y lo persiste."""
+        self.steps[name] = data
+        self.save()
+
+    def save(self, status=None):
+        if status:
+            self.status = status
+        self.journal._save(self)
+
+    def commit(self, create, find_existing=None):
+        """
+        Escribe el registro con un solo `create(fields)` y devuelve el record.
+        Si la entrada viene de un intento anterior, primero busca con
+        `find_existing(pdf_id)` por si el create ya se había hecho.
+        """
+        if self.status == "committed":
+            return {"id": self.historial_id, "fields": self.fields}
+        self.save(status="ready")
+        record = find_existing(self.pdf_id) if (self.resumed and find_existing) else None
+        if not record:
+            record = create(self.fields)
+        self.historial_id = record["id"]
+        self.save(status="committed")
+        return record
+
+
+class HistorialJournal:
+    def __init__(self, path=HISTORIAL_JOURNAL_PATH):
+        self.path = path
+        self._thread_pid = None
+        with open_db(self.path) as conn:
+            conn.executescript(SCHEMA)
+            # Journals creados antes de guardar el estado de MP
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(entries)")}
+            if "mp_status" not in columns:
+                conn.execute("ALTER TABLE entries ADD COLUMN mp_status TEXT")
+
+    def begin(self, payment_id, mp_status=None):
+        """
+        Entrada en curso para el pago con el mismo estado de MP (si un intento
+        anterior no terminó) o una nueva con PDF_ID propio. Las entradas sin
+        terminar de otro estado quedan 'superseded': sus pasos (comprobante,
+        email) eran de ese estado y no se reaprovechan.
+        """
+        payment_id = str(payment_id)
+        now = time.time()
+        with open_db(self.path) as conn, transaction(conn):
+            row = conn.execute(
+                """SELECT * FROM entries WHERE payment_id = ? AND status NOT IN ('committed', 'superseded')
+                   ORDER BY created_at DESC LIMIT 1""",
+                (payment_id,)
+            ).fetchone()
+            if row is not None and row["mp_status"] != mp_status:
+                conn.execute(
+                    """UPDATE entries SET status = 'superseded', updated_at = ?
+                       WHERE payment_id = ? AND status NOT IN ('committed', 'superseded')""",
+                    (now, payment_id)
+                )
+                print(f"Journal de Historial: entrada {row['pdf_id']} del pago {payment_id} "
+                      f"({row['mp_status']}) reemplazada por el estado {mp_status}.")
+                row = None
+            if row is None:
+                pdf_id = str(uuid.uuid4())
+                conn.execute(
+                    """INSERT INTO entries (pdf_id, payment_id, mp_status, status, created_at, updated_at)
+                       VALUES (?, ?, ?, 'building', ?, ?)""",
+                    (pdf_id, payment_id, mp_status, now, now)
+                )
+                row = conn.execute("SELECT * FROM entries WHERE pdf_id = ?", (pdf_id,)).fetchone()
+        return HistorialBuilder(self, row)
+
+    def _save(self, builder):
+        with open_db(self.path) as conn:
+            conn.execute(
+                "UPDATE entries SET status = ?, fields_json = ?, steps_json = ?, historial_id = ?, updated_at = ? WHERE pdf_id = ?",
+                (builder.status, json.dumps(builder.fields), json.dumps(builder.steps), builder.historial_id, time.time(), builder.pdf_id)
+            )
+
+    def find(self, pdf_id):
+        """Builder de la entrada con ese PDF_ID, o None."""
+        with open_db(self.path) as conn:
+            row = conn.execute("SELECT * FROM entries WHERE pdf_id = ?", (pdf_id,)).fetchone()
+        return HistorialBuilder(self, row) if row else None
+
+    def replay(self, create, find_existing, older_than=REPLAY_AFTER_SECONDS):
+        """Escribe en Airtable las entradas listas que quedaron sin confirmar. Devuelve cuántas."""
+        with open_db(self.path) as conn:
+            rows = conn.execute(
+                "SELECT * FROM entries WHERE status = 'ready' AND updated_at < ?", (time.time() - older_than,)
+            ).fetchall()
+        written = 0
+        for row in rows:
+            builder = HistorialBuilder(self, row)
+            try:
+                builder.commit(create, find_existing)
+                written += 1
+                print(f"Journal de Historial: registro del pago {builder.payment_id} escrito ({builder.historial_id}).")
+            except Exception as e:
+                print(f"ERROR escribiendo registro pendiente del pago {builder.payment_id}: {e}")
+        return written
+
+    def start_periodic_replay(self, create, find_existing, interval=REPLAY_INTERVAL_SECONDS):
+        """Thread de replay, uno por proceso (después del fork)."""
+        if self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.replay(create, find_existing)
+
+        threading.Thread(target=run, name="historial-journal", daemon=True).start()
+
+    def stats(self):
+        with open_db(self.path) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM entries GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+
+def main():
+    from pyairtable.formulas import match
+
+    from airtable_gateway import AirtableGateway
+    from config import BASE_ID, HISTORIAL_TABLE_ID
+
+    parser = argparse.ArgumentParser(description="Journal local de registros de Historial")
+    parser.add_argument("--replay", action="store_true", help="Escribir en Airtable las entradas pendientes")
+    args = parser.parse_args()
+
+    journal = HistorialJournal()
+    if args.replay:
+        token = os.getenv("AIRTABLE_PAT")
+        if not token:
+            print("ERROR: AIRTABLE_PAT no configurado")
+            raise SystemExit(1)
+        table = AirtableGateway(token).api.table(BASE_ID, HISTORIAL_TABLE_ID)
+        written = journal.replay(table.create, lambda pdf_id: table.first(formula=match({"PDF_ID": pdf_id})), older_than=0)
+        print(f"{written} registros escritos.")
+    print(json.dumps(journal.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Trabajos en segundo plano persistidos en SQLite.
+
+Un job guarda el pedido original (payload) y el resultado de cada paso. Los
+pasos ya completados no se repiten: si el worker muere o un paso pide
+reintento, el job vuelve a la cola y retoma desde el primer paso pendiente.
+
+    job = job_queue.create('cobro', {...})   # queda 'pending', no lo toma nadie
+    job.step('pdf', lambda: {...})          # se puede correr parte en el request
+    job.enqueue()                           # el resto lo hacen los workers
+
+Los workers son threads dentro de cada proceso de gunicorn (JOB_WORKERS por
+proceso); los jobs se reparten entre procesos con la base compartida.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+from local_store import data_path, open_db, transaction
+
+JOBS_PATH = os.getenv("JOBS_PATH", data_path("jobs.sqlite3"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # threads por proceso
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Un job 'running' sin novedades por más de esto se considera abandonado (worker caído)
+JOB_STALE_SECONDS = 600
+JOB_RETENTION_DAYS = 7
+POLL_SECONDS = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload_json TEXT NOT NULL,
+    steps_json TEXT NOT NULL DEFAULT '{}',
+    result_json TEXT NOT NULL DEFAULT '{}',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after);
+"""
+
+
+class RetryJob(Exception):
+    """Lanzarla desde un handler para reintentar el job más tarde (con espera exponencial)."""
+
+
+class Job:
+    def __init__(self, queue, row):
+        self.queue = queue
+        self.id = row["id"]
+        self.kind = row["kind"]
+        self.status = row["status"]
+        self.payload = json.loads(row["payload_json"])
+        self.steps = json.loads(row["steps_json"])
+        self.result = json.loads(row["result_json"])
+        self.attempts = row["attempts"]
+        self._lock = threading.Lock()  # Los pasos pueden correr en paralelo (ver fanout)
+
+    def step(self, name, fn):
+        """
+        Ejecuta un paso una sola vez. `fn()` devuelve un dict con el resultado (o None);
+        si levanta una excepción el paso queda como fallido y se puede reintentar.
+        Mientras corre queda marcado como 'running' y nadie más lo ejecuta.
+        """
+        done = self.steps.get(name)
+        if done and (done.get("ok") or self.step_running(name)):
+            return done
+        started = time.time()
+        self._update(self.steps, name, {"ok": False, "running": True, "started_at": started})
+        try:
+            outcome = {"ok": True, **(fn() or {})}
+        except Exception as e:
+            outcome = {"ok": False, "error": str(e)}
+        outcome["ms"] = int((time.time() - started) * 1000)
+        self._update(self.steps, name, outcome)
+        return outcome
+
+    def step_running(self, name):
+        """True si el paso está en curso (en este u otro proceso) y no quedó abandonado."""
+        step = self.steps.get(name) or {}
+        return bool(step.get("running")) and time.time() - step.get("started_at", 0) < JOB_STALE_SECONDS
+
+    def set_result(self, key, value):
+        self._update(self.result, key, value)
+
+    def _update(self, target, key, value):
+        # Modificar y guardar bajo el lock: otro paso puede estar serializando el job
+        with self._lock:
+            target[key] = value
+            self.queue._save(self)
+
+    def save(self):
+        with self._lock:
+            self.queue._save(self)
+
+    def enqueue(self):
+        self.queue._set_status(self.id, "queued")
+        self.status = "queued"
+
+
+class JobQueue:
+    def __init__(self, path=JOBS_PATH, workers=JOB_WORKERS):
+        self.path = path
+        self.workers = workers
+        self.handlers = {}  # kind -> handler(job)
+        self._wakeup = threading.Event()
+        self._thread_pid = None
+        with open_db(self.path) as conn:
+            conn.executescript(SCHEMA)
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    # --- Alta y consulta ---
+
+    def create(self, kind, payload):
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with open_db(self.path) as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, payload_json, created_at, updated_at) VALUES (?, ?, 'pending', ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), now, now)
+            )
+        return self.load(job_id)
+
+    def submit(self, kind, payload):
+        """Crea el job y lo deja listo para los workers."""
+        job = self.create(kind, payload)
+        job.enqueue()
+        return job
+
+    def load(self, job_id):
+        with open_db(self.path) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(self, row) if row else None
+
+    def _save(self, job):
+        with open_db(self.path) as conn:
+            conn.execute(
+                "UPDATE jobs SET steps_json = ?, result_json = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(job.steps), json.dumps(job.result), time.time(), job.id)
+            )
+
+    def _set_status(self, job_id, status, **extra):
+        sets = ", ".join(f"{col} = ?" for col in extra)
+        with open_db(self.path) as conn:
+            conn.execute(
+                f"UPDATE jobs SET status = ?, updated_at = ?{', ' + sets if sets else ''} WHERE id = ?",
+                (status, time.time(), *extra.values(), job_id)
+            )
+        if status == "queued":
+            self._wakeup.set()
+
+    # --- Workers ---
+
+    def start_workers(self):
+        """Arranca los threads una vez por proceso (después del fork de gunicorn)."""
+        if self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        try:
+            self.purge()
+        except Exception as e:
+            print(f"ADVERTENCIA: No se pudieron purgar jobs viejos: {e}")
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True).start()
+
+    def _claim(self):
+        now = time.time()
+        with open_db(self.path) as conn, transaction(conn):
+            # Jobs de un worker caído (o de un request que murió antes de encolar) vuelven a la cola
+            conn.execute(
+                "UPDATE jobs SET status = 'queued' WHERE status IN ('running', 'pending') AND updated_at < ?",
+                (now - JOB_STALE_SECONDS,)
+            )
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ? ORDER BY created_at LIMIT 1", (now,)
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (now, row["id"])
+            )
+        return self.load(row["id"])
+
+    def _worker(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"ERROR tomando jobs de la cola: {e}")
+                job = None
+            if job is None:
+                self._wakeup.wait(POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+            self.run(job)
+
+    def run(self, job):
+        handler = self.handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise ValueError(f"Sin handler para jobs de tipo {job.kind}")
+            handler(job)
+            self._set_status(job.id, "done", error=None)
+        except RetryJob as e:
+            if job.attempts >= JOB_MAX_ATTEMPTS:
+                self._set_status(job.id, "failed", error=str(e))
+            else:
+                delay = min(600, 15 * 2 ** (job.attempts - 1))
+                self._set_status(job.id, "queued", error=str(e), run_after=time.time() + delay)
+        except Exception as e:
+            print(f"ERROR ejecutando job {job.id} ({job.kind}): {e}")
+            self._set_status(job.id, "failed", error=str(e))
+
+    def purge(self, days=JOB_RETENTION_DAYS):
+        with open_db(self.path) as conn:
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                         (time.time() - days * 86400,))
+
+    def stats(self):
+        with open_db(self.path) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
@@ -0,0 +1,80 @@
+"""
+Imports y clientes diferidos para que arrancar el backend no pague dependencias
+pesadas que un proceso quizás nunca usa.
+
+- `lazy_import("weasyprint")`: devuelve el módulo sin ejecutarlo
+  (importlib.util.LazyLoader); se carga de verdad en el primer acceso a un
+  atributo. Ojo: `from x import y` accede al atributo en el momento, así que
+  en los módulos que lo usan se escribe `x.y` en el punto de uso.
+- `lazy_object(factory)`: un cliente (SDK de MP, etc.) que se crea en el
+  primer uso.
+
+LAZY_IMPORTS=0 importa todo de entrada (como antes): sirve para comparar con
+bench_startup.py.
+"""
+
+import importlib
+import importlib.util
+import os
+import sys
+import threading
+
+LAZY_IMPORTS = os.getenv("LAZY_IMPORTS", "1") == "1"
+
+
+def lazy_import(name):
+    """Módulo `name`, cargado recién cuando se usa (o ya, si LAZY_IMPORTS=0 o ya estaba cargado)."""
+    if name in sys.modules or not LAZY_IMPORTS:
+        return importlib.import_module(name)
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No se encontró el módulo {name}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def is_loaded(name):
+    """True si el módulo ya se ejecutó (un módulo diferido todavía sin usar cuenta como no cargado)."""
+    module = sys.modules.get(name)
+    return module is not None and not isinstance(module, importlib.util._LazyModule)
+
+
+class LazyObject:
+    """Proxy que crea el objeto con `factory()` en el primer acceso a un atributo."""
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_target", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _resolve(self):
+        target = object.__getattribute__(self, "_target")
+        if target is None:
+            with object.__getattribute__(self, "_lock"):
+                target = object.__getattribute__(self, "_target")
+                if target is None:
+                    target = object.__getattribute__(self, "_factory")()
+                    object.__setattr__(self, "_target", target)
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __bool__(self):
+        # Un cliente configurado cuenta como disponible aunque todavía no se haya creado
+        return True
+
+    def __repr__(self):
+        target = object.__getattribute__(self, "_target")
+        return f"<LazyObject {'sin crear' if target is None else repr(target)}>"
+
+
+def lazy_object(factory):
+    return factory() if not LAZY_IMPORTS else LazyObject(factory)
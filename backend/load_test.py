@@ -0,0 +1,207 @@
+"""
+Prueba de carga: requests concurrentes que atiende un worker de gunicorn.
+
+Por defecto levanta un Airtable de prueba local que responde con una demora
+fija (--delay) y arranca gunicorn con gunicorn.conf.py dos veces, con un solo
+worker: sync y gthread. Le manda --requests pedidos con --concurrency clientes
+a /api/get_history_by_payment_id (una lectura de Historial por request, el
+endpoint que consulta el frontend después de pagar) y compara requests por
+segundo, latencias y cuántos requests llegó a tener en curso el worker a la
+vez (medido en el Airtable de prueba).
+
+    python load_test.py                           # sync vs gthread, 1 worker
+    python load_test.py --threads 16 --delay 0.5
+    python load_test.py --url https://backend/api/get_history_by_payment_id/123 -c 20 -n 200
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_PATH = "/api/get_history_by_payment_id/load-test"
+STARTUP_TIMEOUT = 60  # segundos
+
+
+class StandInAirtable(ThreadingHTTPServer):
+    """API de Airtable de prueba: responde vacío después de `delay` y cuenta los requests en curso."""
+
+    daemon_threads = True
+
+    def __init__(self, delay):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.delay = delay
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def reset_peak(self):
+        with self._lock:
+            self.peak = self.in_flight
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def _respond(self):
+        server = self.server
+        with server._lock:
+            server.in_flight += 1
+            server.peak = max(server.peak, server.in_flight)
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                self.rfile.read(length)
+            time.sleep(server.delay)
+            body = json.dumps({"records": []}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server._lock:
+                server.in_flight -= 1
+
+    do_GET = do_POST = do_PATCH = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_load(url, concurrency, total):
+    """Manda `total` GET a url con `concurrency` clientes. Devuelve las métricas."""
+    latencies, errors = [], []
+
+    def one(_):
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url, timeout=120) as response:
+                response.read()
+            latencies.append(time.perf_counter() - started)
+        except (urllib.error.URLError, OSError) as e:
+            errors.append(str(e))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000) if latencies else None
+
+    return {
+        "requests": total,
+        "errors": len(errors),
+        "seconds": round(elapsed, 2),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+    }
+
+
+def start_gunicorn(worker_class, threads, upstream_url, data_dir):
+    """gunicorn con gunicorn.conf.py y un worker, apuntando Airtable al servidor de prueba."""
+    port = free_port()
+    env = {
+        **os.environ,
+        "PORT": str(port),
+        "GUNICORN_WORKER_CLASS": worker_class,
+        "WEB_CONCURRENCY": "1",
+        "GUNICORN_THREADS": str(threads),
+        "AIRTABLE_PAT": "load-test",
+        "AIRTABLE_API_URL": upstream_url,
+        "AIRTABLE_RATE_LIMIT": "100000",  # El límite de Airtable no es lo que se mide acá
+        "AIRTABLE_BURST": "100000",
+        "AIRTABLE_GATEWAY_STATE": os.path.join(data_dir, "gateway.json"),
+        "DATA_DIR": data_dir,
+        "PRELOAD_PADRON": "0",
+        "PDF_POOL_WORKERS": "0",
+        "MP_CATCHUP_INTERVAL": "0",
+        "RESEND_API_KEY": "",
+    }
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+                            cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn ({worker_class}) terminó al arrancar con código {proc.returncode}")
+        try:
+            with urllib.request.urlopen(base_url + "/healthz", timeout=2):
+                return proc, base_url
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f"gunicorn ({worker_class}) no respondió en {STARTUP_TIMEOUT}s")
+
+
+def compare(args):
+    upstream = StandInAirtable(args.delay)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    results = []
+    try:
+        for worker_class in ("sync", "gthread"):
+            with tempfile.TemporaryDirectory() as data_dir:
+                proc, base_url = start_gunicorn(worker_class, args.threads, upstream.url, data_dir)
+                try:
+                    url = base_url + TEST_PATH
+                    run_load(url, 1, 2)  # Primer request: arranca los threads de fondo del worker
+                    upstream.reset_peak()
+                    result = run_load(url, args.concurrency, args.requests)
+                finally:
+                    proc.terminate()
+                    proc.wait(timeout=30)
+            result.update(worker_class=worker_class, peak_in_flight=upstream.peak)
+            results.append(result)
+    finally:
+        upstream.shutdown()
+
+    print(f"1 worker, {args.concurrency} clientes, Airtable de prueba con {args.delay * 1000:.0f} ms por request, "
+          f"gthread con {args.threads} threads\n")
+    columns = ("worker_class", "rps", "p50_ms", "p95_ms", "errors", "peak_in_flight")
+    print(" | ".join(f"{c:>14}" for c in columns))
+    for result in results:
+        print(" | ".join(f"{str(result[c]):>14}" for c in columns))
+    if len(results) == 2 and results[0]["rps"]:
+        sync, gthread = results
+        print(f"\ngthread vs sync: {gthread['rps'] / sync['rps']:.1f}x requests por segundo "
+              f"con el mismo worker ({gthread['peak_in_flight']} requests en curso a la vez)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del backend (requests concurrentes por worker)")
+    parser.add_argument("--url", help="Medir un backend ya levantado (URL completa del endpoint)")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="Clientes simultáneos")
+    parser.add_argument("-n", "--requests", type=int, default=160, help="Requests en total")
+    parser.add_argument("--threads", type=int, default=8, help="Threads por worker gthread")
+    parser.add_argument("--delay", type=float, default=0.2, help="Demora del Airtable de prueba, en segundos")
+    args = parser.parse_args()
+
+    if args.url:
+        print(json.dumps(run_load(args.url, args.concurrency, args.requests), indent=2))
+        return
+    compare(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Ubicación de los archivos locales del backend (caches, colas, espejos) y
+conexión a las bases SQLite que viven ahí.
+Se configura con DATA_DIR; por defecto backend/data/.
+"""
+
+import os
+import sqlite3
+from contextlib import contextmanager
+
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+
+
+def data_path(*parts):
+    """Ruta dentro de DATA_DIR, creando el directorio si hace falta."""
+    path = os.path.join(DATA_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def connect(path):
+    """
+    Conexión SQLite apta para varios workers y threads: modo WAL, espera ante
+    locks y filas accesibles por nombre. Abrir una por operación y cerrarla.
+    """
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+@contextmanager
+def open_db(path):
+    """Conexión que se cierra al salir del bloque."""
+    conn = connect(path)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+@contextmanager
+def transaction(conn):
+    """Transacción explícita (BEGIN IMMEDIATE toma el lock de escritura de entrada)."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
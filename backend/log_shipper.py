@@ -0,0 +1,249 @@
+"""
+Envío asíncrono de logs a la tabla Logs de Airtable.
+
+`log_to_airtable` solo encola la entrada en memoria; un thread por worker la
+envía con `batch_create` en grupos de 10 (el máximo de Airtable) cada
+LOG_SHIP_INTERVAL segundos, o antes si ya se juntó un grupo completo.
+
+- Si Airtable falla, el grupo se escribe en un JSONL local (LOG_SPILL_PATH) y se
+  reintenta con espera exponencial. Cuando Airtable vuelve, el archivo se
+  reenvía (lo toma un solo worker: se renombra antes de leerlo). Los archivos
+  tomados por un worker que murió a mitad del reenvío los retoma otro pasados
+  SPILL_ORPHAN_SECONDS; las líneas que no se pueden leer van a `<archivo>.bad`.
+- Los INFO se pueden muestrear (LOG_INFO_SAMPLE_RATE, 0 a 1). WARNING y ERROR
+  se envían siempre.
+- Al terminar el worker se vacía la cola: `flush_all()` desde el hook
+  worker_exit de gunicorn, y atexit como respaldo.
+"""
+
+import atexit
+import glob
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+from local_store import data_path
+
+LOG_SHIP_INTERVAL = float(os.getenv("LOG_SHIP_INTERVAL", "5"))  # segundos
+LOG_INFO_SAMPLE_RATE = float(os.getenv("LOG_INFO_SAMPLE_RATE", "1"))
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+LOG_SPILL_PATH = os.getenv("LOG_SPILL_PATH", data_path("logs_spill.jsonl"))
+
+BATCH_SIZE = 10  # Límite de batch_create de Airtable
+MAX_BACKOFF_SECONDS = 300
+FLUSH_TIMEOUT_SECONDS = 10
+SPILL_ORPHAN_SECONDS = 600  # Un archivo tomado sin tocar hace tanto es de un worker que ya no está
+
+_shippers = []
+
+
+class LogShipper:
+    def __init__(self, send_batch, spill_path=LOG_SPILL_PATH, interval=LOG_SHIP_INTERVAL,
+                 info_sample_rate=LOG_INFO_SAMPLE_RATE, max_queue=LOG_QUEUE_MAX):
+        self.send_batch = send_batch  # (lista de dicts de campos) -> None; levanta excepción si falla
+        self.spill_path = spill_path
+        self.interval = interval
+        self.info_sample_rate = info_sample_rate
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._send_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread_pid = None
+        self._thread_lock = threading.Lock()
+        self._failures = 0
+        self._retry_at = 0
+        self.counters = {"enqueued": 0, "sampled_out": 0, "sent": 0, "spilled": 0, "resent": 0, "errors": 0,
+                         "quarantined": 0}
+        _shippers.append(self)
+
+    # --- Lado del request: nunca bloquea ---
+
+    def enqueue(self, fields):
+        self._ensure_thread()
+        if fields.get('Level') == 'INFO' and self.info_sample_rate < 1 and random.random() >= self.info_sample_rate:
+            self.counters["sampled_out"] += 1
+            return
+        try:
+            self._queue.put_nowait(fields)
+            self.counters["enqueued"] += 1
+        except queue.Full:
+            # Cola llena (Airtable caído hace rato): directo al archivo local
+            self._spill([fields])
+        if self._queue.qsize() >= BATCH_SIZE:
+            self._wakeup.set()
+
+    def _ensure_thread(self):
+        # Un thread por proceso, arrancado después del fork de gunicorn
+        if self._thread_pid == os.getpid():
+            return
+        with self._thread_lock:  # Varios requests a la vez con workers gthread
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, name="log-shipper", daemon=True).start()
+
+    # --- Thread de envío ---
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"ERROR en el envío de logs a Airtable: {e}")
+
+    def _drain(self, limit=None):
+        items = []
+        while limit is None or len(items) < limit:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def flush(self):
+        """Envía todo lo encolado. Si Airtable está en espera de reintento, va al archivo local."""
+        with self._send_lock:
+            while True:
+                batch = self._drain(BATCH_SIZE)
+                if not batch:
+                    break
+                if time.time() < self._retry_at or not self._send(batch):
+                    # Lo que quede en la cola también espera en disco
+                    self._spill(batch + self._drain())
+                    return
+                self.counters["sent"] += len(batch)
+            if time.time() >= self._retry_at:
+                self._resend_spilled()
+
+    def _send(self, batch):
+        try:
+            self.send_batch(batch)
+            self._failures = 0
+            self._retry_at = 0
+            return True
+        except Exception as e:
+            self.counters["errors"] += 1
+            self._failures += 1
+            delay = min(MAX_BACKOFF_SECONDS, self.interval * 2 ** self._failures)
+            self._retry_at = time.time() + delay
+            print(f"ERROR: Falló el envío de {len(batch)} logs a Airtable ({e}). Reintento en {delay:.0f}s.")
+            return False
+
+    # --- Archivo local ---
+
+    def _spill(self, items):
+        if not items:
+            return
+        data = "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in items).encode("utf-8")
+        try:
+            fd = os.open(self.spill_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            self.counters["spilled"] += len(items)
+        except OSError as e:
+            print(f"ERROR: No se pudieron guardar {len(items)} logs en {self.spill_path}: {e}")
+
+    def _claim_spilled(self):
+        """Archivos a reenviar: los tomados por este proceso, los huérfanos y el archivo compartido."""
+        own_prefix = f"{self.spill_path}.{os.getpid()}."
+        claimed_name = re.compile(re.escape(self.spill_path) + r"\.\d+\.\d+$")
+        paths = []
+        for path in glob.glob(f"{self.spill_path}.*"):
+            if not claimed_name.match(path):
+                continue  # p. ej. el .bad
+            if path.startswith(own_prefix):
+                paths.append(path)
+                continue
+            try:
+                orphan = time.time() - os.path.getmtime(path) > SPILL_ORPHAN_SECONDS
+            except OSError:
+                continue
+            if orphan:
+                paths.append(path)
+        paths.append(self.spill_path)
+
+        claimed = []
+        for path in paths:
+            target = path if path.startswith(own_prefix) else f"{own_prefix}{int(time.time() * 1000)}{len(claimed)}"
+            try:
+                if target != path:
+                    os.rename(path, target)  # Atómico: solo un worker lo toma
+                os.utime(target)  # Recién tomado: no es huérfano para los demás
+                claimed.append(target)
+            except OSError:
+                pass
+        return claimed
+
+    def _read_spilled(self, path):
+        """Entradas del archivo; las líneas que no se pueden leer se apartan en `.bad`."""
+        items, bad = [], []
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    bad.append(line if line.endswith("\n") else line + "\n")
+                    continue
+                if isinstance(item, dict):
+                    items.append(item)
+                else:
+                    bad.append(line)
+        if bad:
+            with open(f"{self.spill_path}.bad", "a", encoding="utf-8") as f:
+                f.writelines(bad)
+            self.counters["quarantined"] += len(bad)
+            print(f"ADVERTENCIA: {len(bad)} líneas ilegibles de {path} apartadas en {self.spill_path}.bad")
+        return items
+
+    def _resend_spilled(self):
+        for path in self._claim_spilled():
+            try:
+                items = self._read_spilled(path)
+            except OSError as e:
+                print(f"ERROR leyendo los logs guardados en {path}: {e}")
+                continue
+            for i in range(0, len(items), BATCH_SIZE):
+                if not self._send(items[i:i + BATCH_SIZE]):
+                    self._spill(items[i:])
+                    _remove(path)
+                    return
+                self.counters["resent"] += len(items[i:i + BATCH_SIZE])
+            _remove(path)
+
+    def close(self, timeout=FLUSH_TIMEOUT_SECONDS):
+        """Vacía la cola antes de que termine el proceso (lo que no salga a tiempo queda en disco)."""
+        if self._queue.empty():
+            return
+        done = threading.Thread(target=self.flush, daemon=True)
+        done.start()
+        done.join(timeout)
+        if done.is_alive():
+            self._spill(self._drain())
+
+    def stats(self):
+        return {**self.counters, "queued": self._queue.qsize(),
+                "spill_pending": os.path.exists(self.spill_path), "retry_in": max(0, round(self._retry_at - time.time()))}
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def flush_all():
+    for shipper in _shippers:
+        shipper.close()
+
+
+atexit.register(flush_all)
@@ -0,0 +1,402 @@
+"""
+Cola persistente de emails salientes (Resend).
+
+Los requests solo guardan el email en SQLite; threads por worker lo envían:
+
+- Los emails sin adjuntos se mandan juntos con el endpoint batch de Resend
+  (hasta MAIL_BATCH_SIZE por llamada). Los que llevan PDF van de a uno.
+- Errores transitorios (red, 429, 5xx) se reintentan con espera exponencial;
+  tras MAIL_MAX_ATTEMPTS el email queda 'dead' para revisarlo desde el admin.
+  Un rechazo de validación (400/422) no se reintenta; si vino de un batch, sus
+  emails se reenvían de a uno para no perder los válidos por uno inválido.
+- Circuit breaker: tras MAIL_BREAKER_THRESHOLD fallos transitorios seguidos no
+  se envía nada durante MAIL_BREAKER_COOLDOWN segundos; después un único envío
+  de prueba decide si se reanuda.
+- Estado de entrega: los emails encolados con `ref` avisan cuando quedan
+  enviados o 'dead' (`on_status`, p. ej. Comprobante_Status del Historial).
+  Si el aviso falla (el registro todavía no existe, Airtable caído) se reintenta.
+- Idempotencia por `dedupe_key`: encolar de nuevo el mismo email no lo duplica.
+
+Para probar sin Resend: RESEND_API_URL apunta a un servidor HTTP local.
+"""
+
+import json
+import os
+import threading
+import time
+
+import resend
+
+from local_store import data_path, open_db, transaction
+
+MAIL_QUEUE_PATH = os.getenv("MAIL_QUEUE_PATH", data_path("mail_queue.sqlite3"))
+MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", "2"))  # threads por proceso
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "8"))
+MAIL_BATCH_SIZE = min(int(os.getenv("MAIL_BATCH_SIZE", "100")), 100)  # Límite del batch de Resend
+MAIL_BREAKER_THRESHOLD = int(os.getenv("MAIL_BREAKER_THRESHOLD", "5"))
+MAIL_BREAKER_COOLDOWN = float(os.getenv("MAIL_BREAKER_COOLDOWN", "60"))  # segundos
+RETRY_BASE_SECONDS = 15
+RETRY_MAX_SECONDS = 1800
+# Un email 'sending' sin novedades por más de esto quedó de un worker caído
+STALE_SECONDS = 600
+POLL_SECONDS = 1.0
+SYNC_RETRY_SECONDS = 60
+SYNC_MAX_ATTEMPTS = 30
+# Códigos de Resend que indican un email inválido: reintentar no cambia nada
+PERMANENT_CODES = {"400", "422"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mails (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dedupe_key TEXT UNIQUE,
+    status TEXT NOT NULL,
+    params_json TEXT NOT NULL,
+    batchable INTEGER NOT NULL,
+    ref TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    provider_id TEXT,
+    status_synced INTEGER NOT NULL DEFAULT 1,
+    sync_attempts INTEGER NOT NULL DEFAULT 0,
+    sync_after REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mails_ready ON mails (status, run_after);
+CREATE INDEX IF NOT EXISTS mails_unsynced ON mails (status_synced, sync_after);
+"""
+
+
+class ResendSender:
+    """Envío real con el SDK de Resend (resend.api_key y resend.api_url los configura app.py)."""
+
+    def send(self, params):
+        return (resend.Emails.send(params) or {}).get("id")
+
+    def send_batch(self, params_list):
+        response = resend.Batch.send(params_list)
+        items = response.get("data") if isinstance(response, dict) else response
+        return [(item or {}).get("id") for item in items or []]
+
+
+def is_permanent(error):
+    """True si Resend rechazó el email en sí (no tiene sentido reintentarlo)."""
+    return str(getattr(error, "code", "")) in PERMANENT_CODES
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=MAIL_BREAKER_THRESHOLD, cooldown=MAIL_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.time() >= self.opened_at + self.cooldown else "open"
+
+    def allow(self):
+        """True si se puede enviar. Con el circuito medio abierto deja pasar un solo envío de prueba."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def release(self):
+        """El envío de prueba no llegó a hacerse (no había nada para enviar)."""
+        with self._lock:
+            self._probing = False
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                print("Emails: Resend responde de nuevo, se reanudan los envíos.")
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or (self.opened_at is None and self.failures >= self.threshold):
+                print(f"ADVERTENCIA: Emails: {self.failures} fallos seguidos de Resend, envíos pausados por {self.cooldown:.0f}s.")
+                self.opened_at = time.time()
+            self._probing = False
+
+
+class MailQueue:
+    def __init__(self, sender=None, path=MAIL_QUEUE_PATH, workers=MAIL_WORKERS, on_status=None, on_dead=None):
+        self.sender = sender or ResendSender()
+        self.on_status = on_status  # on_status(mail) con status 'sent' o 'dead'; levanta excepción si no pudo
+        self.on_dead = on_dead  # on_dead(mail, error)
+        self.path = path
+        self.workers = workers
+        self.breaker = CircuitBreaker()
+        self.counters = {"sent": 0, "batches": 0, "retries": 0, "dead": 0, "split": 0, "synced": 0, "errors": 0}
+        self._wakeup = threading.Event()
+        self._thread_pid = None
+        with open_db(self.path) as conn:
+            conn.executescript(SCHEMA)
+
+    def enqueue(self, params, dedupe_key=None, ref=None):
+        """
+        Guarda un email para enviar (params como los de resend.Emails.send).
+        Devuelve (id, 'queued') o, si ya había uno con la misma dedupe_key, (id, 'duplicate').
+        """
+        now = time.time()
+        with open_db(self.path) as conn, transaction(conn):
+            if dedupe_key:
+                row = conn.execute("SELECT id FROM mails WHERE dedupe_key = ?", (dedupe_key,)).fetchone()
+                if row:
+                    return row["id"], "duplicate"
+            cursor = conn.execute(
+                """INSERT INTO mails (dedupe_key, status, params_json, batchable, ref, created_at, updated_at)
+                   VALUES (?, 'queued', ?, ?, ?, ?, ?)""",
+                (dedupe_key, json.dumps(params), 0 if params.get("attachments") else 1, ref, now, now)
+            )
+        self._wakeup.set()
+        return cursor.lastrowid, "queued"
+
+    # --- Workers ---
+
+    def start_workers(self):
+        """Arranca los threads una vez por proceso (después del fork de gunicorn)."""
+        if self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, args=(i == 0,), name=f"mail-{i}", daemon=True).start()
+
+    def _claim(self):
+        """Toma el próximo email listo; si no lleva adjuntos, junto con otros sin adjuntos para un batch."""
+        now = time.time()
+        with open_db(self.path) as conn, transaction(conn):
+            conn.execute(
+                "UPDATE mails SET status = 'queued' WHERE status = 'sending' AND updated_at < ?",
+                (now - STALE_SECONDS,)
+            )
+            first = conn.execute(
+                "SELECT id, batchable FROM mails WHERE status = 'queued' AND run_after <= ? ORDER BY id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if not first:
+                return []
+            if first["batchable"]:
+                rows = conn.execute(
+                    "SELECT * FROM mails WHERE status = 'queued' AND batchable = 1 AND run_after <= ? ORDER BY id LIMIT ?",
+                    (now, MAIL_BATCH_SIZE)
+                ).fetchall()
+            else:
+                rows = conn.execute("SELECT * FROM mails WHERE id = ?", (first["id"],)).fetchall()
+            conn.executemany(
+                "UPDATE mails SET status = 'sending', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                [(now, row["id"]) for row in rows]
+            )
+        return [dict(row, attempts=row["attempts"] + 1) for row in rows]
+
+    def _worker(self, syncs_status):
+        while True:
+            if syncs_status:
+                try:
+                    self.sync_statuses()
+                except Exception as e:
+                    print(f"ERROR informando estados de emails: {e}")
+            if not self.breaker.allow():
+                time.sleep(POLL_SECONDS)
+                continue
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                print(f"ERROR tomando emails de la cola: {e}")
+                claimed = []
+            if not claimed:
+                self.breaker.release()
+                self._wakeup.wait(POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+            try:
+                self.send(claimed)
+            except Exception as e:
+                # Error local (SQLite, on_dead): el thread sigue; los 'sending' vuelven a la cola por STALE_SECONDS
+                self.counters["errors"] += 1
+                self.breaker.release()
+                print(f"ERROR procesando los emails {[mail['id'] for mail in claimed]}: {e}")
+                time.sleep(POLL_SECONDS)
+
+    def send(self, mails):
+        params = [json.loads(mail["params_json"]) for mail in mails]
+        try:
+            if len(mails) > 1:
+                provider_ids = self.sender.send_batch(params)
+                self.counters["batches"] += 1
+            else:
+                provider_ids = [self.sender.send(params[0])]
+        except Exception as e:
+            if is_permanent(e):
+                # Resend respondió: no es una caída, es el contenido
+                self.breaker.success()
+                if len(mails) > 1:
+                    self._split(mails, e)
+                else:
+                    self._dead(mails[0], e)
+            else:
+                self.breaker.failure()
+                for mail in mails:
+                    self._retry(mail, e)
+            return False
+
+        self.breaker.success()
+        now = time.time()
+        with open_db(self.path) as conn:
+            conn.executemany(
+                """UPDATE mails SET status = 'sent', provider_id = ?, last_error = NULL, params_json = ?,
+                   status_synced = ?, updated_at = ? WHERE id = ?""",
+                [(provider_id, json.dumps(_without_attachments(p)), 0 if mail["ref"] else 1, now, mail["id"])
+                 for mail, p, provider_id in zip(mails, params, list(provider_ids) + [None] * len(mails))]
+            )
+        self.counters["sent"] += len(mails)
+        if any(mail["ref"] for mail in mails):
+            self._wakeup.set()
+        return True
+
+    def _retry(self, mail, error):
+        attempt = mail["attempts"]
+        if attempt >= MAIL_MAX_ATTEMPTS:
+            self._dead(mail, error)
+            return
+        delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+        with open_db(self.path) as conn:
+            conn.execute(
+                "UPDATE mails SET status = 'queued', last_error = ?, run_after = ?, updated_at = ? WHERE id = ?",
+                (str(error)[:1000], time.time() + delay, time.time(), mail["id"])
+            )
+        self.counters["retries"] += 1
+        print(f"ADVERTENCIA: Falló el envío del email {mail['id']} (intento {attempt}), reintento en {delay}s: {error}")
+
+    def _split(self, mails, error):
+        # El batch se rechaza entero: cada email vuelve a la cola para ir solo, sin contar el intento
+        with open_db(self.path) as conn:
+            conn.executemany(
+                "UPDATE mails SET status = 'queued', batchable = 0, attempts = attempts - 1, last_error = ?, updated_at = ? WHERE id = ?",
+                [(str(error)[:1000], time.time(), mail["id"]) for mail in mails]
+            )
+        self.counters["split"] += 1
+        self._wakeup.set()
+
+    def _dead(self, mail, error):
+        with open_db(self.path) as conn:
+            conn.execute(
+                "UPDATE mails SET status = 'dead', last_error = ?, status_synced = ?, updated_at = ? WHERE id = ?",
+                (str(error)[:1000], 0 if mail["ref"] else 1, time.time(), mail["id"])
+            )
+        self.counters["dead"] += 1
+        print(f"ERROR: El email {mail['id']} pasa a la lista de no enviados tras {mail['attempts']} intentos: {error}")
+        if self.on_dead:
+            try:
+                self.on_dead(_public(mail), error)
+            except Exception as e:
+                print(f"ERROR avisando el email no enviado {mail['id']}: {e}")
+
+    def drain(self):
+        """Envía ya, en este thread, todo lo que esté listo (scripts que no arrancan los workers)."""
+        sent = 0
+        while self.breaker.allow():
+            claimed = self._claim()
+            if not claimed:
+                self.breaker.release()
+                break
+            if self.send(claimed):
+                sent += len(claimed)
+        self.sync_statuses()
+        return sent
+
+    # --- Estado de entrega ---
+
+    def sync_statuses(self, limit=20):
+        """Informa (on_status) los emails enviados o 'dead' que todavía no se informaron."""
+        if not self.on_status:
+            return 0
+        now = time.time()
+        with open_db(self.path) as conn:
+            rows = conn.execute(
+                "SELECT * FROM mails WHERE status_synced = 0 AND sync_after <= ? ORDER BY updated_at LIMIT ?",
+                (now, limit)
+            ).fetchall()
+        synced = 0
+        for row in rows:
+            mail = _public(row)
+            try:
+                self.on_status(mail)
+                update = ("UPDATE mails SET status_synced = 1 WHERE id = ?", (row["id"],))
+                synced += 1
+            except Exception as e:
+                gave_up = row["sync_attempts"] + 1 >= SYNC_MAX_ATTEMPTS
+                if gave_up:
+                    print(f"ERROR: No se pudo informar el estado del email {row['id']} ({row['ref']}): {e}")
+                update = (
+                    "UPDATE mails SET status_synced = ?, sync_attempts = sync_attempts + 1, sync_after = ? WHERE id = ?",
+                    (1 if gave_up else 0, time.time() + SYNC_RETRY_SECONDS, row["id"])
+                )
+            with open_db(self.path) as conn:
+                conn.execute(*update)
+        self.counters["synced"] += synced
+        return synced
+
+    # --- Consulta y administración ---
+
+    def get(self, mail_id):
+        with open_db(self.path) as conn:
+            row = conn.execute("SELECT * FROM mails WHERE id = ?", (mail_id,)).fetchone()
+        return _public(row) if row else None
+
+    def mails(self, status=None, limit=100):
+        sql = "SELECT * FROM mails"
+        params = ()
+        if status:
+            sql += " WHERE status = ?"
+            params = (status,)
+        sql += " ORDER BY updated_at DESC LIMIT ?"
+        with open_db(self.path) as conn:
+            rows = conn.execute(sql, params + (limit,)).fetchall()
+        return [_public(row) for row in rows]
+
+    def retry(self, mail_id):
+        """Vuelve a encolar un email de la lista de no enviados. False si no existe o ya salió."""
+        with open_db(self.path) as conn:
+            cursor = conn.execute(
+                "UPDATE mails SET status = 'queued', attempts = 0, run_after = 0, updated_at = ? WHERE id = ? AND status = 'dead'",
+                (time.time(), mail_id)
+            )
+        self._wakeup.set()
+        return cursor.rowcount > 0
+
+    def stats(self):
+        with open_db(self.path) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM mails GROUP BY status").fetchall()
+        return {**{row["status"]: row["n"] for row in rows}, **self.counters,
+                "breaker": self.breaker.state, "consecutive_failures": self.breaker.failures}
+
+
+def _without_attachments(params):
+    # Ya enviado, el contenido de los adjuntos no hace falta guardarlo
+    if not params.get("attachments"):
+        return params
+    return {**params, "attachments": [{"filename": a.get("filename")} for a in params["attachments"]]}
+
+
+def _public(row):
+    """El email como dict: destinatario y asunto, sin el cuerpo ni los adjuntos."""
+    params = json.loads(row["params_json"])
+    mail = {key: row[key] for key in row.keys() if key != "params_json"}
+    mail.update({"to": params.get("to"), "subject": params.get("subject"),
+                 "attachments": [a.get("filename") for a in params.get("attachments") or []]})
+    return mail
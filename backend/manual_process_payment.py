@@ -1,13 +1,29 @@
 """
-Script para procesar manualmente un pago que no fue procesado por el webhook
-Uso: python manual_process_payment.py <payment_id>
+Script para procesar manualmente pagos que no fueron procesados por el webhook
+
+Un pago (muestra la información y el payload para /api/debug/simulate_payment):
+    python manual_process_payment.py <payment_id>
+
+Varios pagos (por ejemplo después de una caída), procesados en este proceso
+con la misma lógica del webhook:
+    python manual_process_payment.py --process 141870342175 141870342176
+    python manual_process_payment.py --process --file ids.txt --workers 4
+
+- Los pagos se consultan a Mercado Pago en paralelo (--workers).
+- Se saltean los que ya están en Historial (aprobados con registro Exitoso).
+- Cada resultado se anota en un checkpoint (JSONL); si se corta, volver a
+  correr el mismo comando sigue donde quedó (los que fallaron se reintentan).
+- Sin --process solo lista qué se procesaría.
 """
 
 import sys
 import os
 import json
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-import mercadopago
 
 # Cargar variables de entorno
 load_dotenv()
@@ -18,7 +34,12 @@ if not MERCADOPAGO_ACCESS_TOKEN:
     print("ERROR: MERCADOPAGO_ACCESS_TOKEN no configurado")
     sys.exit(1)
 
-sdk = mercadopago.SDK(MERCADOPAGO_ACCESS_TOKEN)
+from mp_catchup import mp_sdk  # Después de load_dotenv: lee MP_API_URL
+
+sdk = mp_sdk(MERCADOPAGO_ACCESS_TOKEN)
+
+BATCH_WORKERS = 4
+HISTORIAL_LOOKUP_CHUNK = 50  # IDs por fórmula al buscar en Historial
 
 def get_payment_info(payment_id):
     """Obtiene información del pago desde Mercado Pago"""
@@ -57,15 +78,8 @@ def get_payment_info(payment_id):
         print(f"ERROR obteniendo información del pago: {e}")
         return None
 
-def main():
-    if len(sys.argv) < 2:
-        print("Uso: python manual_process_payment.py <payment_id>")
-        print("\nEjemplo:")
-        print("  python manual_process_payment.py 141870342175")
-        sys.exit(1)
-
-    payment_id = sys.argv[1]
-
+def show_payment(payment_id):
+    """Modo de un solo pago: muestra la información y cómo procesarlo."""
     result = get_payment_info(payment_id)
     if not result:
         print("\nNo se pudo obtener la información del pago.")
@@ -100,5 +114,142 @@ def main():
     }
     print(json.dumps(webhook_payload, indent=2))
 
+# --- Modo lote ---
+
+def read_payment_ids(ids, file_path=None):
+    """IDs de los argumentos y/o de un archivo (uno por línea o separados por comas; # comenta)."""
+    raw = list(ids)
+    if file_path:
+        with open(file_path, encoding="utf-8") as f:
+            for line in f:
+                raw.extend(line.split("#", 1)[0].replace(",", " ").split())
+    seen = set()
+    return [pid for pid in (str(r).strip() for r in raw) if pid and not (pid in seen or seen.add(pid))]
+
+
+class Checkpoint:
+    """Resultados ya obtenidos, en JSONL: una línea por pago, se agrega a medida que terminan."""
+
+    DONE = ("processed", "skipped")
+
+    def __init__(self, path):
+        self.path = path
+        self.results = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.results[entry["id"]] = entry
+
+    def done(self, payment_id):
+        return self.results.get(payment_id, {}).get("result") in self.DONE
+
+    def record(self, payment_id, result, detail=None):
+        entry = {"id": payment_id, "result": result, "detail": detail, "at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        with self._lock:
+            self.results[payment_id] = entry
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return entry
+
+
+def historial_status(historial_table, payment_ids):
+    """{MP_Payment_ID: [Estado, ...]} de los pagos que ya tienen registro en Historial."""
+    found = {}
+    for i in range(0, len(payment_ids), HISTORIAL_LOOKUP_CHUNK):
+        chunk = payment_ids[i:i + HISTORIAL_LOOKUP_CHUNK]
+        # &'' compara como texto aunque el campo sea numérico
+        formula = "OR(" + ", ".join(f"{{MP_Payment_ID}}&''='{pid}'" for pid in chunk) + ")"
+        for record in historial_table.all(formula=formula, fields=["MP_Payment_ID", "Estado"]):
+            fields = record["fields"]
+            found.setdefault(str(fields.get("MP_Payment_ID")), []).append(fields.get("Estado"))
+    return found
+
+
+def fetch_payment(payment_id):
+    response = sdk.payment().get(payment_id)
+    if response.get("status") != 200:
+        raise RuntimeError(f"Mercado Pago respondió HTTP {response.get('status')}: {response.get('response')}")
+    return response["response"]
+
+
+def run_batch(payment_ids, process, workers, checkpoint):
+    """Consulta (y con process=True procesa) los pagos. Devuelve el conteo por resultado."""
+    # app se importa recién acá: inicializa Airtable, colas y caches como el backend
+    import app
+
+    pending = [pid for pid in payment_ids if not checkpoint.done(pid)]
+    print(f"{len(payment_ids)} pagos, {len(payment_ids) - len(pending)} ya resueltos en el checkpoint {checkpoint.path}")
+    if not pending:
+        return {}
+    if not app.api:
+        print("ERROR: Airtable no configurado (AIRTABLE_PAT)")
+        sys.exit(1)
+    known = historial_status(app.api.table(app.BASE_ID, app.HISTORIAL_TABLE_ID), pending)
+
+    def handle(payment_id):
+        payment_info = fetch_payment(payment_id)
+        estados = known.get(payment_id, [])
+        # Aprobado: alcanza con un registro Exitoso. Otro estado: con cualquier registro
+        if ("Exitoso" in estados) or (estados and payment_info.get("status") != "approved"):
+            return "skipped", f"ya en Historial ({', '.join(map(str, estados))})"
+        if not process:
+            return "would_process", f"{payment_info.get('status')} ${payment_info.get('transaction_amount')}"
+        items_context = json.loads(payment_info.get("external_reference") or "{}")
+        result = app.process_payment(payment_id, payment_info, items_context)
+        return "processed", f"{payment_info.get('status')} -> Historial {result.get('historialRecordId')}"
+
+    counts = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(handle, pid): pid for pid in pending}
+        for i, future in enumerate(as_completed(futures), 1):
+            payment_id = futures[future]
+            try:
+                result, detail = future.result()
+            except Exception as e:
+                result, detail = "error", str(e)[:300]
+            if result != "would_process":
+                checkpoint.record(payment_id, result, detail)
+            counts[result] = counts.get(result, 0) + 1
+            print(f"[{i}/{len(pending)}] {payment_id}: {result} - {detail}")
+
+    if process:
+        # Emails y contactos que dejó process_payment: se envían antes de salir
+        if app.resend.api_key:
+            print(f"Emails enviados: {app.mail_queue.drain()}")
+        app.contact_store.flush()
+    return counts
+
+
+def main():
+    if len(sys.argv) == 2 and not sys.argv[1].startswith("-"):
+        return show_payment(sys.argv[1])
+
+    parser = argparse.ArgumentParser(description="Procesar manualmente pagos de Mercado Pago")
+    parser.add_argument("ids", nargs="*", help="IDs de pago")
+    parser.add_argument("--file", help="Archivo con IDs de pago")
+    parser.add_argument("--process", action="store_true", help="Procesar los pagos (si no, solo listar)")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="Pagos en paralelo")
+    parser.add_argument("--checkpoint", help="Archivo de checkpoint (por defecto, junto al archivo de IDs)")
+    args = parser.parse_args()
+
+    payment_ids = read_payment_ids(args.ids, args.file)
+    if not payment_ids:
+        parser.print_usage()
+        print("\nEjemplo:")
+        print("  python manual_process_payment.py 141870342175")
+        print("  python manual_process_payment.py --process --file ids.txt")
+        sys.exit(1)
+    checkpoint = Checkpoint(args.checkpoint or f"{args.file or 'manual_process_payment'}.checkpoint.jsonl")
+
+    started = time.time()
+    counts = run_batch(payment_ids, args.process, max(1, args.workers), checkpoint)
+    print(f"\nListo en {time.time() - started:.1f}s: {json.dumps(counts)}")
+    if counts.get("error"):
+        print("Hubo errores: volver a correr el mismo comando reintenta solo esos pagos.")
+        sys.exit(2)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,244 @@
+"""
+Recuperación de pagos de Mercado Pago cuyo webhook no llegó o falló.
+
+Cada MP_CATCHUP_INTERVAL segundos un worker (toma un turno en SQLite, así no
+corren todos a la vez) pide a MP los pagos aprobados de las últimas
+MP_CATCHUP_LOOKBACK_HOURS horas, página por página, y los cruza con los
+MP_Payment_ID exitosos de Historial. Los que faltan entran a la cola de
+webhooks (source='catchup'): se procesan por el camino normal, con los
+threads de la cola (WEBHOOK_WORKERS) como límite de concurrencia, y la cola
+descarta los que ya tiene.
+
+- Los pagos aprobados hace menos de MP_CATCHUP_MIN_AGE_MINUTES se dejan al
+  webhook normal.
+- Los pagos sin external_reference de esta app (JSON) no se tocan.
+- MP_API_URL apunta la SDK de MP a un servidor local para pruebas.
+
+    python mp_catchup.py --dry-run       # solo listar los faltantes
+    python mp_catchup.py --hours 72      # encolarlos (los procesa el backend)
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from fanout import run_parallel
+from lazy_imports import lazy_import
+from local_store import data_path, open_db, transaction
+
+mercadopago = lazy_import("mercadopago")
+
+MP_CATCHUP_PATH = os.getenv("MP_CATCHUP_PATH", data_path("mp_catchup.sqlite3"))
+MP_CATCHUP_INTERVAL = int(os.getenv("MP_CATCHUP_INTERVAL", "900"))  # segundos; 0 = deshabilitado
+MP_CATCHUP_LOOKBACK_HOURS = float(os.getenv("MP_CATCHUP_LOOKBACK_HOURS", "48"))
+MP_CATCHUP_MIN_AGE_MINUTES = float(os.getenv("MP_CATCHUP_MIN_AGE_MINUTES", "10"))
+MP_API_URL = os.getenv("MP_API_URL")
+MP_API_BASE = "https://api.mercadopago.com"
+PAGE_SIZE = 100
+MAX_PAGES = 100
+FETCH_TIMEOUT = 300  # segundos, para cada lado del cruce
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    source TEXT,
+    summary_json TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def stand_in_http_client(base_url):
+    """HttpClient de la SDK que manda los requests a base_url en lugar de la API real."""
+    from mercadopago.http import HttpClient
+
+    class StandInHttpClient(HttpClient):
+        def request(self, method, url, maxretries=None, **kwargs):
+            return super().request(method, url.replace(MP_API_BASE, base_url.rstrip("/"), 1), maxretries=maxretries, **kwargs)
+
+    return StandInHttpClient()
+
+
+def mp_sdk(access_token):
+    """SDK de Mercado Pago; con MP_API_URL habla con ese servidor."""
+    if MP_API_URL:
+        return mercadopago.SDK(access_token, http_client=stand_in_http_client(MP_API_URL))
+    return mercadopago.SDK(access_token)
+
+
+def _iso(dt):
+    return dt.isoformat(timespec="milliseconds")
+
+
+def search_approved(sdk, begin, end):
+    """Pagos aprobados entre begin y end (datetimes con zona), página por página."""
+    payments = []
+    for page in range(MAX_PAGES):
+        response = sdk.payment().search({
+            "status": "approved",
+            "range": "date_approved",
+            "begin_date": _iso(begin),
+            "end_date": _iso(end),
+            "sort": "date_approved",
+            "criteria": "asc",
+            "limit": PAGE_SIZE,
+            "offset": page * PAGE_SIZE,
+        })
+        if response.get("status") != 200:
+            raise RuntimeError(f"Mercado Pago respondió HTTP {response.get('status')} a la búsqueda de pagos: {response.get('response')}")
+        results = response["response"].get("results") or []
+        payments.extend(results)
+        total = (response["response"].get("paging") or {}).get("total", 0)
+        if len(results) < PAGE_SIZE or len(payments) >= total:
+            return payments
+    print(f"ADVERTENCIA: Recuperación de pagos: se cortó en {MAX_PAGES} páginas; achicar MP_CATCHUP_LOOKBACK_HOURS.")
+    return payments
+
+
+def historial_formula(begin):
+    """Registros exitosos de Historial creados desde begin (se procesan siempre después del pago)."""
+    return f"AND({{Estado}}='Exitoso', IS_AFTER(CREATED_TIME(), DATETIME_PARSE('{_iso(begin)}')))"
+
+
+def is_app_payment(payment):
+    """True si el pago lo generó esta app (external_reference es el JSON con el contexto)."""
+    try:
+        return isinstance(json.loads(payment.get("external_reference") or ""), dict)
+    except (TypeError, ValueError):
+        return False
+
+
+class PaymentCatchUp:
+    def __init__(self, search, known_ids, enqueue, path=MP_CATCHUP_PATH,
+                 interval=MP_CATCHUP_INTERVAL, lookback_hours=MP_CATCHUP_LOOKBACK_HOURS):
+        self.search = search  # search(begin, end) -> pagos aprobados
+        self.known_ids = known_ids  # known_ids(begin) -> MP_Payment_ID ya en Historial
+        self.enqueue = enqueue  # enqueue(payment_id, source) -> 'queued' | 'requeued' | 'duplicate'
+        self.path = path
+        self.interval = interval
+        self.lookback_hours = lookback_hours
+        self._thread_pid = None
+        with open_db(self.path) as conn:
+            conn.executescript(SCHEMA)
+
+    def find_missing(self, hours=None):
+        """(pagos aprobados en la ventana, IDs que faltan en Historial, pagos ajenos a la app)."""
+        now = datetime.now(timezone.utc)
+        begin = now - timedelta(hours=hours or self.lookback_hours)
+        end = now - timedelta(minutes=MP_CATCHUP_MIN_AGE_MINUTES)
+        # Las dos consultas no dependen entre sí
+        results = run_parallel({
+            "mp": (lambda deps: self.search(begin, end), ()),
+            "historial": (lambda deps: {str(payment_id) for payment_id in self.known_ids(begin)}, ()),
+        }, default_timeout=FETCH_TIMEOUT)
+        for name, outcome in results.items():
+            if not outcome["ok"]:
+                raise RuntimeError(f"Recuperación de pagos: falló la consulta a {name}: {outcome['error']}")
+        payments = results["mp"]["result"]
+        known = results["historial"]["result"]
+        foreign = [p for p in payments if not is_app_payment(p)]
+        missing = [str(p["id"]) for p in payments if is_app_payment(p) and str(p["id"]) not in known]
+        return payments, missing, foreign
+
+    def run(self, hours=None, dry_run=False, source="scheduler"):
+        """Busca y encola los pagos faltantes. Devuelve el resumen de la corrida."""
+        started = time.time()
+        with open_db(self.path) as conn:
+            run_id = conn.execute("INSERT INTO runs (started_at, source) VALUES (?, ?)", (started, source)).lastrowid
+        try:
+            payments, missing, foreign = self.find_missing(hours)
+            outcomes = {}
+            if not dry_run:
+                for payment_id in missing:
+                    outcome = self.enqueue(payment_id, "catchup")
+                    outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            summary = {
+                "approved": len(payments), "foreign": len(foreign), "missing": len(missing),
+                "enqueued": outcomes, "missing_ids": missing[:200], "dry_run": dry_run,
+                "seconds": round(time.time() - started, 2),
+            }
+        except Exception as e:
+            with open_db(self.path) as conn:
+                conn.execute("UPDATE runs SET finished_at = ?, error = ? WHERE id = ?", (time.time(), str(e)[:1000], run_id))
+            raise
+        with open_db(self.path) as conn:
+            conn.execute("UPDATE runs SET finished_at = ?, summary_json = ? WHERE id = ?",
+                         (time.time(), json.dumps(summary), run_id))
+        if missing:
+            print(f"Recuperación de pagos: {len(missing)} pagos aprobados sin Historial -> {outcomes or 'sin encolar (dry run)'}")
+        return summary
+
+    # --- Programación ---
+
+    def _take_turn(self):
+        # Una corrida por intervalo entre todos los workers
+        now = time.time()
+        with open_db(self.path) as conn, transaction(conn):
+            row = conn.execute("SELECT value FROM meta WHERE key = 'last_turn'").fetchone()
+            if row and now - float(row["value"]) < self.interval:
+                return False
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_turn', ?)", (str(now),))
+        return True
+
+    def start_periodic(self):
+        """Thread de recuperación, uno por proceso (después del fork)."""
+        if self.interval <= 0 or self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+
+        def loop():
+            while True:
+                try:
+                    if self._take_turn():
+                        self.run()
+                except Exception as e:
+                    print(f"ERROR en la recuperación de pagos de Mercado Pago: {e}")
+                time.sleep(min(60, self.interval))
+
+        threading.Thread(target=loop, name="mp-catchup", daemon=True).start()
+
+    def runs(self, limit=20):
+        with open_db(self.path) as conn:
+            rows = conn.execute("SELECT * FROM runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row, summary=json.loads(row["summary_json"]) if row["summary_json"] else None) for row in rows]
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from airtable_gateway import AirtableGateway
+    from config import BASE_ID, HISTORIAL_TABLE_ID
+    from webhook_queue import WebhookQueue
+
+    parser = argparse.ArgumentParser(description="Recuperar pagos de Mercado Pago sin registro en Historial")
+    parser.add_argument("--hours", type=float, default=MP_CATCHUP_LOOKBACK_HOURS, help="Ventana hacia atrás, en horas")
+    parser.add_argument("--dry-run", action="store_true", help="Solo listar los pagos faltantes")
+    args = parser.parse_args()
+
+    mp_token, airtable_token = os.getenv("MERCADOPAGO_ACCESS_TOKEN"), os.getenv("AIRTABLE_PAT")
+    if not mp_token or not airtable_token:
+        print("ERROR: MERCADOPAGO_ACCESS_TOKEN y AIRTABLE_PAT deben estar configurados")
+        raise SystemExit(1)
+    sdk = mp_sdk(mp_token)
+    historial = AirtableGateway(airtable_token).api.table(BASE_ID, HISTORIAL_TABLE_ID)
+    # Sin handler: acá solo se encola; los procesan los workers del backend (mismo DATA_DIR)
+    queue = WebhookQueue(handler=None)
+
+    catchup = PaymentCatchUp(
+        lambda begin, end: search_approved(sdk, begin, end),
+        lambda begin: [r["fields"].get("MP_Payment_ID") for r in historial.all(formula=historial_formula(begin), fields=["MP_Payment_ID"])],
+        queue.enqueue,
+    )
+    summary = catchup.run(hours=args.hours, dry_run=args.dry_run, source="cli")
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Índice local de obligaciones pendientes (recaudación manual, patente manual y
+plan de pago) para cruzar los pagos de Mercado Pago sin buscar en Airtable.
+
+Los endpoints de registro agregan cada obligación al crear el registro
+"Pendiente"; al aprobarse un pago, `claim` toma la que corresponde por
+(tipo, email, dominio/cuota) y monto, y la marca como pagada en la misma
+transacción (dos pagos simultáneos no se llevan la misma obligación).
+
+- Montos por bucket de $1: el pago se compara solo con los buckets vecinos,
+  con la misma tolerancia de antes (diferencia menor a $1).
+- Varias obligaciones que coinciden ('ambiguous') se resuelven por la más
+  vieja, y un pago que solo coincide con una ya pagada ('duplicate', posible
+  pago doble) no se aplica: en ambos casos queda registrado en `flags` para
+  revisarlo desde el admin.
+- Un reintento del mismo pago vuelve a encontrar la obligación que tomó.
+- Lo que no está en el índice (registrado antes de que existiera) sigue
+  buscándose en Airtable como antes. Una obligación cuyo registro se borró o
+  cambió en Airtable (404/422 al marcarla pagada) sale del índice y se sigue
+  con la búsqueda.
+"""
+
+import json
+import math
+import os
+import time
+
+from local_store import data_path, open_db, transaction
+
+OBLIGATIONS_PATH = os.getenv("OBLIGATIONS_PATH", data_path("obligations.sqlite3"))
+AMOUNT_TOLERANCE = 1.0  # Misma tolerancia que el cruce anterior
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS obligations (
+    record_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    email TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    amount REAL NOT NULL,
+    bucket INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    paid_by TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS obligations_lookup ON obligations (kind, email, ref, bucket);
+CREATE TABLE IF NOT EXISTS flags (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payment_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    amount REAL,
+    record_id TEXT,
+    candidates_json TEXT,
+    created_at REAL NOT NULL
+);
+"""
+
+
+def obligation_key(email, ref):
+    """Email y referencia normalizados (el mismo contribuyente escribe el email de distintas formas)."""
+    return (email or "").strip().lower(), str(ref or "").strip().upper()
+
+
+def amount_bucket(amount):
+    return math.floor(float(amount))
+
+
+class ObligationIndex:
+    def __init__(self, path=OBLIGATIONS_PATH):
+        self.path = path
+        self.counters = {"added": 0, "matched": 0, "ambiguous": 0, "duplicate": 0, "missing": 0}
+        with open_db(self.path) as conn:
+            conn.executescript(SCHEMA)
+
+    def add(self, kind, email, ref, amount, record_id):
+        """Registra una obligación pendiente (record_id del registro recién creado en Airtable)."""
+        email, ref = obligation_key(email, ref)
+        now = time.time()
+        with open_db(self.path) as conn:
+            conn.execute(
+                """INSERT OR REPLACE INTO obligations (record_id, kind, email, ref, amount, bucket, status, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?)""",
+                (record_id, kind, email, ref, float(amount), amount_bucket(amount), now, now)
+            )
+        self.counters["added"] += 1
+
+    def claim(self, kind, email, ref, amount, payment_id):
+        """
+        Toma la obligación pendiente que cubre el pago y la marca pagada. Devuelve
+        {"status": 'matched' | 'ambiguous' | 'duplicate' | 'missing', "record_id", "candidates"}.
+        Con 'ambiguous' se toma la más vieja; con 'duplicate' y 'missing' record_id es None.
+        """
+        email, ref = obligation_key(email, ref)
+        amount = float(amount)
+        bucket = amount_bucket(amount)
+        payment_id = str(payment_id)
+        with open_db(self.path) as conn, transaction(conn):
+            rows = [
+                row for row in conn.execute(
+                    """SELECT record_id, amount, status, paid_by FROM obligations
+                       WHERE kind = ? AND email = ? AND ref = ? AND bucket BETWEEN ? AND ?
+                       ORDER BY created_at""",
+                    (kind, email, ref, bucket - 1, bucket + 1)
+                )
+                if abs(row["amount"] - amount) < AMOUNT_TOLERANCE
+            ]
+            # Reintento del mismo pago: la obligación ya es suya
+            own = [row for row in rows if row["paid_by"] == payment_id]
+            pending = [row for row in rows if row["status"] == "pending"]
+            if own:
+                return {"status": "matched", "record_id": own[0]["record_id"], "candidates": [own[0]["record_id"]]}
+            if pending:
+                record_id = pending[0]["record_id"]
+                conn.execute(
+                    "UPDATE obligations SET status = 'paid', paid_by = ?, updated_at = ? WHERE record_id = ?",
+                    (payment_id, time.time(), record_id)
+                )
+                status = "ambiguous" if len(pending) > 1 else "matched"
+                result = {"status": status, "record_id": record_id, "candidates": [row["record_id"] for row in pending]}
+            elif rows:
+                result = {"status": "duplicate", "record_id": None, "candidates": [row["record_id"] for row in rows]}
+            else:
+                result = {"status": "missing", "record_id": None, "candidates": []}
+        self.counters[result["status"]] += 1
+        if result["status"] in ("ambiguous", "duplicate"):
+            self.flag(payment_id, kind, result["status"], amount, result["record_id"], result["candidates"])
+        return result
+
+    def release(self, record_id, payment_id):
+        """Devuelve a pendiente una obligación tomada por un pago que no llegó a aplicarse."""
+        with open_db(self.path) as conn:
+            conn.execute(
+                "UPDATE obligations SET status = 'pending', paid_by = NULL, updated_at = ? WHERE record_id = ? AND paid_by = ?",
+                (time.time(), record_id, str(payment_id))
+            )
+
+    def remove(self, record_id):
+        """Saca una obligación cuyo registro ya no existe en Airtable."""
+        with open_db(self.path) as conn:
+            conn.execute("DELETE FROM obligations WHERE record_id = ?", (record_id,))
+
+    def mark_paid(self, record_id, payment_id):
+        """Una obligación que se encontró por fuera del índice y se pagó."""
+        with open_db(self.path) as conn:
+            conn.execute(
+                "UPDATE obligations SET status = 'paid', paid_by = ?, updated_at = ? WHERE record_id = ?",
+                (str(payment_id), time.time(), record_id)
+            )
+
+    def flag(self, payment_id, kind, reason, amount=None, record_id=None, candidates=()):
+        print(f"ADVERTENCIA: Pago {payment_id} ({kind}): coincidencia '{reason}' con {list(candidates)}")
+        with open_db(self.path) as conn:
+            conn.execute(
+                """INSERT INTO flags (payment_id, kind, reason, amount, record_id, candidates_json, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (str(payment_id), kind, reason, amount, record_id, json.dumps(list(candidates)), time.time())
+            )
+
+    def flags(self, limit=100):
+        with open_db(self.path) as conn:
+            rows = conn.execute("SELECT * FROM flags ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row, candidates=json.loads(row["candidates_json"] or "[]")) for row in rows]
+
+    def stats(self):
+        with open_db(self.path) as conn:
+            rows = conn.execute("SELECT kind, status, COUNT(*) AS n FROM obligations GROUP BY kind, status").fetchall()
+            flags = conn.execute("SELECT COUNT(*) AS n FROM flags").fetchone()["n"]
+        by_kind = {}
+        for row in rows:
+            by_kind.setdefault(row["kind"], {})[row["status"]] = row["n"]
+        return {**self.counters, "obligations": by_kind, "flags": flags}
@@ -0,0 +1,254 @@
+"""
+Cache read-through de las tablas del padrón (Contributivos, Agua, Patente, Deudas).
+
+- Cada tabla se guarda completa en memoria con un TTL.
+- Pasado el TTL se sigue respondiendo con los datos viejos mientras un thread
+  los recarga (stale-while-revalidate). Si Airtable falla, se conservan.
+- Con la cache fría, la primera búsqueda dispara la carga en segundo plano y
+  el endpoint responde con la consulta directa a Airtable.
+- `invalidate()` aplica los campos escritos sobre el registro y lo publica en
+  un archivo compartido, para que los demás workers de gunicorn hagan lo mismo.
+"""
+
+import json
+import os
+import threading
+import time
+
+from local_store import data_path
+
+try:
+    import fcntl
+except ImportError:  # Windows: las invalidaciones quedan limitadas al proceso actual
+    fcntl = None
+
+PADRON_CACHE_TTL = int(os.getenv("PADRON_CACHE_TTL", "300"))  # segundos
+INVALIDATIONS_FILE = data_path("padron_cache_invalidations.jsonl")
+INVALIDATIONS_MAX_BYTES = 1024 * 1024
+
+
+class TableCache:
+    """Snapshot en memoria de una tabla de Airtable."""
+
+    def __init__(self, name, loader, record_loader=None, ttl=PADRON_CACHE_TTL):
+        self.name = name
+        self.loader = loader  # () -> lista de records
+        self.record_loader = record_loader  # (record_id) -> record
+        self.ttl = ttl
+        self.records = None  # {record_id: record}
+        self.loaded_at = 0
+        self.last_error = None
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def add_listener(self, listener):
+        """listener(event, payload): event es 'reset' (lista de records) o 'upsert' (record)."""
+        self.listeners.append(listener)
+        if self.records is not None:
+            listener('reset', list(self.records.values()))
+
+    def _notify(self, event, payload):
+        for listener in self.listeners:
+            try:
+                listener(event, payload)
+            except Exception as e:
+                print(f"ERROR en listener de cache {self.name}: {e}")
+
+    def is_stale(self):
+        return time.time() - self.loaded_at > self.ttl
+
+    def get_records(self):
+        """
+        Devuelve la lista de records en memoria, o None si la cache todavía no cargó.
+        Nunca bloquea en Airtable: si hace falta recargar, lo hace en segundo plano.
+        """
+        if self.records is None or self.is_stale():
+            self.refresh_async()
+        if self.records is None:
+            return None
+        return list(self.records.values())
+
+    def refresh(self):
+        """Recarga la tabla completa. Ante un error conserva los datos anteriores."""
+        started = time.time()
+        try:
+            records = self.loader()
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"ADVERTENCIA: No se pudo recargar la cache {self.name}, se siguen usando datos previos: {e}")
+            return False
+        with self._lock:
+            self.records = {r['id']: r for r in records}
+            self.loaded_at = started
+            self.last_error = None
+        self._notify('reset', records)
+        return True
+
+    def refresh_async(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name=f"cache-{self.name}", daemon=True).start()
+
+    def apply(self, record_id, fields=None):
+        """Aplica campos escritos a un registro; sin campos, lo vuelve a pedir a Airtable."""
+        if self.records is None:
+            return
+        if fields is not None and record_id in self.records:
+            with self._lock:
+                record = self.records[record_id]
+                record = {**record, 'fields': {**record.get('fields', {}), **fields}}
+                self.records[record_id] = record
+            self._notify('upsert', record)
+            return
+        if not self.record_loader:
+            self.loaded_at = 0
+            return
+
+        def fetch():
+            try:
+                record = self.record_loader(record_id)
+            except Exception as e:
+                print(f"ADVERTENCIA: No se pudo refrescar {record_id} en cache {self.name}: {e}")
+                self.loaded_at = 0  # Forzar recarga completa en la próxima lectura
+                return
+            with self._lock:
+                self.records[record_id] = record
+            self._notify('upsert', record)
+
+        threading.Thread(target=fetch, name=f"cache-{self.name}-{record_id}", daemon=True).start()
+
+    def stats(self):
+        return {
+            "registros": len(self.records) if self.records is not None else None,
+            "edad_segundos": round(time.time() - self.loaded_at, 1) if self.loaded_at else None,
+            "ttl": self.ttl,
+            "ultimo_error": self.last_error,
+        }
+
+
+class PadronCache:
+    """Registro de caches por tabla, con invalidaciones compartidas entre procesos."""
+
+    def __init__(self, invalidations_file=INVALIDATIONS_FILE):
+        self.tables = {}
+        self.invalidations_file = invalidations_file
+        self._offset = None
+        self._offset_pid = None
+        self._lock = threading.Lock()
+
+    def register(self, table_id, name, loader, record_loader=None, ttl=PADRON_CACHE_TTL):
+        self.tables[table_id] = TableCache(name, loader, record_loader, ttl)
+        return self.tables[table_id]
+
+    def get(self, table_id):
+        """TableCache de la tabla, habiendo aplicado antes las invalidaciones de otros workers."""
+        self._consume_invalidations()
+        return self.tables[table_id]
+
+    def records(self, table_id):
+        return self.get(table_id).get_records()
+
+    def invalidate(self, table_id, record_id=None, fields=None):
+        """
+        Invalida un registro (o la tabla entera si no se indica record_id).
+        - Con `fields`: se aplican sobre el registro en memoria sin ir a Airtable.
+        - Sin `fields`: el registro se vuelve a pedir en segundo plano.
+        """
+        if table_id not in self.tables:
+            return
+        self._consume_invalidations()
+        self._apply(table_id, record_id, fields)
+        entry = json.dumps({"table": table_id, "id": record_id, "fields": fields, "pid": os.getpid()})
+        try:
+            with open(self.invalidations_file, 'a+', encoding='utf-8') as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0, os.SEEK_END)
+                if f.tell() > INVALIDATIONS_MAX_BYTES:
+                    # Al rotar, los demás workers detectan el archivo más corto y recargan todo
+                    f.truncate(0)
+                f.write(entry + "\n")
+                f.flush()
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except OSError as e:
+            print(f"ADVERTENCIA: No se pudo publicar invalidación de cache: {e}")
+
+    def _apply(self, table_id, record_id, fields):
+        cache = self.tables.get(table_id)
+        if not cache:
+            return
+        if record_id:
+            cache.apply(record_id, fields)
+        else:
+            cache.loaded_at = 0
+
+    def _consume_invalidations(self):
+        """Lee las invalidaciones publicadas por otros procesos desde la última lectura."""
+        with self._lock:
+            try:
+                with open(self.invalidations_file, 'rb') as f:
+                    # Con el mismo lock que el escritor: ni líneas a medio escribir ni rotaciones
+                    # entre el tamaño y la lectura
+                    if fcntl:
+                        fcntl.flock(f, fcntl.LOCK_SH)
+                    try:
+                        size = os.fstat(f.fileno()).st_size
+                        if self._offset is None or self._offset_pid != os.getpid():
+                            # Proceso nuevo: lo anterior ya está reflejado en la carga inicial
+                            self._offset = size
+                            self._offset_pid = os.getpid()
+                            return
+                        if size == self._offset:
+                            return
+                        if size < self._offset:
+                            self._offset = 0
+                            for cache in self.tables.values():
+                                cache.loaded_at = 0
+                        f.seek(self._offset)
+                        data = f.read(size - self._offset)
+                    finally:
+                        if fcntl:
+                            fcntl.flock(f, fcntl.LOCK_UN)
+            except FileNotFoundError:
+                if self._offset is None or self._offset_pid != os.getpid():
+                    self._offset = 0
+                    self._offset_pid = os.getpid()
+                return
+            except OSError:
+                return
+            # Solo hasta el último salto de línea: una línea incompleta se lee la próxima vez
+            complete = data.rfind(b"\n") + 1
+            self._offset += complete
+        for line in data[:complete].decode('utf-8', errors='replace').splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("pid") == os.getpid():
+                continue
+            self._apply(entry.get("table"), entry.get("id"), entry.get("fields"))
+
+    def stats(self):
+        return {cache.name: cache.stats() for cache in self.tables.values()}
+
+
+def field_text(value):
+    """Texto en minúsculas de un campo, como lo vería LOWER() en una fórmula de Airtable."""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, list):
+        return ", ".join(field_text(v) for v in value)
+    return str(value).lower()
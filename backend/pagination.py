@@ -0,0 +1,203 @@
+"""
+Paginación por cursor para los listados de administración.
+
+Cada página pide solo `per_page` registros a Airtable con `pageSize`/`offset`
+nativos, o al espejo local si la tabla está sincronizada. El cursor que se
+devuelve al cliente es opaco (base64 de un JSON pequeño).
+
+Para no romper los clientes que paginan con `?page=N`, se recuerdan los offsets
+de Airtable de las páginas ya recorridas: avanzar de a una página sigue costando
+una sola llamada.
+
+Los offsets de Airtable vencen: un cursor viejo (422
+LIST_RECORDS_ITERATOR_NOT_AVAILABLE) se rehace recorriendo desde la página 1.
+Un cursor adulterado levanta InvalidCursor (400 en los endpoints).
+
+El total de registros es aproximado y se cachea aparte (se recalcula en segundo
+plano pidiendo un solo campo), así el conteo no se paga en cada página.
+"""
+
+import base64
+import json
+import threading
+import time
+
+# Airtable invalida los offsets a los pocos minutos
+OFFSET_TTL_SECONDS = 240
+TOTAL_COUNT_TTL_SECONDS = 600
+MAX_PAGE_SIZE = 100  # Límite de pageSize de Airtable
+ITERATOR_EXPIRED = "LIST_RECORDS_ITERATOR_NOT_AVAILABLE"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(data):
+    raw = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    """Devuelve el dict del cursor, o None si el token es inválido."""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return data if isinstance(data, dict) else None
+    except (ValueError, TypeError):
+        return None
+
+
+def _iterator_expired(error):
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) == 422 and ITERATOR_EXPIRED in (getattr(response, "text", "") or "")
+
+
+def _sort_to_sql(sort):
+    """['-Fecha', 'Hora'] -> ORDER BY sobre json_extract de los campos del espejo."""
+    parts = []
+    for spec in sort:
+        direction = "DESC" if spec.startswith("-") else "ASC"
+        field = spec.lstrip("-").replace('"', '""')
+        parts.append(f"json_extract(fields_json, '$.\"{field}\"') {direction}")
+    parts.append("record_id DESC")
+    return ", ".join(parts)
+
+
+class Paginator:
+    def __init__(self, api, base_id, mirror=None):
+        self.api = api
+        self.base_id = base_id
+        self.mirror = mirror
+        self._offsets = {}  # (table_id, sort, per_page) -> {page: (offset, timestamp)}
+        self._totals = {}  # table_id -> (total, timestamp)
+        self._counting = set()
+        self._lock = threading.Lock()
+
+    def page(self, table_id, sort, per_page, page=1, cursor=None):
+        """
+        Una página de registros. Devuelve dict con:
+        records, page, next_cursor, total_records, total_records_approx.
+        """
+        per_page = max(1, min(int(per_page), MAX_PAGE_SIZE))
+        state = decode_cursor(cursor) if cursor else None
+        if state and state.get("t") == table_id:
+            try:
+                page = int(state.get("p", page))
+            except (TypeError, ValueError):
+                raise InvalidCursor("Cursor inválido")
+            if page < 1 or not isinstance(state.get("o") or "", str):
+                raise InvalidCursor("Cursor inválido")
+        page = max(1, int(page))
+
+        if self.mirror and self.mirror.is_ready(table_id):
+            records = self.mirror.records(
+                table_id, order_by=_sort_to_sql(sort), limit=per_page + 1, offset=(page - 1) * per_page
+            )
+            has_more = len(records) > per_page
+            records = records[:per_page]
+            next_cursor = encode_cursor({"t": table_id, "p": page + 1}) if has_more else None
+            total = self.mirror.count(table_id)
+            return self._result(records, page, next_cursor, total, approx=False)
+
+        offset = state.get("o") if state and state.get("t") == table_id else None
+        try:
+            if offset is None and page > 1:
+                offset = self._walk_to(table_id, sort, per_page, page)
+            records, next_offset = self._fetch_page(table_id, sort, per_page, page, offset)
+        except Exception as e:
+            if not _iterator_expired(e):
+                raise
+            # Offset vencido (cursor viejo o recordado): se rehace el recorrido desde la página 1
+            self._forget(table_id, sort, per_page)
+            offset = self._walk_to(table_id, sort, per_page, page) if page > 1 else None
+            records, next_offset = self._fetch_page(table_id, sort, per_page, page, offset)
+        next_cursor = None
+        if next_offset:
+            self._remember(table_id, sort, per_page, page + 1, next_offset)
+            next_cursor = encode_cursor({"t": table_id, "p": page + 1, "o": next_offset})
+
+        total, approx = self.total_count(table_id, sort)
+        if total is None:
+            # Mientras se calcula el total, al menos se sabe cuántos hay hasta acá
+            total = (page - 1) * per_page + len(records) + (per_page if next_cursor else 0)
+            approx = True
+        return self._result(records, page, next_cursor, total, approx)
+
+    @staticmethod
+    def _result(records, page, next_cursor, total, approx):
+        return {
+            "records": records,
+            "page": page,
+            "next_cursor": next_cursor,
+            "total_records": total,
+            "total_records_approx": approx,
+        }
+
+    def _fetch_page(self, table_id, sort, per_page, page, offset):
+        if offset is None and page > 1:
+            # La página pedida está más allá del final: vacía, no la primera
+            return [], None
+        return self._fetch(table_id, sort, per_page, offset)
+
+    def _fetch(self, table_id, sort, per_page, offset):
+        table = self.api.table(self.base_id, table_id)
+        options = {"page_size": per_page, "sort": list(sort)}
+        if offset:
+            options["offset"] = offset
+        response = self.api.request("GET", table.urls.records, options=options)
+        return response.get("records", []), response.get("offset")
+
+    def _remember(self, table_id, sort, per_page, page, offset):
+        with self._lock:
+            known = self._offsets.setdefault((table_id, tuple(sort), per_page), {})
+            known[page] = (offset, time.time())
+
+    def _forget(self, table_id, sort, per_page):
+        with self._lock:
+            self._offsets.pop((table_id, tuple(sort), per_page), None)
+
+    def _walk_to(self, table_id, sort, per_page, page):
+        """Offset de Airtable para `page`, partiendo de la página conocida más cercana."""
+        key = (table_id, tuple(sort), per_page)
+        now = time.time()
+        with self._lock:
+            known = {p: o for p, (o, ts) in self._offsets.get(key, {}).items() if now - ts < OFFSET_TTL_SECONDS}
+        start = max([p for p in known if p <= page], default=1)
+        offset = known.get(start)
+        current = start
+        while current < page:
+            _, offset = self._fetch(table_id, sort, per_page, offset)
+            if not offset:
+                return None  # La página pedida está más allá del final
+            current += 1
+            self._remember(table_id, sort, per_page, current, offset)
+        return offset
+
+    def total_count(self, table_id, sort):
+        """(total, aproximado) desde la cache; dispara el recálculo en segundo plano si venció."""
+        with self._lock:
+            cached = self._totals.get(table_id)
+            expired = not cached or time.time() - cached[1] > TOTAL_COUNT_TTL_SECONDS
+            start_count = expired and table_id not in self._counting
+            if start_count:
+                self._counting.add(table_id)
+        if start_count:
+            threading.Thread(target=self._count, args=(table_id, sort), name=f"count-{table_id}", daemon=True).start()
+        if not cached:
+            return None, True
+        return cached[0], True
+
+    def _count(self, table_id, sort):
+        try:
+            # Un solo campo por registro: el conteo es barato en ancho de banda
+            field = sort[0].lstrip("-") if sort else None
+            options = {"fields": [field]} if field else {}
+            total = sum(len(page) for page in self.api.table(self.base_id, table_id).iterate(page_size=MAX_PAGE_SIZE, **options))
+            with self._lock:
+                self._totals[table_id] = (total, time.time())
+        except Exception as e:
+            print(f"ADVERTENCIA: No se pudo contar registros de {table_id}: {e}")
+        finally:
+            with self._lock:
+                self._counting.discard(table_id)
@@ -0,0 +1,197 @@
+"""
+Pool de procesos para generar los comprobantes PDF.
+
+El render de WeasyPrint es CPU y retiene el GIL: hecho dentro del worker de
+gunicorn frena a los demás threads del proceso (requests, jobs, webhooks).
+Acá cada render corre en un proceso aparte y el thread que lo pidió solo
+espera el resultado.
+
+- Los procesos salen de un forkserver que ya importó receipt_renderer, y cada
+  uno hace un render de prueba al arrancar (`start()` los levanta todos).
+- Como mucho PDF_POOL_QUEUE_MAX renders en curso o en espera por proceso de
+  gunicorn; si no hay lugar en PDF_POOL_QUEUE_WAIT segundos se rechaza con
+  `PdfPoolBusy` en vez de acumular requests.
+- Cada render tiene PDF_RENDER_TIMEOUT segundos. Un render vencido sigue
+  ocupando su lugar hasta que termina, así la contrapresión refleja la carga real.
+- Con PDF_POOL_WORKERS=0 se renderiza en el mismo proceso (como antes).
+- RECEIPT_BACKEND=native (o `backend='native'` por llamada) usa el PDF
+  escrito con pydyf (receipt_pdf_native): es liviano y corre en el mismo
+  proceso, sin pasar por el pool.
+"""
+
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import receipt_pdf_native
+import receipt_renderer
+
+PDF_POOL_WORKERS = int(os.getenv("PDF_POOL_WORKERS", "2"))  # procesos por worker de gunicorn
+PDF_POOL_QUEUE_MAX = int(os.getenv("PDF_POOL_QUEUE_MAX", "8"))
+PDF_POOL_QUEUE_WAIT = float(os.getenv("PDF_POOL_QUEUE_WAIT", "5"))  # segundos
+PDF_RENDER_TIMEOUT = float(os.getenv("PDF_RENDER_TIMEOUT", "20"))  # segundos
+RECEIPT_BACKEND = os.getenv("RECEIPT_BACKEND", "weasyprint")  # weasyprint | native
+BACKENDS = ("weasyprint", "native")
+
+
+class PdfPoolBusy(RuntimeError):
+    """No hay lugar en la cola de renders."""
+
+
+# --- Lado del proceso del pool ---
+
+def _init_worker():
+    receipt_renderer.renderer.warm_up()
+
+
+def _render(payment_details, pdf_id):
+    pdf_file, pdf_id = receipt_renderer.renderer.render(payment_details, pdf_id=pdf_id)
+    return pdf_file.getvalue(), pdf_id
+
+
+def _render_many(receipts):
+    return receipt_renderer.renderer.render_many(receipts).getvalue()
+
+
+def _ping():
+    return os.getpid()
+
+
+# --- Lado del worker de gunicorn ---
+
+class PdfPool:
+    def __init__(self, workers=PDF_POOL_WORKERS, queue_max=PDF_POOL_QUEUE_MAX,
+                 queue_wait=PDF_POOL_QUEUE_WAIT, timeout=PDF_RENDER_TIMEOUT):
+        self.workers = workers
+        self.queue_max = queue_max
+        self.queue_wait = queue_wait
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_max)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self.counters = {"rendered": 0, "errors": 0, "timeouts": 0, "rejected": 0, "restarts": 0,
+                         "in_flight": 0, "wait_seconds": 0.0}
+
+    def _get_executor(self):
+        # Un pool por proceso de gunicorn, creado después del fork. forkserver y no fork:
+        # el worker ya tiene threads corriendo y un fork podría heredar locks tomados.
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                context = multiprocessing.get_context("forkserver")
+                # WeasyPrint explícito: receipt_renderer lo importa diferido (lazy_imports) y sin
+                # esto cada proceso del pool lo cargaría de cero en vez de heredarlo del forkserver
+                context.set_forkserver_preload(["weasyprint", "weasyprint.text.fonts", "receipt_renderer"])
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                                     initializer=_init_worker)
+                self._executor_pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(self.queue_max)
+            return self._executor
+
+    def _restart(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+                self.counters["restarts"] += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def start(self):
+        """Levanta y precalienta los procesos sin esperar (idempotente)."""
+        if self.workers <= 0 or self._executor_pid == os.getpid():
+            return
+        executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(_ping)
+
+    def render(self, payment_details, pdf_id=None, backend=None):
+        """(BytesIO con el PDF, pdf_id), igual que receipt_renderer. Levanta PdfPoolBusy o TimeoutError."""
+        backend = self._backend(backend)
+        if backend == "native":
+            return receipt_pdf_native.renderer.render(payment_details, pdf_id=pdf_id)
+        if self.workers <= 0:
+            return receipt_renderer.renderer.render(payment_details, pdf_id=pdf_id)
+        pdf_bytes, pdf_id = self._run(self.timeout, 1, _render, payment_details, pdf_id)
+        return io.BytesIO(pdf_bytes), pdf_id
+
+    def render_many(self, receipts, backend=None):
+        """Un PDF de varias páginas (BytesIO) con todos los comprobantes. receipts: [(payment_details, pdf_id)]."""
+        backend = self._backend(backend)
+        if backend == "native":
+            return receipt_pdf_native.renderer.render_many(receipts)
+        if self.workers <= 0:
+            return receipt_renderer.renderer.render_many(receipts)
+        # El timeout crece con la cantidad: un render por cada 10 comprobantes
+        timeout = self.timeout * max(1, len(receipts) / 10)
+        return io.BytesIO(self._run(timeout, len(receipts), _render_many, receipts))
+
+    @staticmethod
+    def _backend(backend):
+        backend = backend or RECEIPT_BACKEND
+        if backend not in BACKENDS:
+            raise ValueError(f"Backend de comprobantes desconocido: {backend}")
+        return backend
+
+    def _run(self, timeout, count, fn, *args):
+        """Ejecuta fn(*args) en el pool respetando la cola y el timeout."""
+        executor = self._get_executor()
+        slots = self._slots
+        if not slots.acquire(timeout=self.queue_wait):
+            self.counters["rejected"] += 1
+            raise PdfPoolBusy(f"Cola de PDFs llena ({self.queue_max} en curso)")
+        self.counters["in_flight"] += 1
+        started = time.perf_counter()
+
+        def release(_future):
+            self.counters["in_flight"] -= 1
+            slots.release()
+
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            release(None)
+            self._restart(executor)
+            raise
+        except Exception:
+            release(None)
+            raise
+        future.add_done_callback(release)
+
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeout:
+            self.counters["timeouts"] += 1
+            raise TimeoutError(f"El PDF no se generó en {timeout:.0f}s")
+        except BrokenProcessPool:
+            # Un proceso del pool murió (p. ej. sin memoria): el próximo render usa un pool nuevo
+            self.counters["errors"] += 1
+            self._restart(executor)
+            raise
+        except Exception:
+            self.counters["errors"] += 1
+            raise
+        self.counters["rendered"] += count
+        self.counters["wait_seconds"] += time.perf_counter() - started
+        return result
+
+    def stats(self):
+        native = receipt_pdf_native.renderer.stats()
+        if self.workers <= 0:
+            return {"mode": "inline", "default_backend": RECEIPT_BACKEND, **receipt_renderer.renderer.stats(), "native": native}
+        rendered = self.counters["rendered"]
+        seconds = self.counters["wait_seconds"]
+        return {
+            "mode": "pool",
+            "default_backend": RECEIPT_BACKEND,
+            "native": native,
+            "workers": self.workers, "queue_max": self.queue_max,
+            **self.counters,
+            "wait_seconds": round(seconds, 3),
+            "avg_ms": round(seconds / rendered * 1000, 1) if rendered else None,
+        }
+
+
+pool = PdfPool()
@@ -0,0 +1,77 @@
+"""
+Exportación masiva de comprobantes (/api/admin/receipts/export).
+
+- ZIP: se arma y se envía en streaming, un PDF a la vez (`zip_stream`). La
+  memoria no depende de cuántos comprobantes se exporten.
+- PDF único: todos los comprobantes en un PDF de varias páginas, con una sola
+  pasada de layout. Se arma entero en memoria, por eso tiene un máximo
+  (EXPORT_PDF_MAX_RECEIPTS); para más, usar ZIP.
+"""
+
+import io
+import os
+import zipfile
+from datetime import datetime
+
+EXPORT_PDF_MAX_RECEIPTS = int(os.getenv("EXPORT_PDF_MAX_RECEIPTS", "200"))
+EXPORT_PAGE_SIZE = 100  # Records por página de Airtable
+
+
+class _ChunkWriter(io.RawIOBase):
+    """Destino no posicionable para zipfile: junta lo escrito hasta que se lo retira."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def zip_stream(entries):
+    """
+    Genera el ZIP en partes. entries: iterable de (nombre, fn) donde fn() devuelve
+    los bytes del PDF; si levanta una excepción ese comprobante se lista en
+    errores.txt y la exportación sigue.
+    """
+    writer = _ChunkWriter()
+    errors = []
+    # Los PDF ya vienen comprimidos: ZIP_STORED evita gastar CPU en recomprimirlos
+    with zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_STORED) as zf:
+        for name, fn in entries:
+            try:
+                data = fn()
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+                continue
+            zf.writestr(name, data)
+            yield writer.drain()
+        if errors:
+            zf.writestr("errores.txt", "\n".join(errors) + "\n")
+    yield writer.drain()
+
+
+def parse_date(value, name):
+    """'YYYY-MM-DD' -> el mismo texto validado. Levanta ValueError con un mensaje claro."""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise ValueError(f"'{name}' debe tener el formato YYYY-MM-DD")
+
+
+def date_range_formula(date_expr, desde=None, hasta=None):
+    """Condiciones de Airtable para desde <= fecha <= hasta (días completos)."""
+    conditions = []
+    if desde:
+        conditions.append(f"NOT(IS_BEFORE({date_expr}, DATETIME_PARSE('{desde}', 'YYYY-MM-DD')))")
+    if hasta:
+        conditions.append(f"IS_BEFORE({date_expr}, DATEADD(DATETIME_PARSE('{hasta}', 'YYYY-MM-DD'), 1, 'days'))")
+    return conditions
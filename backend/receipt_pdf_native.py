@@ -0,0 +1,280 @@
+"""
+Comprobante PDF escrito directamente con pydyf, sin motor HTML/CSS.
+
+Mismo contenido y disposición que comprobante_template.html (encabezado,
+datos del pago, tabla de ítems, total y pie), con diseño fijo en A4 y las
+fuentes estándar Helvetica del PDF (no se embeben fuentes). Pensado para los
+flujos de mucho volumen (cobros en efectivo): no carga WeasyPrint ni Pango.
+
+Se elige con RECEIPT_BACKEND=native o por llamada
+(`create_receipt_pdf(..., backend='native')`). Comparación con WeasyPrint:
+    python bench_receipts.py
+"""
+
+import io
+import time
+import unicodedata
+import uuid
+from datetime import datetime
+
+from lazy_imports import lazy_import
+
+pydyf = lazy_import("pydyf")
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4 en puntos
+MARGIN = 56
+PADDING = 15
+CONTENT_LEFT = MARGIN + PADDING
+CONTENT_WIDTH = PAGE_WIDTH - 2 * CONTENT_LEFT
+AMOUNT_COLUMN = 130  # Ancho de la columna Monto
+CELL_PADDING = 6
+
+TEXT = (0.2, 0.2, 0.2)          # #333
+TITLE = (0, 0.337, 0.702)       # #0056b3
+BORDER = (0.933, 0.933, 0.933)  # #eee
+HEADER_BG = (0.973, 0.973, 0.973)  # #f8f8f8
+FOOTER = (0.467, 0.467, 0.467)  # #777
+
+# Anchos AFM (1/1000 em) de Helvetica y Helvetica-Bold, caracteres 32 a 126
+_HELVETICA = (
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+)
+_HELVETICA_BOLD = (
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+)
+FONTS = {"F1": ("Helvetica", _HELVETICA), "F2": ("Helvetica-Bold", _HELVETICA_BOLD)}
+
+
+def text_width(text, font, size):
+    widths = FONTS[font][1]
+    total = 0
+    for char in text:
+        # Letras acentuadas (á, ñ...) miden como la letra base
+        base = unicodedata.normalize("NFKD", char)[:1] or char
+        code = ord(base)
+        total += widths[code - 32] if 32 <= code <= 126 else 556
+    return total * size / 1000
+
+
+def wrap(text, font, size, width):
+    """Parte el texto en líneas que entran en `width`."""
+    lines, current = [], ""
+    for word in str(text).split() or [""]:
+        candidate = f"{current} {word}" if current else word
+        if current and text_width(candidate, font, size) > width:
+            lines.append(current)
+            current = word
+        else:
+            current = candidate
+    lines.append(current)
+    return lines
+
+
+class _Page:
+    def __init__(self):
+        self.stream = pydyf.Stream(compress=True)
+        self.y = PAGE_HEIGHT - MARGIN - PADDING
+
+    def text(self, x, y, text, font="F1", size=12, color=TEXT):
+        self.stream.set_color_rgb(*color)
+        self.stream.begin_text()
+        self.stream.set_font_size(font, size)
+        self.stream.move_text_to(x, y)
+        # WinAnsiEncoding: los acentos del castellano entran en cp1252
+        self.stream.show_text_string(str(text).encode("cp1252", "replace"))
+        self.stream.end_text()
+
+    def text_aligned(self, text, y, font="F1", size=12, color=TEXT, align="left", left=CONTENT_LEFT, width=CONTENT_WIDTH):
+        x = left
+        if align == "center":
+            x = left + (width - text_width(text, font, size)) / 2
+        elif align == "right":
+            x = left + width - text_width(text, font, size)
+        self.text(x, y, text, font, size, color)
+
+    def rect(self, x, y, width, height, fill=None, stroke=None):
+        if fill:
+            self.stream.set_color_rgb(*fill)
+            self.stream.rectangle(x, y, width, height)
+            self.stream.fill()
+        if stroke:
+            self.stream.set_color_rgb(*stroke, stroke=True)
+            self.stream.set_line_width(0.75)
+            self.stream.rectangle(x, y, width, height)
+            self.stream.stroke()
+
+    def line(self, x1, y1, x2, y2, color=BORDER):
+        self.stream.set_color_rgb(*color, stroke=True)
+        self.stream.set_line_width(0.75)
+        self.stream.move_to(x1, y1)
+        self.stream.line_to(x2, y2)
+        self.stream.stroke()
+
+
+class NativeReceiptRenderer:
+    def __init__(self):
+        self.counters = {"rendered": 0, "errors": 0, "render_seconds": 0.0, "bytes": 0}
+
+    # --- Armado de páginas ---
+
+    def _header(self, page):
+        page.y -= 18
+        page.text_aligned("Comprobante de Pago", page.y, "F2", 18, TITLE, align="center")
+        page.y -= 22
+        page.text_aligned("Comuna de Villa Traful - Provincia de Neuquén", page.y, "F2", 12, align="center")
+        page.y -= 15
+        page.text_aligned("CUIT: 30-67297005-5. Laffitte 0 . Villa Traful.", page.y, "F1", 9, align="center")
+        page.y -= 10
+        page.line(CONTENT_LEFT, page.y, CONTENT_LEFT + CONTENT_WIDTH, page.y)
+        page.y -= 15
+
+    def _details(self, page, rows):
+        for label, value in rows:
+            page.y -= 14
+            page.text(CONTENT_LEFT, page.y, label, "F2", 12)
+            page.text(CONTENT_LEFT + text_width(label, "F2", 12) + 3, page.y, value, "F1", 12)
+            page.y -= 4
+        page.y -= 15
+
+    def _table_row(self, page, description, amount, header=False):
+        font = "F2" if header else "F1"
+        desc_width = CONTENT_WIDTH - AMOUNT_COLUMN
+        lines = wrap(description, font, 12, desc_width - 2 * CELL_PADDING)
+        height = len(lines) * 14 + 2 * CELL_PADDING
+        top = page.y
+        bottom = top - height
+        page.rect(CONTENT_LEFT, bottom, desc_width, height, fill=HEADER_BG if header else None, stroke=BORDER)
+        page.rect(CONTENT_LEFT + desc_width, bottom, AMOUNT_COLUMN, height, fill=HEADER_BG if header else None, stroke=BORDER)
+        baseline = top - CELL_PADDING - 11
+        for line in lines:
+            page.text(CONTENT_LEFT + CELL_PADDING, baseline, line, font, 12)
+            baseline -= 14
+        page.text_aligned(amount, top - CELL_PADDING - 11, font, 12, align="left" if header else "right",
+                          left=CONTENT_LEFT + desc_width + CELL_PADDING, width=AMOUNT_COLUMN - 2 * CELL_PADDING)
+        page.y = bottom
+        return height
+
+    def _container(self, page, top):
+        # Borde del recuadro (como .container): se dibuja al cerrar la página
+        page.rect(MARGIN, page.y - PADDING, PAGE_WIDTH - 2 * MARGIN, top - page.y + PADDING, stroke=BORDER)
+
+    def _layout(self, payment_details, pdf_id):
+        """Páginas del comprobante (normalmente una)."""
+        rows = [
+            ("ID de Comprobante:", pdf_id),
+            ("Fecha de Pago:", payment_details.get("FECHA_PAGO", datetime.now().strftime("%d/%m/%Y %H:%M:%S"))),
+            ("Estado del Pago:", payment_details.get("ESTADO_PAGO", "N/A")),
+            ("ID de Operación (Mercado Pago):", payment_details.get("ID_PAGO_MP", "N/A")),
+        ]
+        top = PAGE_HEIGHT - MARGIN
+        pages = [_Page()]
+        page = pages[0]
+        self._header(page)
+        self._details(page, [(label, str(value)) for label, value in rows])
+        self._table_row(page, "Descripción", "Monto", header=True)
+        for item in payment_details.get("items", []):
+            description = str(item.get("description", ""))
+            needed = len(wrap(description, "F1", 12, CONTENT_WIDTH - AMOUNT_COLUMN - 2 * CELL_PADDING)) * 14 + 2 * CELL_PADDING
+            if page.y - needed < MARGIN + PADDING:
+                # Sin lugar: la tabla sigue en otra página, repitiendo el encabezado
+                self._container(page, top)
+                page = _Page()
+                pages.append(page)
+                self._table_row(page, "Descripción", "Monto", header=True)
+            self._table_row(page, description, f"${item.get('amount', 0)}")
+
+        if page.y - 100 < MARGIN + PADDING:
+            self._container(page, top)
+            page = _Page()
+            pages.append(page)
+        page.y -= 34
+        page.text_aligned(f"Total Pagado: ${payment_details.get('MONTO_TOTAL', 0)}", page.y, "F2", 13.5, align="right")
+        page.y -= 36
+        page.text_aligned("Gracias por tu pago.", page.y, "F1", 9, FOOTER, align="center")
+        page.y -= 14
+        page.text_aligned("Este es un comprobante generado automáticamente, no requiere firma.", page.y, "F1", 9, FOOTER, align="center")
+        self._container(page, top)
+        return pages
+
+    def build(self, payment_details, pdf_id):
+        """PDF del comprobante en bytes."""
+        return self._write(self._layout(payment_details, pdf_id))
+
+    def _write(self, pages):
+        pdf = pydyf.PDF()
+        pdf.info["Title"] = pydyf.String("Comprobante de Pago")
+        pdf.info["Producer"] = pydyf.String("trafulapp-pago")
+        fonts = pydyf.Dictionary()
+        for name, (base_font, _) in FONTS.items():
+            font = pydyf.Dictionary({
+                "Type": "/Font", "Subtype": "/Type1",
+                "BaseFont": f"/{base_font}", "Encoding": "/WinAnsiEncoding",
+            })
+            pdf.add_object(font)
+            fonts[name] = font.reference
+        resources = pydyf.Dictionary({"Font": fonts})
+        for page in pages:
+            pdf.add_object(page.stream)
+            pdf.add_page(pydyf.Dictionary({
+                "Type": "/Page",
+                "Parent": pdf.pages.reference,
+                "MediaBox": pydyf.Array([0, 0, PAGE_WIDTH, PAGE_HEIGHT]),
+                "Contents": page.stream.reference,
+                "Resources": resources,
+            }))
+        output = io.BytesIO()
+        pdf.write(output, compress=True)
+        return output.getvalue()
+
+    # --- Misma interfaz que receipt_renderer ---
+
+    def render_many(self, receipts):
+        """Varios comprobantes en un PDF de varias páginas. receipts: [(payment_details, pdf_id)]."""
+        started = time.perf_counter()
+        try:
+            data = self._write([page for details, pdf_id in receipts for page in self._layout(details, pdf_id)])
+        except Exception:
+            self.counters["errors"] += 1
+            raise
+        self.counters["rendered"] += len(receipts)
+        self.counters["render_seconds"] += time.perf_counter() - started
+        self.counters["bytes"] += len(data)
+        return io.BytesIO(data)
+
+    def render(self, payment_details, pdf_id=None):
+        """(BytesIO con el PDF, pdf_id)."""
+        pdf_id = pdf_id or str(uuid.uuid4())
+        started = time.perf_counter()
+        try:
+            data = self.build(payment_details, pdf_id)
+        except Exception:
+            self.counters["errors"] += 1
+            raise
+        self.counters["rendered"] += 1
+        self.counters["render_seconds"] += time.perf_counter() - started
+        self.counters["bytes"] += len(data)
+        return io.BytesIO(data), pdf_id
+
+    def stats(self):
+        rendered = self.counters["rendered"]
+        seconds = self.counters["render_seconds"]
+        return {
+            **self.counters,
+            "render_seconds": round(seconds, 3),
+            "avg_ms": round(seconds / rendered * 1000, 1) if rendered else None,
+            "receipts_per_second": round(rendered / seconds, 2) if seconds else None,
+            "avg_bytes": self.counters["bytes"] // rendered if rendered else None,
+        }
+
+
+renderer = NativeReceiptRenderer()
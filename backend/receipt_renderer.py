@@ -0,0 +1,184 @@
+"""
+Generación de comprobantes PDF con WeasyPrint.
+
+El template (comprobante_template.html) se lee una sola vez por proceso: la
+hoja de estilos del <style> se parsea una vez como `CSS` y se reutiliza junto
+con una única `FontConfiguration`, así cada comprobante solo arma su HTML y
+lo renderiza. Los placeholders {{CAMPO}} se completan en una sola pasada,
+escapando los valores (nombres y descripciones los carga el usuario).
+
+Con `preload_app` de gunicorn y render en el mismo proceso (PDF_POOL_WORKERS=0)
+el template se carga y se hace un render de prueba en el proceso master
+(`warm_up()`), antes del fork: los workers arrancan con las fuentes ya
+descubiertas. WeasyPrint en sí se importa recién en el primer render.
+
+    python receipt_renderer.py --bench 50
+"""
+
+import argparse
+import html
+import io
+import os
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from lazy_imports import lazy_import
+
+# WeasyPrint (Pango, Cairo, fontconfig) se carga en el primer render, no al importar:
+# los workers de gunicorn que mandan los PDF al pool nunca lo cargan
+weasyprint = lazy_import("weasyprint")
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'comprobante_template.html')
+
+PLACEHOLDER_RE = re.compile(r"{{(\w+)}}")
+STYLE_RE = re.compile(r"<style[^>]*>(.*?)</style>", re.DOTALL | re.IGNORECASE)
+BODY_RE = re.compile(r"(<body[^>]*>)(.*)(</body>)", re.DOTALL | re.IGNORECASE)
+PAGE_BREAK = '<div style="break-before: page"></div>'
+
+# Opciones de write_pdf: fuentes recortadas a los glifos usados, sin hinting e imágenes optimizadas
+PDF_OPTIONS = {"full_fonts": False, "hinting": False, "optimize_images": True, "uncompressed_pdf": False}
+
+SAMPLE_DETAILS = {
+    "FECHA_PAGO": "01/01/2026 12:00:00",
+    "ESTADO_PAGO": "Aprobado",
+    "ID_PAGO_MP": "0000000000",
+    "NOMBRE_PAGADOR": "Contribuyente de Prueba",
+    "IDENTIFICADOR_PAGADOR": "00000000",
+    "items": [{"description": "Tasa Municipal", "amount": 1000}, {"description": "Descuento", "amount": -100}],
+    "MONTO_TOTAL": 900,
+}
+
+
+class ReceiptRenderer:
+    def __init__(self, template_path=TEMPLATE_PATH):
+        self.template_path = template_path
+        self._template = None
+        self._stylesheet = None
+        self._font_config = None
+        self._image_cache = {}
+        # WeasyPrint no garantiza renders concurrentes con la misma FontConfiguration
+        self._render_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.counters = {"rendered": 0, "errors": 0, "render_seconds": 0.0, "bytes": 0}
+
+    def _load(self):
+        if self._template is not None:
+            return
+        with self._load_lock:
+            if self._template is not None:
+                return
+            with open(self.template_path, 'r', encoding='utf-8') as f:
+                source = f.read()
+            # La hoja de estilos se parsea una vez y se pasa aparte en cada render
+            css = "\n".join(STYLE_RE.findall(source))
+            from weasyprint.text.fonts import FontConfiguration
+            self._font_config = FontConfiguration()
+            self._stylesheet = weasyprint.CSS(string=css, font_config=self._font_config)
+            self._template = STYLE_RE.sub("", source)
+
+    def fill(self, payment_details, pdf_id):
+        """HTML del comprobante con los placeholders completados."""
+        self._load()
+        items_html = "".join(
+            f"<tr><td>{html.escape(str(item.get('description', '')))}</td>"
+            f"<td style='text-align: right;'>${html.escape(str(item.get('amount', 0)))}</td></tr>"
+            for item in payment_details.get("items", [])
+        )
+        values = {
+            "PDF_ID": html.escape(str(pdf_id)),
+            "FECHA_PAGO": html.escape(str(payment_details.get("FECHA_PAGO", datetime.now().strftime("%d/%m/%Y %H:%M:%S")))),
+            "ESTADO_PAGO": html.escape(str(payment_details.get("ESTADO_PAGO", "N/A"))),
+            "ID_PAGO_MP": html.escape(str(payment_details.get("ID_PAGO_MP", "N/A"))),
+            "NOMBRE_PAGADOR": html.escape(str(payment_details.get("NOMBRE_PAGADOR", "N/A"))),
+            "IDENTIFICADOR_PAGADOR": html.escape(str(payment_details.get("IDENTIFICADOR_PAGADOR", "N/A"))),
+            "ITEMS_PAGADOS": items_html,
+            "MONTO_TOTAL": html.escape(str(payment_details.get("MONTO_TOTAL", 0))),
+        }
+        return PLACEHOLDER_RE.sub(lambda m: values.get(m.group(1), m.group(0)), self._template)
+
+    def fill_many(self, receipts):
+        """Un solo HTML con un comprobante por página. receipts: [(payment_details, pdf_id)]."""
+        bodies = [BODY_RE.search(self.fill(details, pdf_id)).group(2) for details, pdf_id in receipts]
+        return BODY_RE.sub(lambda m: m.group(1) + PAGE_BREAK.join(bodies) + m.group(3), self._template, count=1)
+
+    def _write(self, html_filled, count):
+        started = time.perf_counter()
+        try:
+            pdf_file = io.BytesIO()
+            with self._render_lock:
+                weasyprint.HTML(string=html_filled).write_pdf(
+                    target=pdf_file, stylesheets=[self._stylesheet], font_config=self._font_config,
+                    cache=self._image_cache, **PDF_OPTIONS
+                )
+        except Exception:
+            self.counters["errors"] += 1
+            raise
+        pdf_file.seek(0)
+        self.counters["rendered"] += count
+        self.counters["render_seconds"] += time.perf_counter() - started
+        self.counters["bytes"] += pdf_file.getbuffer().nbytes
+        return pdf_file
+
+    def render(self, payment_details, pdf_id=None):
+        """(BytesIO con el PDF, pdf_id). Levanta la excepción si falla el render."""
+        pdf_id = pdf_id or str(uuid.uuid4())
+        return self._write(self.fill(payment_details, pdf_id), 1), pdf_id
+
+    def render_many(self, receipts):
+        """Varios comprobantes en un PDF de varias páginas, con una sola pasada de layout."""
+        return self._write(self.fill_many(receipts), len(receipts))
+
+    def warm_up(self):
+        """Carga template, CSS y fuentes y hace un render de prueba (no cuenta en las estadísticas)."""
+        started = time.perf_counter()
+        counters = dict(self.counters)
+        try:
+            self.render(SAMPLE_DETAILS, pdf_id="warm-up")
+            print(f"Comprobantes: render de prueba listo en {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            print(f"ADVERTENCIA: Falló el render de prueba de comprobantes: {e}")
+        finally:
+            self.counters = counters
+
+    def stats(self):
+        rendered = self.counters["rendered"]
+        seconds = self.counters["render_seconds"]
+        return {
+            **self.counters,
+            "render_seconds": round(seconds, 3),
+            "avg_ms": round(seconds / rendered * 1000, 1) if rendered else None,
+            "receipts_per_second": round(rendered / seconds, 2) if seconds else None,
+            "avg_bytes": self.counters["bytes"] // rendered if rendered else None,
+        }
+
+
+renderer = ReceiptRenderer()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render de comprobantes PDF")
+    parser.add_argument("--bench", type=int, metavar="N", help="Renderizar N comprobantes de prueba y medir")
+    parser.add_argument("--out", help="Guardar un comprobante de prueba en este archivo")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    renderer.warm_up()
+    print(f"Arranque (template, CSS y fuentes): {time.perf_counter() - started:.2f}s")
+    if args.out:
+        pdf_file, _ = renderer.render(SAMPLE_DETAILS)
+        with open(args.out, "wb") as f:
+            f.write(pdf_file.getvalue())
+        print(f"Comprobante de prueba guardado en {args.out}")
+    if args.bench:
+        for _ in range(args.bench):
+            renderer.render(SAMPLE_DETAILS)
+        stats = renderer.stats()
+        print(f"{stats['rendered']} comprobantes: {stats['receipts_per_second']} por segundo, "
+              f"{stats['avg_ms']} ms y {stats['avg_bytes']} bytes en promedio")
+
+
+if __name__ == "__main__":
+    main()
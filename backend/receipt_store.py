@@ -0,0 +1,214 @@
+"""
+Almacén local de comprobantes PDF ya generados.
+
+Un comprobante no cambia después del pago: se guarda una vez y las descargas
+siguientes sirven esos bytes sin consultar Airtable ni volver a renderizar.
+
+- Los PDF se guardan por contenido (sha256) en DATA_DIR/receipts/; el mismo
+  contenido se guarda una sola vez aunque lo referencien varias claves.
+- Las claves son el PDF_ID y, como alias, el ID del registro de Historial
+  (links viejos /api/receipt/rec...).
+- El sha256 es también el ETag de la descarga (If-None-Match -> 304).
+- Tamaño acotado (RECEIPT_STORE_MAX_MB): al pasarse se borran los PDF usados
+  hace más tiempo; si se vuelven a pedir se regeneran.
+- Links de descarga firmados y con vencimiento (`sign` / `verify`, HMAC con
+  RECEIPT_URL_SECRET) para que los endpoints de cobro devuelvan una URL en
+  vez del PDF en base64.
+"""
+
+import hashlib
+import hmac
+import os
+import secrets
+import tempfile
+import time
+
+from local_store import data_path, open_db, transaction
+
+RECEIPT_STORE_PATH = os.getenv("RECEIPT_STORE_PATH", data_path("receipts.sqlite3"))
+RECEIPT_STORE_DIR = os.getenv("RECEIPT_STORE_DIR", data_path("receipts", ""))
+RECEIPT_STORE_MAX_MB = float(os.getenv("RECEIPT_STORE_MAX_MB", "500"))
+# Al desalojar se baja hasta esta fracción del máximo, para no desalojar en cada alta
+EVICT_TARGET = 0.9
+# Solo se actualiza el último acceso si pasó más que esto (evita una escritura por descarga)
+TOUCH_SECONDS = 300
+RECEIPT_URL_TTL = int(os.getenv("RECEIPT_URL_TTL", "3600"))  # segundos
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_lru ON blobs (last_access);
+CREATE TABLE IF NOT EXISTS receipt_keys (
+    key TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS receipt_keys_sha ON receipt_keys (sha256);
+"""
+
+SECRET_READ_ATTEMPTS = 5
+
+
+def _shared_secret(path):
+    """Secreto guardado en `path`; lo crea si no existe. Todos los procesos leen el mismo."""
+    for _ in range(SECRET_READ_ATTEMPTS):
+        if not os.path.exists(path):
+            # Se escribe completo en un temporal y se publica de una vez: nadie lee un archivo
+            # vacío. link() no pisa el de otro worker que ganó la carrera (replace sí lo haría)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(secrets.token_hex(32))
+                os.chmod(tmp, 0o600)
+                os.link(tmp, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp)
+        with open(path) as f:
+            secret = f.read().strip()
+        if secret:
+            return secret
+        time.sleep(0.1)
+    raise RuntimeError(f"El secreto de links de comprobantes en {path} está vacío")
+
+
+class ReceiptStore:
+    def __init__(self, path=RECEIPT_STORE_PATH, blob_dir=RECEIPT_STORE_DIR, max_mb=RECEIPT_STORE_MAX_MB):
+        self.path = path
+        self.blob_dir = blob_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.counters = {"hits": 0, "misses": 0, "stored": 0, "deduplicated": 0, "evicted": 0}
+        self._secret = None
+        os.makedirs(self.blob_dir, exist_ok=True)
+        with open_db(self.path) as conn:
+            conn.executescript(SCHEMA)
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256[:2], f"{sha256}.pdf")
+
+    # --- Alta ---
+
+    def put(self, key, data, aliases=()):
+        """Guarda el PDF bajo `key` (y sus alias). Devuelve el sha256."""
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(sha256)
+        if os.path.exists(path):
+            self.counters["deduplicated"] += 1
+        else:
+            # Escritura atómica: nadie lee un archivo a medio escribir
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self.counters["stored"] += 1
+
+        now = time.time()
+        with open_db(self.path) as conn, transaction(conn):
+            conn.execute(
+                """INSERT INTO blobs (sha256, size, created_at, last_access) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(sha256) DO UPDATE SET last_access = excluded.last_access""",
+                (sha256, len(data), now, now)
+            )
+            conn.executemany("INSERT OR REPLACE INTO receipt_keys (key, sha256) VALUES (?, ?)",
+                             [(str(k), sha256) for k in (key, *aliases) if k])
+        self._evict()
+        return sha256
+
+    def alias(self, alias, key):
+        """Agrega `alias` como otra clave del PDF guardado bajo `key`. False si no está."""
+        with open_db(self.path) as conn:
+            cursor = conn.execute(
+                "INSERT OR REPLACE INTO receipt_keys (key, sha256) SELECT ?, sha256 FROM receipt_keys WHERE key = ?",
+                (str(alias), str(key))
+            )
+        return cursor.rowcount > 0
+
+    # --- Lectura ---
+
+    def etag(self, key):
+        """sha256 del PDF guardado bajo `key`, o None."""
+        with open_db(self.path) as conn:
+            row = conn.execute("SELECT sha256 FROM receipt_keys WHERE key = ?", (str(key),)).fetchone()
+        return row["sha256"] if row else None
+
+    def open(self, key):
+        """(sha256, archivo abierto) del PDF guardado bajo `key`, o None si no está."""
+        sha256 = self.etag(key)
+        if sha256:
+            try:
+                f = open(self._blob_path(sha256), "rb")
+            except FileNotFoundError:
+                f = None  # Desalojado entre la consulta y la apertura
+            if f:
+                self._touch(sha256)
+                self.counters["hits"] += 1
+                return sha256, f
+        self.counters["misses"] += 1
+        return None
+
+    def _touch(self, sha256):
+        now = time.time()
+        with open_db(self.path) as conn:
+            conn.execute("UPDATE blobs SET last_access = ? WHERE sha256 = ? AND last_access < ?",
+                         (now, sha256, now - TOUCH_SECONDS))
+
+    # --- Desalojo ---
+
+    def _evict(self):
+        with open_db(self.path) as conn, transaction(conn):
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) AS total FROM blobs").fetchone()["total"]
+            if total <= self.max_bytes:
+                return
+            victims = []
+            for row in conn.execute("SELECT sha256, size FROM blobs ORDER BY last_access"):
+                if total <= self.max_bytes * EVICT_TARGET:
+                    break
+                victims.append(row["sha256"])
+                total -= row["size"]
+            conn.executemany("DELETE FROM blobs WHERE sha256 = ?", [(sha,) for sha in victims])
+            conn.executemany("DELETE FROM receipt_keys WHERE sha256 = ?", [(sha,) for sha in victims])
+        for sha256 in victims:
+            try:
+                os.remove(self._blob_path(sha256))
+            except FileNotFoundError:
+                pass
+        self.counters["evicted"] += len(victims)
+
+    # --- Links firmados ---
+
+    def _url_secret(self):
+        # Sin RECEIPT_URL_SECRET se usa uno generado en DATA_DIR, compartido por los workers de la máquina
+        if self._secret is None:
+            secret = os.getenv("RECEIPT_URL_SECRET")
+            if not secret:
+                secret = _shared_secret(data_path("receipt_url_secret"))
+            self._secret = secret.encode()
+        return self._secret
+
+    def _signature(self, key, expires):
+        return hmac.new(self._url_secret(), f"{key}:{expires}".encode(), hashlib.sha256).hexdigest()[:32]
+
+    def sign(self, key, ttl=RECEIPT_URL_TTL):
+        """Parámetros de un link de descarga de `key` válido por `ttl` segundos."""
+        expires = int(time.time()) + ttl
+        return {"expires": expires, "sig": self._signature(key, expires)}
+
+    def verify(self, key, expires, sig):
+        """True si la firma corresponde a `key` y el link no venció."""
+        try:
+            expires = int(expires)
+        except (TypeError, ValueError):
+            return False
+        return expires >= time.time() and hmac.compare_digest(self._signature(key, expires), str(sig or ""))
+
+    def stats(self):
+        with open_db(self.path) as conn:
+            blobs = conn.execute("SELECT COUNT(*) AS n, COALESCE(SUM(size), 0) AS size FROM blobs").fetchone()
+            keys = conn.execute("SELECT COUNT(*) AS n FROM receipt_keys").fetchone()["n"]
+        return {**self.counters, "receipts": blobs["n"], "keys": keys,
+                "size_mb": round(blobs["size"] / 1024 / 1024, 2), "max_mb": round(self.max_bytes / 1024 / 1024, 2)}
@@ -0,0 +1,292 @@
+"""
+Índices en memoria para los buscadores del padrón.
+
+`DniNameIndex` es un índice invertido por token sobre `dni` y `contribuyente`:
+- Minúsculas y sin acentos ("Muñoz" se encuentra con "munoz").
+- Los DNI múltiples ("24017675 - 33043380") quedan como tokens separados y
+  los puntos de miles se ignoran ("24.017.675" == "24017675").
+- Cada término debe aparecer dentro de algún token del campo; se mantiene la
+  semántica de las fórmulas originales: todos los términos en el DNI, o todos
+  los términos en el nombre.
+
+`PrefixIndex` ordena sugerencias para el typeahead de deudas: primero los
+nombres que empiezan con lo tipeado, después los que tienen una palabra que
+empieza así, y por último los que lo contienen en cualquier lugar.
+
+Ambos se reconstruyen desde el snapshot de la cache del padrón y se actualizan
+registro por registro (ver `listener`).
+"""
+
+import bisect
+import heapq
+import re
+import threading
+import unicodedata
+
+_THOUSANDS_DOT = re.compile(r"(?<=\d)\.(?=\d)")
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def fold(text):
+    """Minúsculas y sin diacríticos."""
+    if text is None:
+        return ""
+    if isinstance(text, float) and text.is_integer():
+        text = int(text)
+    if isinstance(text, list):
+        text = " ".join(str(t) for t in text)
+    normalized = unicodedata.normalize("NFKD", str(text).lower())
+    return "".join(c for c in normalized if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return _TOKEN.findall(_THOUSANDS_DOT.sub("", fold(text)))
+
+
+def _trigrams(token):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+class TokenIndex:
+    """Índice invertido de un campo: token -> ids, más un índice de trigramas del vocabulario."""
+
+    def __init__(self):
+        self.postings = {}  # token -> set(record_id)
+        self.doc_tokens = {}  # record_id -> set(token)
+        self.grams = {}  # trigrama -> set(token)
+        self.text_tokens = set()  # tokens con alguna letra (los DNI son solo dígitos)
+
+    def add(self, record_id, tokens):
+        self.remove(record_id)
+        tokens = set(tokens)
+        self.doc_tokens[record_id] = tokens
+        for token in tokens:
+            ids = self.postings.get(token)
+            if ids is None:
+                ids = self.postings[token] = set()
+                if not token.isdigit():
+                    self.text_tokens.add(token)
+                for gram in _trigrams(token):
+                    self.grams.setdefault(gram, set()).add(token)
+            ids.add(record_id)
+
+    def remove(self, record_id):
+        for token in self.doc_tokens.pop(record_id, ()):
+            ids = self.postings.get(token)
+            if ids is None:
+                continue
+            ids.discard(record_id)
+            if not ids:
+                del self.postings[token]
+                self.text_tokens.discard(token)
+                for gram in _trigrams(token):
+                    tokens = self.grams.get(gram)
+                    if tokens is not None:
+                        tokens.discard(token)
+                        if not tokens:
+                            del self.grams[gram]
+
+    def tokens_containing(self, term):
+        """Tokens del vocabulario que contienen `term`."""
+        if len(term) >= 3:
+            gram_sets = [self.grams.get(g) for g in _trigrams(term)]
+            if any(s is None for s in gram_sets):
+                return []
+            gram_sets.sort(key=len)
+            candidates = set(gram_sets[0])
+            for s in gram_sets[1:]:
+                candidates &= s
+                if not candidates:
+                    return []
+        else:
+            # Términos de 1-2 caracteres: se recorre el vocabulario (mucho menor que la tabla).
+            # Un término con letras no puede estar dentro de un token numérico.
+            candidates = self.postings.keys() if term.isdigit() else self.text_tokens
+        return [token for token in candidates if term in token]
+
+    def ids_matching(self, term):
+        ids = set()
+        for token in self.tokens_containing(term):
+            ids |= self.postings[token]
+        return ids
+
+    def ids_matching_all(self, terms):
+        result = None
+        # Primero los términos más largos: suelen ser los más selectivos
+        for term in sorted(terms, key=len, reverse=True):
+            ids = self.ids_matching(term)
+            result = ids if result is None else result & ids
+            if not result:
+                return set()
+        return result or set()
+
+
+class DniNameIndex:
+    """Índice de búsqueda por DNI o nombre del contribuyente para una tabla del padrón."""
+
+    def __init__(self, dni_field='dni', name_field='contribuyente'):
+        self.dni_field = dni_field
+        self.name_field = name_field
+        self.ready = False
+        self._lock = threading.Lock()
+        self._reset_state()
+
+    def _reset_state(self):
+        self.dni = TokenIndex()
+        self.name = TokenIndex()
+        self.records = {}
+        self.position = {}
+
+    def _index_record(self, record):
+        fields = record.get('fields', {})
+        record_id = record['id']
+        self.records[record_id] = record
+        self.position.setdefault(record_id, len(self.position))
+        self.dni.add(record_id, tokenize(fields.get(self.dni_field)))
+        self.name.add(record_id, tokenize(fields.get(self.name_field)))
+
+    def rebuild(self, records):
+        """Reconstruye el índice completo. Las búsquedas en curso siguen usando el anterior."""
+        fresh = DniNameIndex(self.dni_field, self.name_field)
+        for record in records:
+            fresh._index_record(record)
+        with self._lock:
+            self.dni, self.name = fresh.dni, fresh.name
+            self.records, self.position = fresh.records, fresh.position
+            self.ready = True
+
+    def upsert(self, record):
+        with self._lock:
+            self._index_record(record)
+
+    def remove(self, record_id):
+        with self._lock:
+            self.dni.remove(record_id)
+            self.name.remove(record_id)
+            self.records.pop(record_id, None)
+
+    def listener(self, event, payload):
+        """Para TableCache.add_listener: 'reset' reconstruye, 'upsert' actualiza un registro."""
+        if event == 'reset':
+            self.rebuild(payload)
+        elif event == 'upsert':
+            self.upsert(payload)
+
+    def search(self, query):
+        """Records donde todos los términos están en el DNI o todos en el nombre, en orden de tabla."""
+        terms = []
+        for raw_term in query.split():
+            terms.extend(tokenize(raw_term))
+        if not terms:
+            return []
+        with self._lock:
+            ids = self.dni.ids_matching_all(terms) | self.name.ids_matching_all(terms)
+            return [self.records[i] for i in sorted(ids, key=self.position.__getitem__)]
+
+
+class PrefixIndex:
+    """Índice de prefijos rankeado sobre un campo de nombre (typeahead)."""
+
+    # Rangos de coincidencia, de mejor a peor
+    EXACT_PREFIX, WORD_PREFIX, SUBSTRING = 0, 1, 2
+
+    def __init__(self, name_field):
+        self.name_field = name_field
+        self.ready = False
+        self._lock = threading.Lock()
+        self.names = {}  # record_id -> nombre normalizado ("perez juan")
+        self.records = {}
+        self.sorted_names = []  # [(nombre, record_id)]
+        self.sorted_words = []  # [(palabra, record_id)]
+        self.tokens = TokenIndex()
+
+    def _insert(self, record):
+        record_id = record['id']
+        words = tokenize(record.get('fields', {}).get(self.name_field))
+        name = " ".join(words)
+        self.names[record_id] = name
+        self.records[record_id] = record
+        bisect.insort(self.sorted_names, (name, record_id))
+        for word in set(words):
+            bisect.insort(self.sorted_words, (word, record_id))
+        self.tokens.add(record_id, words)
+
+    def _delete(self, record_id):
+        name = self.names.pop(record_id, None)
+        self.records.pop(record_id, None)
+        if name is None:
+            return
+        for sorted_list, key in [(self.sorted_names, name)] + [(self.sorted_words, w) for w in set(name.split())]:
+            i = bisect.bisect_left(sorted_list, (key, record_id))
+            if i < len(sorted_list) and sorted_list[i] == (key, record_id):
+                del sorted_list[i]
+        self.tokens.remove(record_id)
+
+    def rebuild(self, records):
+        fresh = PrefixIndex(self.name_field)
+        names, words = [], []
+        for record in records:
+            tokens = tokenize(record.get('fields', {}).get(self.name_field))
+            name = " ".join(tokens)
+            fresh.names[record['id']] = name
+            fresh.records[record['id']] = record
+            names.append((name, record['id']))
+            words.extend((w, record['id']) for w in set(tokens))
+            fresh.tokens.add(record['id'], tokens)
+        fresh.sorted_names = sorted(names)
+        fresh.sorted_words = sorted(words)
+        with self._lock:
+            self.names, self.records = fresh.names, fresh.records
+            self.sorted_names, self.sorted_words = fresh.sorted_names, fresh.sorted_words
+            self.tokens = fresh.tokens
+            self.ready = True
+
+    def upsert(self, record):
+        with self._lock:
+            self._delete(record['id'])
+            self._insert(record)
+
+    def listener(self, event, payload):
+        """Para TableCache.add_listener: 'reset' reconstruye, 'upsert' actualiza un registro."""
+        if event == 'reset':
+            self.rebuild(payload)
+        elif event == 'upsert':
+            self.upsert(payload)
+
+    @staticmethod
+    def _prefix_range(sorted_list, prefix):
+        i = bisect.bisect_left(sorted_list, (prefix,))
+        while i < len(sorted_list) and sorted_list[i][0].startswith(prefix):
+            yield sorted_list[i][1]
+            i += 1
+
+    def search(self, query, limit=10):
+        """
+        Hasta `limit` records ordenados por rango (prefijo del nombre, prefijo de
+        palabra, substring) y, dentro de cada rango, por nombre más corto.
+        """
+        query_tokens = tokenize(query)
+        if not query_tokens or limit <= 0:
+            return []
+        q = " ".join(query_tokens)
+        results = []
+        seen = set()
+
+        def take(candidate_ids, accept):
+            ranked = heapq.nsmallest(
+                limit - len(results),
+                ((len(self.names[i]), self.names[i], i) for i in candidate_ids if i not in seen and accept(self.names[i]))
+            )
+            for _, _, record_id in ranked:
+                seen.add(record_id)
+                results.append(self.records[record_id])
+
+        with self._lock:
+            take(set(self._prefix_range(self.sorted_names, q)), lambda name: True)
+            if len(results) < limit:
+                take(set(self._prefix_range(self.sorted_words, query_tokens[0])),
+                     lambda name: (" " + name).find(" " + q) >= 0)
+            if len(results) < limit:
+                # Candidatos por el término más largo; `q in name` verifica el resto
+                take(self.tokens.ids_matching(max(query_tokens, key=len)), lambda name: q in name)
+        return results
@@ -0,0 +1,209 @@
+"""
+Totales precalculados para /api/admin/stats.
+
+Cada pago exitoso se registra una sola vez (clave: ID del registro de origen en
+Airtable) y actualiza los acumulados por día, por mes y por categoría. El
+endpoint de estadísticas solo lee esos acumulados: su costo no depende de
+cuántos pagos haya en el año.
+
+Lo alimentan `process_payment` (Historial, Recaudación y Patente Manual al
+aprobarse) y los registros en efectivo. Para backfills o para corregir
+diferencias con cambios hechos a mano en Airtable:
+    python stats_rollup.py --rebuild
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from config import BASE_ID, EFECTIVO_TABLE_ID, HISTORIAL_TABLE_ID, PATENTE_MANUAL_TABLE_ID, RECAUDACION_TABLE_ID
+from local_store import data_path, open_db, transaction
+
+STATS_ROLLUP_PATH = os.getenv("STATS_ROLLUP_PATH", data_path("stats_rollup.sqlite3"))
+# Reconstrucción completa periódica (segundos; 0 = deshabilitada)
+STATS_ROLLUP_REBUILD_INTERVAL = int(os.getenv("STATS_ROLLUP_REBUILD_INTERVAL", "21600"))
+
+CATEGORIES = ("deudas", "contributivos", "recaudacion", "patente", "efectivo")
+
+PAGADO_FORMULA = "OR({Estado Pago}='Pagado', {Estado Pago}='Exitoso')"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    source_id TEXT PRIMARY KEY,
+    category TEXT NOT NULL,
+    day TEXT NOT NULL,
+    amount REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS by_day (day TEXT PRIMARY KEY, total REAL NOT NULL, count INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS by_month (month TEXT PRIMARY KEY, total REAL NOT NULL, count INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS by_category (category TEXT PRIMARY KEY, total REAL NOT NULL, count INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+# --- Registros de Airtable -> (source_id, categoría, monto, fecha) ---
+
+def historial_entry(record):
+    f = record.get('fields', {})
+    # Deuda o contributivo según el detalle (mismo criterio que tenía get_stats)
+    cat = "deudas"
+    if "lote" in f.get('Detalle', '').lower() or "Contributivo" in f.get('Detalle', ''):
+        cat = "contributivos"
+    # Usar Timestamp de creación si no hay fecha de transacción
+    return record['id'], cat, f.get('Monto'), f.get('Fecha de Transacción') or record.get('createdTime')
+
+
+def manual_entry(record, category):
+    f = record.get('fields', {})
+    return record['id'], category, f.get('Total'), f.get('Fecha')
+
+
+def efectivo_entry(record):
+    f = record.get('fields', {})
+    return record['id'], "efectivo", f.get('Total'), f.get('Fecha y Hora') or record.get('createdTime')
+
+
+def _normalize(source_id, category, amount, date_str):
+    """(source_id, categoría, día, monto) o None si la fecha no se puede interpretar."""
+    try:
+        # Airtable puede devolver '2026-01-14' o ISO
+        day = datetime.strptime(str(date_str)[:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+        return source_id, category, day, float(amount or 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class StatsRollup:
+    def __init__(self, path=STATS_ROLLUP_PATH):
+        self.path = path
+        self._thread_pid = None
+        with open_db(self.path) as conn:
+            conn.executescript(SCHEMA)
+
+    @staticmethod
+    def _apply(conn, day, category, amount, sign):
+        for table, key_col, key in (("by_day", "day", day), ("by_month", "month", day[:7]), ("by_category", "category", category)):
+            conn.execute(
+                f"""INSERT INTO {table} ({key_col}, total, count) VALUES (?, ?, ?)
+                    ON CONFLICT({key_col}) DO UPDATE SET total = total + excluded.total, count = count + excluded.count""",
+                (key, sign * amount, sign)
+            )
+
+    def record(self, source_id, category, amount, date_str):
+        """
+        Registra un pago. Idempotente: repetir el mismo source_id no suma dos veces,
+        y si cambió el monto/fecha/categoría se corrigen los acumulados.
+        Devuelve True si hubo cambios.
+        """
+        entry = _normalize(source_id, category, amount, date_str)
+        if not entry:
+            print(f"ADVERTENCIA: Pago {source_id} sin fecha válida, no se suma a las estadísticas.")
+            return False
+        _, category, day, amount = entry
+        with open_db(self.path) as conn, transaction(conn):
+            old = conn.execute("SELECT category, day, amount FROM entries WHERE source_id = ?", (source_id,)).fetchone()
+            if old and (old["category"], old["day"], old["amount"]) == (category, day, amount):
+                return False
+            if old:
+                self._apply(conn, old["day"], old["category"], old["amount"], -1)
+            conn.execute("INSERT OR REPLACE INTO entries (source_id, category, day, amount) VALUES (?, ?, ?, ?)",
+                         (source_id, category, day, amount))
+            self._apply(conn, day, category, amount, 1)
+        return True
+
+    def rebuild(self, fetch):
+        """
+        Recalcula todo desde Airtable. `fetch(table_id, formula)` devuelve los records.
+        Reemplaza los acumulados en una sola transacción.
+        """
+        started = time.time()
+        raw = [historial_entry(r) for r in fetch(HISTORIAL_TABLE_ID, "Estado='Exitoso'")]
+        raw += [manual_entry(r, "recaudacion") for r in fetch(RECAUDACION_TABLE_ID, PAGADO_FORMULA)]
+        raw += [manual_entry(r, "patente") for r in fetch(PATENTE_MANUAL_TABLE_ID, PAGADO_FORMULA)]
+        raw += [efectivo_entry(r) for r in fetch(EFECTIVO_TABLE_ID, None)]
+        entries = [e for e in (_normalize(*r) for r in raw) if e]
+
+        with open_db(self.path) as conn, transaction(conn):
+            for table in ("entries", "by_day", "by_month", "by_category"):
+                conn.execute(f"DELETE FROM {table}")
+            conn.executemany("INSERT OR REPLACE INTO entries (source_id, category, day, amount) VALUES (?, ?, ?, ?)", entries)
+            conn.execute("INSERT INTO by_day SELECT day, SUM(amount), COUNT(*) FROM entries GROUP BY day")
+            conn.execute("INSERT INTO by_month SELECT substr(day, 1, 7), SUM(amount), COUNT(*) FROM entries GROUP BY substr(day, 1, 7)")
+            conn.execute("INSERT INTO by_category SELECT category, SUM(amount), COUNT(*) FROM entries GROUP BY category")
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built_at', ?)", (str(time.time()),))
+        print(f"Estadísticas reconstruidas: {len(entries)} pagos en {time.time() - started:.1f}s")
+        return len(entries)
+
+    def built_at(self):
+        with open_db(self.path) as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'built_at'").fetchone()
+        return float(row["value"]) if row else None
+
+    def is_built(self):
+        return self.built_at() is not None
+
+    def start_periodic_rebuild(self, fetch, interval=STATS_ROLLUP_REBUILD_INTERVAL):
+        """
+        Reconstrucción periódica para absorber cambios hechos directo en Airtable.
+        Un thread por proceso; como la marca de tiempo es compartida, con varios
+        workers solo reconstruye el primero que encuentra los totales vencidos.
+        """
+        if interval <= 0 or self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(min(interval, 600))
+                try:
+                    built = self.built_at()
+                    if built is not None and time.time() - built >= interval:
+                        self.rebuild(fetch)
+                except Exception as e:
+                    print(f"ERROR reconstruyendo estadísticas: {e}")
+
+        threading.Thread(target=run, name="stats-rollup", daemon=True).start()
+
+    def snapshot(self):
+        """Respuesta de /api/admin/stats (mismo formato que usa StatsDashboard)."""
+        with open_db(self.path) as conn:
+            days = conn.execute("SELECT day, total, count FROM by_day WHERE count > 0 ORDER BY day").fetchall()
+            months = conn.execute("SELECT month, total FROM by_month WHERE count > 0 ORDER BY month").fetchall()
+            cats = {row["category"]: row for row in conn.execute("SELECT category, total, count FROM by_category")}
+
+        counts = {cat: cats[cat]["count"] if cat in cats else 0 for cat in CATEGORIES}
+        totals = {cat: cats[cat]["total"] if cat in cats else 0 for cat in CATEGORIES}
+        return {
+            "summary": {
+                "total_anual": sum(totals.values()),
+                "cantidad_operaciones": {"total": sum(counts.values()), **counts},
+                "totales_categoria": totals
+            },
+            "daily_chart": [{"date": r["day"], "total": r["total"], "cantidad": r["count"]} for r in days],
+            "monthly_chart": [{"month": r["month"], "total": r["total"]} for r in months]
+        }
+
+
+def main():
+    from airtable_gateway import AirtableGateway
+
+    parser = argparse.ArgumentParser(description="Totales precalculados de /api/admin/stats")
+    parser.add_argument("--rebuild", action="store_true", help="Recalcular todo desde Airtable")
+    args = parser.parse_args()
+
+    rollup = StatsRollup()
+    if args.rebuild:
+        token = os.getenv("AIRTABLE_PAT")
+        if not token:
+            print("ERROR: AIRTABLE_PAT no configurado")
+            raise SystemExit(1)
+        api = AirtableGateway(token).api
+        rollup.rebuild(lambda table_id, formula: api.table(BASE_ID, table_id).all(formula=formula))
+    print(json.dumps(rollup.snapshot()["summary"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Cola persistente de notificaciones de pago de Mercado Pago.
+
+El webhook solo guarda el payment_id en SQLite y responde; los workers
+consultan el pago a MP y ejecutan `process_payment` con reintentos y espera
+exponencial. Después de WEBHOOK_MAX_ATTEMPTS fallos el pago queda en la lista
+de no procesados ('dead') para revisarlo y reintentarlo desde el admin.
+
+Idempotencia por payment_id: las notificaciones repetidas de un pago ya en cola
+o ya procesado como 'approved' no hacen nada. Si el último procesamiento vio
+otro estado (pending, in_process...), el pago vuelve a la cola: MP notifica de
+nuevo cuando cambia el estado.
+"""
+
+import json
+import os
+import threading
+import time
+
+from local_store import data_path, open_db, transaction
+
+WEBHOOK_QUEUE_PATH = os.getenv("WEBHOOK_QUEUE_PATH", data_path("webhook_queue.sqlite3"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))  # threads por proceso
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8"))
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+# Un pago 'processing' sin novedades por más de esto quedó de un worker caído
+STALE_SECONDS = 600
+POLL_SECONDS = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payments (
+    payment_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    mp_status TEXT,
+    source TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    notifications INTEGER NOT NULL DEFAULT 1,
+    run_after REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    result_json TEXT,
+    received_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS payments_ready ON payments (status, run_after);
+"""
+
+
+class WebhookQueue:
+    def __init__(self, handler, path=WEBHOOK_QUEUE_PATH, workers=WEBHOOK_WORKERS, on_dead=None):
+        # handler(payment_id, previous_mp_status) -> dict con al menos "mp_status"
+        self.handler = handler
+        self.on_dead = on_dead  # on_dead(payment_id, error)
+        self.path = path
+        self.workers = workers
+        self._wakeup = threading.Event()
+        self._thread_pid = None
+        with open_db(self.path) as conn:
+            conn.executescript(SCHEMA)
+
+    def enqueue(self, payment_id, source="webhook"):
+        """
+        Registra una notificación. Devuelve 'queued' (nuevo), 'requeued' (ya visto
+        pero sin aprobar, o en la lista de no procesados) o 'duplicate'.
+        """
+        payment_id = str(payment_id)
+        now = time.time()
+        with open_db(self.path) as conn, transaction(conn):
+            row = conn.execute("SELECT status, mp_status FROM payments WHERE payment_id = ?", (payment_id,)).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO payments (payment_id, status, source, received_at, updated_at) VALUES (?, 'queued', ?, ?, ?)",
+                    (payment_id, source, now, now)
+                )
+                outcome = "queued"
+            elif row["status"] in ("queued", "processing") or (row["status"] == "processed" and row["mp_status"] == "approved"):
+                conn.execute("UPDATE payments SET notifications = notifications + 1 WHERE payment_id = ?", (payment_id,))
+                outcome = "duplicate"
+            else:
+                conn.execute(
+                    """UPDATE payments SET status = 'queued', attempts = 0, run_after = 0, source = ?,
+                       notifications = notifications + 1, updated_at = ? WHERE payment_id = ?""",
+                    (source, now, payment_id)
+                )
+                outcome = "requeued"
+        if outcome != "duplicate":
+            self._wakeup.set()
+        return outcome
+
+    # --- Workers ---
+
+    def start_workers(self):
+        """Arranca los threads una vez por proceso (después del fork de gunicorn)."""
+        if self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"mp-webhook-{i}", daemon=True).start()
+
+    def _claim(self):
+        now = time.time()
+        with open_db(self.path) as conn, transaction(conn):
+            conn.execute(
+                "UPDATE payments SET status = 'queued' WHERE status = 'processing' AND updated_at < ?",
+                (now - STALE_SECONDS,)
+            )
+            row = conn.execute(
+                "SELECT payment_id, mp_status, attempts FROM payments WHERE status = 'queued' AND run_after <= ? ORDER BY received_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute(
+                "UPDATE payments SET status = 'processing', attempts = attempts + 1, updated_at = ? WHERE payment_id = ?",
+                (now, row["payment_id"])
+            )
+        return row["payment_id"], row["mp_status"], row["attempts"] + 1
+
+    def _worker(self):
+        while True:
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                print(f"ERROR tomando pagos de la cola de webhooks: {e}")
+                claimed = None
+            if claimed is None:
+                self._wakeup.wait(POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+            self.process(*claimed)
+
+    def process(self, payment_id, previous_mp_status=None, attempt=1):
+        try:
+            result = self.handler(payment_id, previous_mp_status) or {}
+        except Exception as e:
+            dead = attempt >= WEBHOOK_MAX_ATTEMPTS
+            delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+            with open_db(self.path) as conn:
+                conn.execute(
+                    "UPDATE payments SET status = ?, last_error = ?, run_after = ?, updated_at = ? WHERE payment_id = ?",
+                    ("dead" if dead else "queued", str(e)[:1000], time.time() + delay, time.time(), payment_id)
+                )
+            if dead:
+                print(f"ERROR: Pago {payment_id} pasa a la lista de no procesados tras {attempt} intentos: {e}")
+                if self.on_dead:
+                    self.on_dead(payment_id, e)
+            else:
+                print(f"ADVERTENCIA: Falló el procesamiento del pago {payment_id} (intento {attempt}), reintento en {delay}s: {e}")
+            return False
+
+        with open_db(self.path) as conn:
+            conn.execute(
+                """UPDATE payments SET status = 'processed', mp_status = ?, last_error = NULL,
+                   result_json = ?, updated_at = ? WHERE payment_id = ?""",
+                (result.get("mp_status", previous_mp_status), json.dumps(result), time.time(), payment_id)
+            )
+        return True
+
+    # --- Consulta y administración ---
+
+    def payments(self, status=None, limit=100):
+        sql = "SELECT * FROM payments"
+        params = ()
+        if status:
+            sql += " WHERE status = ?"
+            params = (status,)
+        sql += " ORDER BY updated_at DESC LIMIT ?"
+        with open_db(self.path) as conn:
+            rows = conn.execute(sql, params + (limit,)).fetchall()
+        return [dict(row, result=json.loads(row["result_json"]) if row["result_json"] else None) for row in rows]
+
+    def retry(self, payment_id):
+        """Vuelve a encolar un pago de la lista de no procesados. False si no existe."""
+        with open_db(self.path) as conn:
+            cursor = conn.execute(
+                "UPDATE payments SET status = 'queued', attempts = 0, run_after = 0, updated_at = ? WHERE payment_id = ? AND status != 'processing'",
+                (time.time(), str(payment_id))
+            )
+        self._wakeup.set()
+        return cursor.rowcount > 0
+
+    def stats(self):
+        with open_db(self.path) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM payments GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
@@ -67,7 +67,7 @@ const PatenteEfectivo: React.FC = () => {
         total_final: totalFinal
       };
 
-      const response = await fetch(`${API_BASE_URL}/patente_efectivo`, {
+      const response = await fetch(`${API_BASE_URL}/patente_efectivo?pdf_mode=url`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(payload)
@@ -79,7 +79,10 @@ const PatenteEfectivo: React.FC = () => {
         setStatus({ type: 'success', msg: 'Pago en efectivo de patente registrado exitosamente. Comprobante enviado por email.' });
 
         // Crear URL para descargar PDF
-        if (data.pdf_base64) {
+        // El backend devuelve un link firmado al PDF (pdf_base64 queda como respaldo)
+        if (data.pdf_url) {
+            setPdfDownloadUrl(data.pdf_url);
+        } else if (data.pdf_base64) {
             const byteCharacters = atob(data.pdf_base64);
             const byteNumbers = new Array(byteCharacters.length);
             for (let i = 0; i < byteCharacters.length; i++) {
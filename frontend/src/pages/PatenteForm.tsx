@@ -67,7 +67,7 @@ const PatenteForm: React.FC = () => {
         total_final: totalFinal
       };
 
-      const response = await fetch(`${API_BASE_URL}/patente_manual`, {
+      const response = await fetch(`${API_BASE_URL}/patente_manual?pdf_mode=url`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(payload)
@@ -79,7 +79,10 @@ const PatenteForm: React.FC = () => {
         setStatus({ type: 'success', msg: 'Pago de Patente registrado, PDF generado y email enviado con éxito.' });
         
         // Crear URL para descargar PDF
-        if (data.pdf_base64) {
+        // El backend devuelve un link firmado al PDF (pdf_base64 queda como respaldo)
+        if (data.pdf_url) {
+            setPdfDownloadUrl(data.pdf_url);
+        } else if (data.pdf_base64) {
             const byteCharacters = atob(data.pdf_base64);
             const byteNumbers = new Array(byteCharacters.length);
             for (let i = 0; i < byteCharacters.length; i++) {
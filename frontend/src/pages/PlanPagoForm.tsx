@@ -49,7 +49,7 @@ const PlanPagoForm: React.FC = () => {
     setMpLink(null);
 
     try {
-      const response = await fetch(`${API_BASE_URL}/plan_pago`, {
+      const response = await fetch(`${API_BASE_URL}/plan_pago?pdf_mode=url`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(formData)
@@ -72,7 +72,10 @@ const PlanPagoForm: React.FC = () => {
         setStatus({ type: 'success', msg: successMsg });
 
         // Crear URL para descargar PDF
-        if (data.pdf_base64) {
+        // El backend devuelve un link firmado al PDF (pdf_base64 queda como respaldo)
+        if (data.pdf_url) {
+            setPdfDownloadUrl(data.pdf_url);
+        } else if (data.pdf_base64) {
             const byteCharacters = atob(data.pdf_base64);
             const byteNumbers = new Array(byteCharacters.length);
             for (let i = 0; i < byteCharacters.length; i++) {
@@ -120,7 +120,7 @@ const RecaudacionEfectivo: React.FC = () => {
         total_final: totalFinal
       };
 
-      const response = await fetch(`${API_BASE_URL}/recaudacion_efectivo`, {
+      const response = await fetch(`${API_BASE_URL}/recaudacion_efectivo?pdf_mode=url`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(payload)
@@ -132,7 +132,10 @@ const RecaudacionEfectivo: React.FC = () => {
         setStatus({ type: 'success', msg: data.message || 'Pago en efectivo registrado exitosamente. Comprobante enviado por email.' });
 
         // Crear URL para descargar PDF
-        if (data.pdf_base64) {
+        // El backend devuelve un link firmado al PDF (pdf_base64 queda como respaldo)
+        if (data.pdf_url) {
+            setPdfDownloadUrl(data.pdf_url);
+        } else if (data.pdf_base64) {
             const byteCharacters = atob(data.pdf_base64);
             const byteNumbers = new Array(byteCharacters.length);
             for (let i = 0; i < byteCharacters.length; i++) {
@@ -121,7 +121,7 @@ const RecaudacionForm: React.FC = () => {
         total_final: totalFinal
       };
 
-      const response = await fetch(`${API_BASE_URL}/recaudacion`, {
+      const response = await fetch(`${API_BASE_URL}/recaudacion?pdf_mode=url`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(payload)
@@ -133,7 +133,10 @@ const RecaudacionForm: React.FC = () => {
         // Usar el mensaje dinámico del backend que indica qué funcionó
         setStatus({ type: 'success', msg: data.message || 'Recaudación registrada exitosamente.' });
         // Crear URL para descargar PDF
-        if (data.pdf_base64) {
+        // El backend devuelve un link firmado al PDF (pdf_base64 queda como respaldo)
+        if (data.pdf_url) {
+            setPdfDownloadUrl(data.pdf_url);
+        } else if (data.pdf_base64) {
             const byteCharacters = atob(data.pdf_base64);
             const byteNumbers = new Array(byteCharacters.length);
             for (let i = 0; i < byteCharacters.length; i++) {